@@ -0,0 +1,50 @@
+"""Compare decode_audio with the previous librosa.load path on the files in tests/testdata.
+
+Run from the repository root: python -m benchmarks.bench_decode [--repeat N]
+"""
+import argparse
+import glob
+import os
+import time
+
+import librosa
+
+from scripts.utils.analysis import decode_audio
+
+TESTDATA = os.path.join(os.path.dirname(__file__), '..', 'tests', 'testdata')
+# BirdNET and Perch input rates
+SAMPLE_RATES = [48000, 32000]
+
+
+def librosa_decode(path, sample_rate):
+    return librosa.load(path, sr=sample_rate, mono=True, res_type='kaiser_fast')
+
+
+def best_of(func, path, sample_rate, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(path, sample_rate)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5, help='runs per measurement, the best one is reported')
+    args = parser.parse_args()
+
+    print(f'{"file":<32} {"rate":>6} {"librosa ms":>11} {"decode_audio ms":>16} {"speedup":>8}')
+    for path in sorted(glob.glob(os.path.join(TESTDATA, '*.wav'))):
+        for sample_rate in SAMPLE_RATES:
+            try:
+                old = best_of(librosa_decode, path, sample_rate, args.repeat)
+            except Exception as e:  # kaiser_fast needs the optional resampy package
+                print(f'{os.path.basename(path):<32} {sample_rate:>6} librosa failed: {str(e).splitlines()[0]}')
+                continue
+            new = best_of(decode_audio, path, sample_rate, args.repeat)
+            print(f'{os.path.basename(path):<32} {sample_rate:>6} {old * 1000:>11.1f} {new * 1000:>16.1f} {old / new:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,281 @@
+"""Time every stage of the analysis of a recording, for each model class.
+
+Runs on tests/testdata/Pica pica_30s.wav and on synthetic noise. By default the tflite interpreters are replaced by a
+deterministic fake with the tensor layout of each model, so no model files are needed and the numbers only move
+when the code around the interpreter does. Results can be saved as JSON and compared with those of another commit.
+
+Run from the repository root: python -m benchmarks.bench_inference [--repeat N] [--json FILE] [--compare FILE]
+"""
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from unittest.mock import patch
+
+import numpy as np
+import soundfile
+
+from scripts.utils import analysis, helpers, models
+from scripts.utils.analysis import apply_highpass_filter, chunk_starts, decode_audio, filter_humans, get_class_filter, \
+    get_detections, splitSignal, _get_numeric_setting
+
+TESTDATA = os.path.join(os.path.dirname(__file__), '..', 'tests', 'testdata')
+MODELS = {'BirdNET_6K_GLOBAL_MODEL': models.BirdNetV1, 'BirdNET_GLOBAL_6K_V2.4_Model_FP16': models.BirdNetV2_4,
+          'BirdNET-Go_classifier_20250916': models.BirdNETGo20250916, 'Perch_v2': models.Perch}
+STAGES = ['decode', 'highpass', 'split', 'invoke', 'label', 'privacy', 'species', 'detections']
+SETTINGS = {
+    'LATITUDE': '50.8', 'LONGITUDE': '4.4', 'CONFIDENCE': '0.7', 'SENSITIVITY': '1.25', 'OVERLAP': '0.0',
+    'SF_THRESH': '0.03', 'DATA_MODEL_VERSION': '1', 'PRIVACY_THRESHOLD': '0', 'DATABASE_LANG': 'en', 'HIGHPASS_HZ': '200',
+    'EXTRACTION_LENGTH': '6',
+}
+# the fake interpreter for models without label file here
+SYNTHETIC_CLASSES = {'Perch_v2': 14795}
+NOISE_SECONDS = 30
+NOISE_RATE = 48000
+
+
+class FakeInterpreter:
+    """Deterministic stand-in for tflite.Interpreter with the tensors of a model: inputs, hidden tensors, outputs.
+
+    Logits are a fixed random projection of the log energy in 32 bands of each chunk, so they depend on the audio
+    but cost next to nothing compared to the stages around the interpreter. Other 2-D tensors (embeddings) get the
+    same treatment, anything else is zeros.
+    """
+
+    def __init__(self, inputs, outputs, logits=0, hidden=(), squash=False):
+        self.inputs = [list(shape) for shape in inputs]
+        self.hidden = [list(shape) for shape in hidden]
+        self.outputs = [list(shape) for shape in outputs]
+        self._first_output = len(self.inputs) + len(self.hidden)
+        self.logits = self._first_output + logits
+        self.squash = squash
+        rng = np.random.default_rng(0)
+        features = min(32, self.inputs[0][-1])
+        self.weights = {idx: (rng.standard_normal((features, shape[-1])).astype('float32') / np.sqrt(features),
+                              rng.normal(-4.0, 2.0, shape[-1]).astype('float32'))
+                        for idx, shape in enumerate(self.inputs + self.hidden + self.outputs)
+                        if idx >= len(self.inputs) and len(shape) == 2}
+        self._tensors = {}
+
+    def _details(self, shapes, offset):
+        return [{'index': offset + i, 'shape': np.array(shape)} for i, shape in enumerate(shapes)]
+
+    def get_input_details(self):
+        return self._details(self.inputs, 0)
+
+    def get_output_details(self):
+        return self._details(self.outputs, self._first_output)
+
+    def get_tensor_details(self):
+        return self._details(self.inputs + self.hidden + self.outputs, 0)
+
+    def resize_tensor_input(self, idx, shape):
+        self.inputs[idx] = list(shape)
+
+    def allocate_tensors(self):
+        for shape in self.hidden + self.outputs:
+            shape[0] = self.inputs[0][0]
+
+    def set_tensor(self, idx, value):
+        if list(value.shape) != self.inputs[idx]:
+            raise ValueError(f'tensor {idx} is {self.inputs[idx]}, got {list(value.shape)}')
+        self._tensors[idx] = value
+
+    def invoke(self):
+        x = self._tensors[0]
+        if x.shape[-1] > 32:
+            x = np.log(np.mean(np.square(x[:, :x.shape[-1] // 32 * 32].reshape(len(x), 32, -1)), axis=-1) + 1e-10)
+        x = (x - x.mean(axis=-1, keepdims=True)) / (x.std(axis=-1, keepdims=True) + 1e-6)
+        for idx, (weights, bias) in self.weights.items():
+            out = x @ weights + bias
+            self._tensors[idx] = 1 / (1 + np.exp(-out)) if self.squash and idx == self.logits else out
+
+    def get_tensor(self, idx):
+        if idx in self.weights:
+            return self._tensors[idx]
+        return np.zeros((self.inputs + self.hidden + self.outputs)[idx], dtype='float32')
+
+
+def fake_interpreter(model_path, num_threads=None, xnnpack=True):
+    name = os.path.basename(model_path)[:-len('.tflite')]
+    if 'MData' in name:
+        return FakeInterpreter([[1, 3]], [[1, len(benchmark_labels('BirdNET_GLOBAL_6K_V2.4_Model_FP16'))]], squash=True)
+    classes = len(benchmark_labels(name))
+    if name == 'Perch_v2':
+        # embedding, spatial embedding, spectrogram, logits
+        return FakeInterpreter([[1, 160000]], [[1, 1536], [1, 16, 4, 1536], [1, 500, 128], [1, classes]], logits=3)
+    # BirdNET: the global average pool right before the logits is the embedding
+    if name == 'BirdNET_6K_GLOBAL_MODEL':
+        return FakeInterpreter([[1, 144000], [1, 6]], [[1, classes]], hidden=[[1, 1024]])
+    return FakeInterpreter([[1, 144000]], [[1, classes]], hidden=[[1, 1024]])
+
+
+def benchmark_labels(model=None):
+    try:
+        return helpers.get_model_labels(model)
+    except FileNotFoundError:
+        base = helpers.get_model_labels('BirdNET_GLOBAL_6K_V2.4_Model_FP16')
+        return base + [f'Species {i}' for i in range(len(base), SYNTHETIC_CLASSES.get(model, len(base)))]
+
+
+def make_settings(path=None):
+    parser = helpers.PHPConfigParser(interpolation=None)
+    parser.optionxform = lambda option: option
+    if path is not None:
+        with open(path) as f:
+            parser.read_string('[top]\n' + f.read())
+    else:
+        parser.read_dict({'top': SETTINGS})
+    return parser['top']
+
+
+@contextlib.contextmanager
+def environment(conf, fake=True):
+    """Settings (and with fake, interpreters and labels) for the benchmark, the occurrence tables in a temp dir."""
+    with tempfile.TemporaryDirectory() as cache_dir, contextlib.ExitStack() as stack:
+        stack.enter_context(patch('scripts.utils.helpers._load_settings', return_value=conf))
+        stack.enter_context(patch('scripts.utils.models.CACHE_DIR', cache_dir))
+        if fake:
+            stack.enter_context(patch('scripts.utils.models.make_interpreter', fake_interpreter))
+            stack.enter_context(patch('scripts.utils.models.get_model_labels', benchmark_labels))
+        yield cache_dir
+
+
+def write_noise(path):
+    rng = np.random.default_rng(0)
+    soundfile.write(path, (0.1 * rng.standard_normal(NOISE_SECONDS * NOISE_RATE)).astype('float32'), NOISE_RATE, subtype='PCM_16')
+
+
+def time_stages(model, path, conf, repeat):
+    """Best and median time of each stage over repeat runs, and what the last run found."""
+    timings = {stage: [] for stage in STAGES}
+    lat, lon, overlap = conf.getfloat('LATITUDE'), conf.getfloat('LONGITUDE'), conf.getfloat('OVERLAP')
+    highpass_hz = _get_numeric_setting(conf, 'HIGHPASS_HZ', 0.0)
+    file_date = datetime.datetime(2024, 5, 1, 6, 0, 0)
+    include, exclude, whitelist = [], [], []
+    # BirdNET V1 takes the location as input of the invoke
+    model.set_meta_data(lat, lon, file_date.isocalendar()[1])
+
+    def timed(stage, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        timings[stage].append(time.perf_counter() - start)
+        return result
+
+    for _ in range(repeat):
+        sig, rate = timed('decode', decode_audio, path, model.sample_rate)
+        sig = timed('highpass', apply_highpass_filter, sig, rate, highpass_hz)
+        chunks = timed('split', splitSignal, sig, rate, overlap, model.chunk_duration)
+        logits = timed('invoke', model.predict_logits, chunks)
+
+        def label():
+            scores = model.scores(logits)
+            return [model.top_k(s) for s in scores], model.human_ranks(scores)
+        predictions, human_ranks = timed('label', label)
+        predictions = timed('privacy', filter_humans, predictions, human_ranks)
+
+        def species():
+            # what a new week costs: the species list and the class filter of the labels
+            analysis._class_filters.clear()
+            model.set_meta_data(lat, lon, file_date.isocalendar()[1])
+            species_list = model.get_species_list()
+            get_class_filter(model.labels, species_list, include, exclude, whitelist)
+            return species_list
+        species_list = timed('species', species)
+
+        raw = {f'{start};{start + model.chunk_duration}': p
+               for start, p in zip(chunk_starts(len(predictions), model.chunk_duration, overlap), predictions)}
+        detections = timed('detections', get_detections, file_date, raw, species_list)
+
+    return {
+        'chunks': len(chunks),
+        'detections': len(detections),
+        'stages': {stage: {'best_ms': min(t) * 1000, 'median_ms': statistics.median(t) * 1000} for stage, t in timings.items()},
+    }
+
+
+def run(model_names=None, repeat=5, fake=True, settings_path=None):
+    conf = make_settings(settings_path)
+    results = []
+    with environment(conf, fake) as tmp:
+        noise = os.path.join(tmp, 'noise_30s.wav')
+        write_noise(noise)
+        inputs = [os.path.join(TESTDATA, 'Pica pica_30s.wav'), noise]
+        for name in model_names or MODELS:
+            conf['MODEL'] = name
+            try:
+                model = models.get_model(name)
+            except (ValueError, FileNotFoundError) as e:
+                print(f'{name}: skipped, {e}', file=sys.stderr)
+                continue
+            for path in inputs:
+                result = time_stages(model, path, conf, repeat)
+                results.append({'model': name, 'input': os.path.basename(path), **result})
+    return {
+        'commit': git_commit(),
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'interpreter': 'fake' if fake else 'tflite',
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(__file__),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(report, previous=None, threshold=1.25):
+    """Best times per stage; with previous (an earlier report), how much slower each stage got."""
+    before = {}
+    if previous is not None:
+        before = {(r['model'], r['input']): r['stages'] for r in previous['results']}
+        print(f'compared with {previous.get("commit")} ({previous.get("interpreter")} interpreter)')
+    for result in report['results']:
+        print(f'{result["model"]} on {result["input"]}: {result["chunks"]} chunks, {result["detections"]} detections')
+        old = before.get((result['model'], result['input']), {})
+        for stage, timing in result['stages'].items():
+            line = f'  {stage:<12} {timing["best_ms"]:>9.2f} ms'
+            if stage in old and old[stage]['best_ms'] > 0:
+                ratio = timing['best_ms'] / old[stage]['best_ms']
+                line += f'  {ratio:>5.2f}x' + ('  slower' if ratio > threshold else '')
+            print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5, help='runs per measurement, the best one is reported')
+    parser.add_argument('--model', action='append', choices=list(MODELS), help='model class to time, default all')
+    parser.add_argument('--tflite', action='store_true', help='use the real interpreters, models without files are skipped')
+    parser.add_argument('--settings', help='birdnet.conf to use instead of the built-in settings')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare', help='results of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=1.25, help='ratio over which a stage is marked slower')
+    args = parser.parse_args()
+
+    report = run(args.model, args.repeat, not args.tflite, args.settings)
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    print_results(report, previous, args.threshold)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
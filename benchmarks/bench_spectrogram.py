@@ -0,0 +1,74 @@
+"""Compare the cached SpectrogramPlan with the previous detection spectrogram DSP on clips of tests/testdata.
+
+The previous path redesigned the filter, ran an STFT, an ISTFT for the noise gate and a second STFT with a new mel
+filterbank for every clip. Both are timed per clip, after a first call that pays the one-time costs.
+
+Run from the repository root: python -m benchmarks.bench_spectrogram [--repeat N] [--length SECONDS]
+"""
+import argparse
+import glob
+import os
+import time
+import warnings
+
+import librosa
+import numpy as np
+import soundfile
+from scipy import signal
+
+from scripts.utils.reporting import EPSILON, NOISE_PROFILE_PERCENTILE, get_spectrogram_plan
+
+TESTDATA = os.path.join(os.path.dirname(__file__), '..', 'tests', 'testdata')
+RATE = 48000
+
+
+def legacy_matrix(y, sr):
+    sos = signal.butter(4, 1000, btype="highpass", fs=sr, output="sos")
+    y = signal.sosfilt(sos, y)
+    n_fft = 8192
+    hop_length = 1228
+    D = librosa.stft(y, n_fft=n_fft, hop_length=hop_length, window="hann")
+    magnitude = np.abs(D)
+    noise_profile = np.percentile(magnitude, NOISE_PROFILE_PERCENTILE, axis=1, keepdims=True)
+    reduced_mag = np.maximum(magnitude - noise_profile, 0.0)
+    y = librosa.istft(reduced_mag * np.exp(1j * np.angle(D)), hop_length=hop_length, length=len(y))
+    S = librosa.feature.melspectrogram(y=y, sr=sr, n_fft=n_fft, hop_length=hop_length, window="hann", n_mels=1024,
+                                       fmin=900, fmax=14000, power=1.0)
+    return librosa.pcen(S + EPSILON, sr=sr, hop_length=hop_length, gain=0.7, bias=9.0, power=1.0)
+
+
+def plan_matrix(y, sr):
+    return get_spectrogram_plan(sr).matrix(y)
+
+
+def best_of(func, y, repeat):
+    func(y, RATE)
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(y, RATE)
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5, help='runs per measurement, the best one is reported')
+    parser.add_argument('--length', type=float, default=6.0, help='clip length in seconds, as EXTRACTION_LENGTH')
+    args = parser.parse_args()
+    # the 1024 band filterbank has empty bands at this FFT size, in both paths
+    warnings.filterwarnings('ignore', message='Empty filters detected')
+
+    print(f'{"file":<32} {"previous ms":>12} {"plan ms":>8} {"speedup":>8} {"correlation":>12}')
+    for path in sorted(glob.glob(os.path.join(TESTDATA, '*.wav'))):
+        y, sr = soundfile.read(path, dtype='float32', frames=int(args.length * RATE))
+        if sr != RATE or y.ndim != 1 or len(y) < args.length * RATE:
+            continue
+        old, old_matrix = best_of(legacy_matrix, y, args.repeat)
+        new, new_matrix = best_of(plan_matrix, y, args.repeat)
+        correlation = np.corrcoef(old_matrix.ravel(), new_matrix.ravel())[0, 1]
+        print(f'{os.path.basename(path):<32} {old * 1000:>12.1f} {new * 1000:>8.1f} {old / new:>7.1f}x {correlation:>12.4f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,41 @@
+import argparse
+import functools
 import logging
+import multiprocessing
 import os
 import os.path
 import re
 import signal
+import subprocess
 import sys
 import threading
-from queue import Queue
+import time
+from queue import Empty, Full, Queue
 from subprocess import CalledProcessError
 
 import inotify.adapters
+import numpy as np
 from inotify.constants import IN_CLOSE_WRITE
 
-from utils.analysis import load_global_model, run_analysis
+from utils.analysis import load_ensemble_model, load_global_model, load_audio, run_analysis
+from utils.birdweather import close_uploader
+from utils.db import get_db_writer
 from utils.helpers import get_settings, get_wav_files, ANALYZING_NOW
 from utils.classes import ParseFileName
-from utils.reporting import extract_detection, summary, write_to_file, write_to_db, apprise, bird_weather, heartbeat, \
+from utils.streaming import StreamAnalyzer, open_pcm_source, read_pcm_blocks
+from utils.reporting import SpectrogramPool, extract_detections, summary, write_to_file, write_detections_to_db, apprise, bird_weather, heartbeat, \
     update_json_file
 
 shutdown = False
+# number of files that may wait between pipeline stages
+DECODE_QUEUE_SIZE = 2
+ANALYSIS_QUEUE_SIZE = 2
+REPORT_QUEUE_SIZE = 4
+# how often a blocked queue checks that the worker processes at the other end are still alive
+WORKER_CHECK_SECONDS = 1
+# what --startup-profile times, heavy modules here should not be loaded until they are needed
+PROFILE_MODULES = ['birdnet_analysis', 'utils.helpers', 'utils.models', 'utils.analysis', 'utils.reporting', 'tflite_runtime.interpreter',
+                   'soundfile', 'scipy.signal', 'librosa', 'matplotlib.pyplot', 'PIL.Image', 'requests', 'apprise', 'tensorflow']
 
 log = logging.getLogger(__name__)
 
@@ -28,24 +46,124 @@ def sig_handler(sig_num, curr_stack_frame):
     shutdown = True
 
 
+class AnalysisPipeline:
+    """decode -> analysis in threads of this process, bounded queues so a slow stage holds back the ones before it"""
+
+    def __init__(self, report_queue, decode_queue=None):
+        load_global_model()
+        load_ensemble_model()
+        self.decode_queue = Queue(maxsize=DECODE_QUEUE_SIZE) if decode_queue is None else decode_queue
+        analysis_queue = Queue(maxsize=ANALYSIS_QUEUE_SIZE)
+        self.threads = [threading.Thread(target=handle_decode_queue, args=(self.decode_queue, analysis_queue)),
+                        threading.Thread(target=handle_analysis_queue, args=(analysis_queue, report_queue))]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, file_name):
+        self.decode_queue.put(file_name)
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+    def close(self):
+        # the None signal is passed on by every stage, down to the reporting queue
+        self.decode_queue.put(None)
+        self.join()
+
+
+class AnalysisWorkerPool:
+    """One AnalysisPipeline per worker process, each with its own interpreter.
+
+    Files of the same RTSP stream always go to the same worker, so they are analyzed in order.
+    Results of all workers are funneled into the single report_queue of this process.
+    """
+
+    def __init__(self, report_queue, workers, target=None):
+        ctx = multiprocessing.get_context('spawn')
+        self.file_queues = [ctx.Queue(maxsize=DECODE_QUEUE_SIZE) for _ in range(workers)]
+        result_queue = ctx.Queue(maxsize=REPORT_QUEUE_SIZE)
+        self.processes = [ctx.Process(target=analysis_worker if target is None else target, args=(file_queue, result_queue),
+                                      name=f'analysis-{n}')
+                          for n, file_queue in enumerate(self.file_queues)]
+        for process in self.processes:
+            process.start()
+        self.collector = threading.Thread(target=collect_results, args=(result_queue, report_queue, self.processes))
+        self.collector.start()
+
+    def worker_for(self, file_name):
+        match = re.search('RTSP_([0-9]+)-', file_name)
+        return int(match.group(1)) % len(self.file_queues) if match is not None else 0
+
+    def _put(self, worker, item):
+        # a dead worker would never make room in its queue
+        while self.processes[worker].is_alive():
+            try:
+                self.file_queues[worker].put(item, timeout=WORKER_CHECK_SECONDS)
+                return True
+            except Full:
+                continue
+        worker_died(self.processes[worker])
+        return False
+
+    def submit(self, file_name):
+        # not queued for a dead worker, the file stays in StreamData for the next start
+        self._put(self.worker_for(file_name), file_name)
+
+    def close(self):
+        for worker in range(len(self.file_queues)):
+            self._put(worker, None)
+        for process in self.processes:
+            process.join()
+        self.collector.join()
+
+
+def worker_died(process):
+    # stop, so systemd starts the service again and the files left in StreamData are analyzed as backlog
+    global shutdown
+    if not shutdown:
+        log.error('%s exited with code %s, stopping', process.name, process.exitcode)
+    shutdown = True
+
+
+def get_analysis_workers(conf):
+    try:
+        return max(1, conf.getint('ANALYSIS_WORKERS', fallback=1))
+    except ValueError:
+        return 1
+
+
+def get_spectrogram_workers(conf):
+    try:
+        return max(0, conf.getint('SPECTROGRAM_WORKERS', fallback=1))
+    except ValueError:
+        return 1
+
+
 def main():
-    load_global_model()
     conf = get_settings()
     i = inotify.adapters.Inotify()
     i.add_watch(os.path.join(conf['RECS_DIR'], 'StreamData'), mask=IN_CLOSE_WRITE)
 
     backlog = get_wav_files()
 
-    report_queue = Queue()
-    thread = threading.Thread(target=handle_reporting_queue, args=(report_queue, ))
-    thread.start()
+    report_queue = Queue(maxsize=REPORT_QUEUE_SIZE)
+    reporting = threading.Thread(target=handle_reporting_queue, args=(report_queue, ))
+    reporting.start()
+
+    workers = get_analysis_workers(conf)
+    if workers > 1:
+        log.info('starting %d analysis workers', workers)
+        pipeline = AnalysisWorkerPool(report_queue, workers)
+    else:
+        pipeline = AnalysisPipeline(report_queue)
 
     log.info('backlog is %d', len(backlog))
     for file_name in backlog:
-        process_file(file_name, report_queue)
+        pipeline.submit(file_name)
         if shutdown:
             break
-    log.info('backlog done')
+    log.info('backlog queued')
 
     empty_count = 0
     for event in i.event_gen():
@@ -71,36 +189,158 @@ def main():
             backlog = []
             continue
 
-        process_file(file_path, report_queue)
+        pipeline.submit(file_path)
         empty_count = 0
 
     # we're all done
+    pipeline.close()
+    reporting.join()
+
+
+def stream_main(source, rate, channels):
+    # analyze raw PCM (e.g. arecord -t raw -f S16_LE or ffmpeg -f s16le) as it arrives, without recording files first
+    report_queue = Queue(maxsize=REPORT_QUEUE_SIZE)
+    reporting = threading.Thread(target=handle_reporting_queue, args=(report_queue, ))
+    reporting.start()
+
+    analyzer = StreamAnalyzer(rate, lambda file, detections: report_queue.put((file, detections)))
+    log.info('analyzing stream %s at %d Hz', source, rate)
+    with open_pcm_source(source) as stream:
+        for block in read_pcm_blocks(stream, rate, channels):
+            analyzer.feed(block)
+            if shutdown:
+                break
+    analyzer.close()
+    log.info('stream ended')
+
     report_queue.put(None)
-    thread.join()
-    report_queue.join()
+    reporting.join()
 
 
-def process_file(file_name, report_queue):
+def startup_profile():
+    # every import timed in a fresh interpreter, so each is a cold start on its own
+    code = 'import time; start = time.perf_counter(); import {}; print(time.perf_counter() - start)'
+    for module in PROFILE_MODULES:
+        result = subprocess.run([sys.executable, '-c', code.format(module)], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True)
+        if result.returncode != 0:
+            log.info('import %-28s not installed', module)
+            continue
+        state = 'loaded at start' if module in sys.modules or module == 'birdnet_analysis' else 'deferred'
+        log.info('import %-28s %8.1f ms  %s', module, float(result.stdout.split()[-1]) * 1000, state)
+
+    start = time.perf_counter()
+    model = load_global_model()
+    log.info('load model %-24s %8.1f ms', model.model_name, (time.perf_counter() - start) * 1000)
+    start = time.perf_counter()
+    model.predict_batch(np.zeros(int(model.chunk_duration * model.sample_rate), dtype='float32'))
+    log.info('first inference %19s %8.1f ms', '', (time.perf_counter() - start) * 1000)
+
+
+def decode_file(file_name):
     try:
         if os.path.getsize(file_name) == 0:
             os.remove(file_name)
-            return
-        log.info('Analyzing %s', file_name)
-        with open(ANALYZING_NOW, 'w') as analyzing:
-            analyzing.write(file_name)
+            return None
         file = ParseFileName(file_name)
-        detections = run_analysis(file)
-        # we join() to make sure te reporting queue does not get behind
-        if not report_queue.empty():
-            log.warning('reporting queue not yet empty')
-        report_queue.join()
+        try:
+            audio_data = load_audio(file)
+        except (NameError, TypeError) as e:
+            log.error("Error with the following info: %s", e)
+            audio_data = None
+        return file, audio_data
+    except BaseException as e:
+        stderr = e.stderr.decode('utf-8') if isinstance(e, CalledProcessError) else ""
+        log.exception(f'Unexpected error: {stderr}', exc_info=e)
+        return None
+
+
+def process_file(file, audio_data, report_queue):
+    try:
+        log.info('Analyzing %s', file.file_name)
+        with open(ANALYZING_NOW, 'w') as analyzing:
+            analyzing.write(file.file_name)
+        # audio that could not be decoded is reported without detections, so it is cleaned up
+        detections = run_analysis(file, audio_data) if audio_data is not None else []
+        if report_queue.full():
+            log.warning('reporting queue is full')
         report_queue.put((file, detections))
     except BaseException as e:
         stderr = e.stderr.decode('utf-8') if isinstance(e, CalledProcessError) else ""
         log.exception(f'Unexpected error: {stderr}', exc_info=e)
 
 
+def handle_decode_queue(queue, analysis_queue):
+    while True:
+        file_name = queue.get()
+        if file_name is None:
+            break
+        # files left after a shutdown stay in StreamData and are picked up as backlog on the next start
+        if shutdown:
+            continue
+
+        decoded = decode_file(file_name)
+        if decoded is not None:
+            analysis_queue.put(decoded)
+
+    analysis_queue.put(None)
+    log.info('handle_decode_queue done')
+
+
+def handle_analysis_queue(queue, report_queue):
+    while True:
+        msg = queue.get()
+        if msg is None:
+            break
+        if shutdown:
+            continue
+
+        file, audio_data = msg
+        process_file(file, audio_data, report_queue)
+
+    report_queue.put(None)
+    log.info('handle_analysis_queue done')
+
+
+def analysis_worker(file_queue, result_queue):
+    signal.signal(signal.SIGINT, sig_handler)
+    signal.signal(signal.SIGTERM, sig_handler)
+    setup_logging()
+
+    # runs until the pool sends None through file_queue
+    AnalysisPipeline(result_queue, file_queue).join()
+
+
+def collect_results(result_queue, report_queue, processes):
+    # a worker is done once it has exited, after passing on the None of close() or because it died
+    running = list(processes)
+    while running:
+        try:
+            msg = result_queue.get(timeout=WORKER_CHECK_SECONDS)
+        except Empty:
+            for process in [p for p in running if not p.is_alive()]:
+                running.remove(process)
+                if process.exitcode != 0:
+                    worker_died(process)
+            continue
+        if msg is not None:
+            report_queue.put(msg)
+    # what the workers put in before they exited
+    while True:
+        try:
+            msg = result_queue.get(timeout=0.1)
+        except Empty:
+            break
+        if msg is not None:
+            report_queue.put(msg)
+    report_queue.put(None)
+    log.info('collect_results done')
+
+
 def handle_reporting_queue(queue):
+    # the spectrograms follow the other sinks from their own processes, unless SPECTROGRAM_WORKERS=0
+    workers = get_spectrogram_workers(get_settings())
+    spectrograms = SpectrogramPool(workers) if workers else None
     while True:
         msg = queue.get()
         # check for signal that we are done
@@ -110,11 +350,14 @@ def handle_reporting_queue(queue):
         file, detections = msg
         try:
             update_json_file(file, detections)
+            render = functools.partial(spectrograms.submit, priority=spectrograms.priority(file)) if spectrograms else None
+            for detection, file_name_extr in zip(detections, extract_detections(file, detections, render)):
+                detection.file_name_extr = file_name_extr
             for detection in detections:
-                detection.file_name_extr = extract_detection(file, detection)
                 log.info('%s;%s', summary(file, detection), os.path.basename(detection.file_name_extr))
                 write_to_file(file, detection)
-                write_to_db(file, detection)
+            # one transaction for the recording
+            write_detections_to_db(file, detections)
             apprise(file, detections)
             bird_weather(file, detections)
             heartbeat()
@@ -125,6 +368,13 @@ def handle_reporting_queue(queue):
 
         queue.task_done()
 
+    if spectrograms is not None:
+        spectrograms.close()
+    get_db_writer().close()
+    close_uploader()
+    # loaded with the first notification
+    if 'utils.notifications' in sys.modules:
+        sys.modules['utils.notifications'].close_dispatcher()
     # mark the 'None' signal as processed
     queue.task_done()
     log.info('handle_reporting_queue done')
@@ -147,4 +397,16 @@ if __name__ == '__main__':
 
     setup_logging()
 
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--stream', metavar='SOURCE', help="analyze raw S16_LE PCM from '-' (stdin), a FIFO or tcp://host:port")
+    parser.add_argument('--rate', default=48000, type=int, help='sample rate of the stream')
+    parser.add_argument('--channels', default=1, type=int, help='channels of the stream, mixed down to mono')
+    parser.add_argument('--startup-profile', action='store_true', help='time the imports and model load of a cold start, then exit')
+    args = parser.parse_args()
+
+    if args.startup_profile:
+        startup_profile()
+    elif args.stream:
+        stream_main(args.stream, args.rate, args.channels)
+    else:
+        main()
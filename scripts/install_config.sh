@@ -107,6 +107,9 @@ APPRISE_NOTIFY_NEW_SPECIES_EACH_DAY=0
 APPRISE_MINIMUM_SECONDS_BETWEEN_NOTIFICATIONS_PER_SPECIES=0
 APPRISE_ONLY_NOTIFY_SPECIES_NAMES=""
 APPRISE_ONLY_NOTIFY_SPECIES_NAMES_2=""
+## APPRISE_ONE_MESSAGE_PER_RECORDING=1 sends the notifications of all species
+## of one recording as a single message, instead of one message each.
+APPRISE_ONE_MESSAGE_PER_RECORDING=0
 
 #----------------------  Image Provider Configuration ------------------------#
 ## WIKIPEDIA or FLICKR (Flickr requires API key)
@@ -228,6 +231,51 @@ CHANNELS=2
 
 PRIVACY_THRESHOLD=0
 
+## ANALYSIS_WORKERS is the number of processes birdnet_analysis.service uses to
+## analyze recordings. Each worker loads its own copy of the model, so only
+## raise this when recording several RTSP streams on a Pi with cores and memory
+## to spare. Recordings of one stream are always handled by the same worker.
+
+ANALYSIS_WORKERS=1
+
+## TFLITE_THREADS is the number of CPU threads each model interpreter may use.
+## Leave empty or 0 for the TensorFlow Lite default.
+## TFLITE_XNNPACK=0 disables the XNNPACK CPU delegate, which is not the fastest
+## option on every Pi. TFLITE_QUANTIZED_MODEL can name a (e.g. INT8) .tflite
+## file in the model directory to use instead of the selected MODEL; it is
+## only used when its input and classes match that model.
+## TFLITE_BENCHMARK=1 logs the invoke latency of every threads/XNNPACK
+## combination when birdnet_analysis.service starts, to help tune the above.
+
+TFLITE_THREADS=
+TFLITE_XNNPACK=1
+TFLITE_QUANTIZED_MODEL=
+TFLITE_BENCHMARK=0
+
+## EMBEDDINGS=1 also keeps the embedding vector of every analyzed chunk, in a
+## compact float16 store per model in EMBEDDINGS_DIR (default
+## ~/BirdSongs/Embeddings), so calls can be clustered and re-scored later
+## without the audio. About 2 kB per 3 second chunk for BirdNET.
+
+EMBEDDINGS=0
+EMBEDDINGS_DIR=
+
+## SCORES=1 keeps the 10 best logits of every analyzed chunk in SCORES_DIR
+## (default ~/BirdSongs/Scores), about 100 bytes per chunk. scripts/rescore.py
+## can then redo the detections of past days with another CONFIDENCE,
+## SENSITIVITY, SF_THRESH or PRIVACY_THRESHOLD, without the audio.
+
+SCORES=0
+SCORES_DIR=
+
+## ENSEMBLE_MODEL runs a second model (e.g. Perch_v2 next to
+## BirdNET_GLOBAL_6K_V2.4_Model_FP16) on the same recordings, from the same
+## decoded audio. Only MODEL is reported; the detections of both models, with
+## how confident the other model was about the same species at that time, are
+## appended to ~/BirdNET-Pi/BirdDB_ensemble.txt for comparison.
+
+ENSEMBLE_MODEL=
+
 ## RECORDING_LENGTH sets the length of the recording that BirdNET-Lite will
 ## analyze.
 
@@ -276,6 +324,19 @@ AUTOMATIC_UPDATE=0
 
 RAW_SPECTROGRAM=0
 
+## SPECTROGRAM_RENDERER draws the spectrograms of the detections. The default
+## (pil) writes the image straight from the spectrogram; matplotlib draws it as
+## a matplotlib figure, at several times the CPU.
+
+SPECTROGRAM_RENDERER=pil
+
+## SPECTROGRAM_WORKERS is the number of processes that draw the spectrograms,
+## after the detection is already in the database and notified. Those of new
+## recordings go before those of a backlog. 0 draws them in the reporting
+## thread, before the detection is stored.
+
+SPECTROGRAM_WORKERS=1
+
 ## CUSTOM_IMAGE and CUSTOM_IMAGE_TITLE allow you to show a custom image on the
 ## Overview page of your BirdNET-Pi. This can be used to show a dynamically 
 ## updating picture of your garden, for example.
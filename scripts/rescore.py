@@ -0,0 +1,44 @@
+import argparse
+import datetime
+import sys
+
+from utils.helpers import get_settings, get_model_labels
+from utils.models import get_meta_model
+from utils.reporting import summary
+from utils.scores import ScoreStore, get_score_store_path, rescore
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Redo the detections of a date range from the stored scores (SCORES=1), with other settings. '
+                    'Prints them like BirdDB.txt, nothing is written to the database.'
+    )
+    parser.add_argument('first', type=datetime.date.fromisoformat, help='First day, YYYY-MM-DD')
+    parser.add_argument('last', type=datetime.date.fromisoformat, nargs='?', help='Last day, defaults to the first')
+    parser.add_argument('--confidence', type=float, help='Minimum confidence. Defaults to CONFIDENCE.')
+    parser.add_argument('--sensitivity', type=float, help='Sigmoid sensitivity (BirdNET). Defaults to SENSITIVITY.')
+    parser.add_argument('--sf-thresh', type=float, help='Occurrence frequency threshold. Defaults to SF_THRESH.')
+    parser.add_argument('--privacy-threshold', type=float, help='Defaults to PRIVACY_THRESHOLD.')
+    parser.add_argument('--model', help='Scores of which model. Defaults to MODEL.')
+    args = parser.parse_args()
+
+    conf = get_settings()
+    for key, value in [('CONFIDENCE', args.confidence), ('SENSITIVITY', args.sensitivity), ('SF_THRESH', args.sf_thresh),
+                       ('PRIVACY_THRESHOLD', args.privacy_threshold), ('MODEL', args.model)]:
+        if value is not None:
+            conf[key] = str(value)
+
+    model = conf['MODEL']
+    store = ScoreStore(get_score_store_path(model, conf))
+    labels = get_model_labels(model)
+    meta_model = get_meta_model(model)
+
+    count = 0
+    day = args.first
+    while day <= (args.last or args.first):
+        for file_date, stream, detections in rescore(store.read(day), model, labels, conf.getfloat('SENSITIVITY'), meta_model):
+            for detection in detections:
+                print(summary(None, detection))
+                count += 1
+        day += datetime.timedelta(days=1)
+
+    print(f'{count} detections', file=sys.stderr)
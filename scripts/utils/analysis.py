@@ -1,22 +1,38 @@
 import logging
+import math
 import os
 import time
 import inspect
+from collections import Counter
 from functools import lru_cache
 
 import numpy as np
-import librosa
-from scipy.signal import butter, sosfilt
+import soundfile
+from numpy.lib.stride_tricks import sliding_window_view
 
 from .classes import Detection, ParseFileName
-from .helpers import get_settings, get_language
-from .models import get_model
+from .embeddings import get_embedding_store, get_stream
+from .scores import get_score_store
+from .helpers import get_settings, get_cached_language, get_custom_species_list
+from .models import get_model, Prediction
+from .reporting import write_ensemble_file
 
 log = logging.getLogger(__name__)
 
 MODEL = None
+ENSEMBLE = None
+# the ENSEMBLE_MODEL that could not be loaded, so it is only reported once
+_ensemble_failed = None
 HIGHPASS_FILTER_ORDER = 4
 _HIGH_PASS_CACHE_SIZE = 32
+_RESAMPLE_CACHE_SIZE = 8
+_CLASS_FILTER_CACHE_SIZE = 64
+
+# why a label is left out of the detections, 0 means it is kept
+FILTER_REASONS = [None, 'not in INCLUDE_LIST', 'in EXCLUDE_LIST', 'below Species Occurrence Frequency Threshold']
+_class_filters = {}
+# (reason, species) -> number of confident predictions filtered out since start
+filter_stats = Counter()
 
 
 @lru_cache(maxsize=128)
@@ -48,51 +64,85 @@ def _get_numeric_setting(conf, key, default=0.0):
 
 @lru_cache(maxsize=_HIGH_PASS_CACHE_SIZE)
 def _get_highpass_sos(order, cutoff_hz, rate):
+    from scipy.signal import butter
     return butter(order, cutoff_hz, btype='highpass', fs=rate, output='sos')
 
 
 def apply_highpass_filter(sig, rate, cutoff_hz):
     if cutoff_hz <= 0 or cutoff_hz > rate / 2:
         return sig
+    from scipy.signal import sosfilt
     sos = _get_highpass_sos(HIGHPASS_FILTER_ORDER, cutoff_hz, rate)
     return sosfilt(sos, sig)
 
 
-def loadCustomSpeciesList(path):
-    species_list = []
-    if os.path.isfile(path):
-        with open(path, 'r') as csfile:
-            species_list = [line.strip().split('_')[0] for line in csfile.readlines()]
+@lru_cache(maxsize=_RESAMPLE_CACHE_SIZE)
+def _get_resample_filter(up, down):
+    # Same low-pass FIR that resample_poly designs on every call, designed once per rate pair
+    from scipy.signal import firwin
+    max_rate = max(up, down)
+    return firwin(2 * 10 * max_rate + 1, 1. / max_rate, window=('kaiser', 5.0)).astype('float32')
 
-    return species_list
 
+def resample(sig, rate, sample_rate):
+    if rate == sample_rate:
+        return sig
+    # scipy.signal is slow to import, only load it once a recording needs it
+    from scipy.signal import resample_poly
+    gcd = math.gcd(int(rate), int(sample_rate))
+    up, down = int(sample_rate) // gcd, int(rate) // gcd
+    return resample_poly(sig, up, down, window=_get_resample_filter(up, down)).astype('float32', copy=False)
 
-def splitSignal(sig, rate, overlap, seconds=3.0, minlen=1.5):
-    # Split signal with overlap
-    sig_splits = []
-    for i in range(0, len(sig), int((seconds - overlap) * rate)):
-        split = sig[i:i + int(seconds * rate)]
 
-        # End of signal?
-        if len(split) < int(minlen * rate):
-            break
+def decode_audio(path, sample_rate=None):
+    # sample_rate None keeps the rate of the file
+    try:
+        sig, rate = soundfile.read(path, dtype='float32')
+    except RuntimeError as e:
+        # Not a format libsndfile can read (e.g. mp3 on older releases): let librosa/audioread handle it
+        log.debug('Falling back to librosa for %s: %s', path, e)
+        import librosa
+        return librosa.load(path, sr=sample_rate, mono=True, res_type='kaiser_fast')
+
+    if sig.ndim > 1:
+        sig = np.mean(sig, axis=1, dtype='float32')
+
+    if sample_rate is None:
+        return sig, rate
+    return resample(sig, rate, sample_rate), sample_rate
+
+
+def loadCustomSpeciesList(path):
+    return get_custom_species_list(path)
+
+
+def splitSignal(sig, rate, overlap, seconds=3.0, minlen=1.5):
+    # Split signal with overlap into a read-only (chunks, samples) float32 view
+    chunk_len = int(seconds * rate)
+    step = int((seconds - overlap) * rate)
+    min_len = max(int(minlen * rate), 1)
+    if len(sig) < min_len:
+        return np.empty((0, chunk_len), dtype='float32')
 
-        # Signal chunk too short? Fill with zeros.
-        if len(split) < int(rate * seconds):
-            temp = np.zeros((int(rate * seconds)))
-            temp[:len(split)] = split
-            split = temp
+    # Windows start every step samples for as long as at least minlen of signal is left
+    n_chunks = (len(sig) - min_len) // step + 1
+    padded_len = (n_chunks - 1) * step + chunk_len
 
-        sig_splits.append(split)
+    # Signal chunk too short or not float32 yet? Copy once into a zero-padded buffer.
+    if padded_len > len(sig) or sig.dtype != np.float32:
+        buf = np.zeros(padded_len, dtype='float32')
+        n = min(len(sig), padded_len)
+        buf[:n] = sig[:n]
+        sig = buf
 
-    return sig_splits
+    return sliding_window_view(sig[:padded_len], chunk_len)[::step]
 
 
 def readAudioData(path, overlap, sample_rate, chunk_duration, highpass_hz=0.0):
     log.info('READING AUDIO DATA...')
 
-    # Open file with librosa (uses ffmpeg or libav)
-    sig, rate = librosa.load(path, sr=sample_rate, mono=True, res_type='kaiser_fast')
+    # Read PCM straight into float32, resampling only when the file does not match the model
+    sig, rate = decode_audio(path, sample_rate)
 
     if highpass_hz > 0:
         sig = apply_highpass_filter(sig, rate, highpass_hz)
@@ -106,9 +156,22 @@ def readAudioData(path, overlap, sample_rate, chunk_duration, highpass_hz=0.0):
     return chunks
 
 
-def analyzeAudioData(chunks, overlap, lat, lon, week):
+def chunk_starts(n, chunk_duration, overlap):
+    starts = []
+    pred_start = 0.0
+    for _ in range(n):
+        starts.append(pred_start)
+        pred_end = pred_start + chunk_duration
+        pred_start = pred_end - overlap
+    return starts
+
+
+def analyzeAudioData(chunks, overlap, lat, lon, week, file=None, model=None):
     detections = []
-    model = load_global_model()
+    if model is None:
+        model = load_global_model()
+    embedding_store = get_embedding_store(model) if file is not None else None
+    score_store = get_score_store(model) if file is not None else None
 
     start = time.time()
     log.info('ANALYZING AUDIO...')
@@ -116,26 +179,42 @@ def analyzeAudioData(chunks, overlap, lat, lon, week):
     model.set_meta_data(lat, lon, week)
     predicted_species_list = model.get_species_list()
 
-    # Parse every chunk
-    for chunk in chunks:
-        p = model.predict(chunk)
+    # Run all chunks through the interpreter in one invoke
+    if embedding_store is not None:
+        logits, embeddings = model.predict_logits(chunks, embeddings=True)
+    else:
+        logits = model.predict_logits(chunks)
+    scores = model.scores(logits)
+    for chunk_scores in scores:
+        p = model.top_k(chunk_scores)
         log.debug("PPPPP: %s", p)
         detections.append(p)
+    human_ranks = model.human_ranks(scores)
+
+    starts = chunk_starts(len(scores), model.chunk_duration, overlap)
+    if embedding_store is not None:
+        embedding_store.append(file.file_date.timestamp() + np.array(starts), model.chunk_duration, embeddings, get_stream(file))
+    if score_store is not None and len(scores):
+        score_store.append(file.file_date, starts, model.chunk_duration, [p.indices for p in detections], logits,
+                           model.score_norm(logits), human_ranks, get_stream(file))
 
     labeled = {}
-    pred_start = 0.0
-    for p in filter_humans(detections):
+    for pred_start, p in zip(starts, filter_humans(detections, human_ranks)):
         # Save timestamp and result
         pred_end = pred_start + model.chunk_duration
         labeled[str(pred_start) + ';' + str(pred_end)] = p
 
-        pred_start = pred_end - overlap
-
     log.info('DONE! Time %.2f SECONDS', time.time() - start)
     return labeled, predicted_species_list
 
 
-def filter_humans(predictions):
+def _has_human(prediction, human_cutoff):
+    if isinstance(prediction, Prediction):
+        return prediction.has_human_within(human_cutoff)
+    return any('Human' in p[0] for p in prediction[:human_cutoff])
+
+
+def filter_humans(predictions, human_ranks=None):
     conf = get_settings()
     priv_thresh = conf.getfloat('PRIVACY_THRESHOLD')
     human_cutoff = max(10, int(6000 * priv_thresh / 100.0))
@@ -148,27 +227,22 @@ def filter_humans(predictions):
         pass
 
     # mask for humans
-    human_mask = [False] * len(predictions)
-    for i, prediction in enumerate(predictions):
-        for p in prediction[:human_cutoff]:
-            if 'Human' in p[0]:
-                human_mask[i] = True
-                break
-
-    # mask for predictions that have a human neighbour
-    human_neighbour_mask = [False] * len(predictions)
-    for i, _ in enumerate(human_mask):
-        if i != 0 and human_mask[i - 1]:
-            human_neighbour_mask[i] = True
-        if i != len(human_mask) - 1 and human_mask[i + 1]:
-            human_neighbour_mask[i] = True
+    if human_ranks is not None:
+        human_mask = np.asarray(human_ranks) < human_cutoff
+    else:
+        human_mask = np.array([_has_human(prediction, human_cutoff) for prediction in predictions], dtype=bool)
+
+    # also mask predictions that have a human neighbour
+    privacy_mask = human_mask.copy()
+    privacy_mask[1:] |= human_mask[:-1]
+    privacy_mask[:-1] |= human_mask[1:]
 
     clean_detections = []
-    for prediction, human, has_human_neighbour in zip(predictions, human_mask, human_neighbour_mask):
-        if human or has_human_neighbour:
+    for prediction, private in zip(predictions, privacy_mask):
+        if private:
             log.debug('Overwriting prediction %s', prediction[0])
             prediction = [('Human_Human', 0.0)]
-        else:
+        elif not isinstance(prediction, Prediction) or len(prediction) > 10:
             prediction = prediction[:10]
         clean_detections.append(prediction)
 
@@ -185,49 +259,146 @@ def load_global_model():
     return MODEL
 
 
-def run_analysis(file):
-    include_list = loadCustomSpeciesList(os.path.expanduser("~/BirdNET-Pi/include_species_list.txt"))
-    exclude_list = loadCustomSpeciesList(os.path.expanduser("~/BirdNET-Pi/exclude_species_list.txt"))
-    whitelist_list = loadCustomSpeciesList(os.path.expanduser("~/BirdNET-Pi/whitelist_species_list.txt"))
+def load_ensemble_model():
+    """The second model of ENSEMBLE_MODEL, run next to MODEL on the same recordings, or None."""
+    global ENSEMBLE, _ensemble_failed
+    conf = get_settings()
+    model = conf.get('ENSEMBLE_MODEL', '')
+    if not model or model == conf['MODEL'] or model == _ensemble_failed:
+        return None
+    if ENSEMBLE is None:
+        log.info('LOADING ENSEMBLE MODEL %s...', model)
+        try:
+            ENSEMBLE = get_model(model)
+        except Exception as e:
+            log.exception('Cannot load ENSEMBLE_MODEL %s', model, exc_info=e)
+            _ensemble_failed = model
+            return None
+        if ENSEMBLE is None:
+            log.error('Unknown ENSEMBLE_MODEL %s', model)
+            _ensemble_failed = model
+            return None
+        log.info('LOADING DONE!')
+    return ENSEMBLE
 
+
+def load_audio(file):
+    """Chunks of file for the model, or a list of [model chunks, ensemble model chunks] in ensemble mode."""
     conf = get_settings()
     model = load_global_model()
-    names = get_language(conf['DATABASE_LANG'])
     highpass_hz = _get_numeric_setting(conf, 'HIGHPASS_HZ', 0.0)
+    ensemble = load_ensemble_model()
+    if ensemble is None:
+        return readAudioData(file.file_name, conf.getfloat('OVERLAP'), model.sample_rate, model.chunk_duration, highpass_hz)
 
-    # Read audio data & handle errors
-    try:
-        audio_data = readAudioData(file.file_name, conf.getfloat('OVERLAP'), model.sample_rate, model.chunk_duration, highpass_hz)
-    except (NameError, TypeError) as e:
-        log.error("Error with the following info: %s", e)
-        return []
+    # one decode and high-pass at the rate of the file, then each model resamples from it once, if it needs to
+    log.info('READING AUDIO DATA...')
+    sig, rate = decode_audio(file.file_name)
+    if highpass_hz > 0:
+        sig = apply_highpass_filter(sig, rate, highpass_hz)
+    chunks = [splitSignal(resample(sig, rate, m.sample_rate), m.sample_rate, conf.getfloat('OVERLAP'), seconds=m.chunk_duration)
+              for m in (model, ensemble)]
+    log.info('READING DONE! READ %s CHUNKS.', ' + '.join(str(len(c)) for c in chunks))
+    return chunks
+
+
+def run_analysis(file, audio_data=None):
+    conf = get_settings()
+
+    # Read audio data & handle errors, unless it was already decoded ahead of time
+    if audio_data is None:
+        try:
+            audio_data = load_audio(file)
+        except (NameError, TypeError) as e:
+            log.error("Error with the following info: %s", e)
+            return []
+
+    ensemble_chunks = None
+    if isinstance(audio_data, list):
+        audio_data, ensemble_chunks = audio_data
 
     # Process audio data and get detections
     raw_detections, predicted_species_list = analyzeAudioData(audio_data, conf.getfloat('OVERLAP'), conf.getfloat('LATITUDE'),
-                                                              conf.getfloat('LONGITUDE'), file.week)
+                                                              conf.getfloat('LONGITUDE'), file.week, file)
+    detections = get_detections(file.file_date, raw_detections, predicted_species_list)
+
+    ensemble = load_ensemble_model() if ensemble_chunks is not None else None
+    if ensemble is not None:
+        # the ensemble model is only recorded next to the detections, what is reported stays the one of MODEL
+        try:
+            raw_detections, predicted_species_list = analyzeAudioData(ensemble_chunks, conf.getfloat('OVERLAP'), conf.getfloat('LATITUDE'),
+                                                                      conf.getfloat('LONGITUDE'), file.week, file, ensemble)
+            write_ensemble_file(file, {load_global_model().model_name: detections,
+                                       ensemble.model_name: get_detections(file.file_date, raw_detections, predicted_species_list)})
+        except Exception as e:
+            log.exception('Ensemble analysis of %s failed', file.file_name, exc_info=e)
+    return detections
+
+
+def _filter_reason(sci_name, predicted_species_list, include_list, exclude_list, whitelist_list):
+    if sci_name not in include_list and len(include_list) != 0:
+        return 1
+    elif sci_name in exclude_list and len(exclude_list) != 0:
+        return 2
+    elif sci_name not in predicted_species_list and len(predicted_species_list) != 0 and sci_name not in whitelist_list:
+        return 3
+    return 0
+
+
+def get_class_filter(labels, predicted_species_list, include_list, exclude_list, whitelist_list):
+    """FILTER_REASONS index per label for this week's species and the current lists, computed once per combination."""
+    lists = tuple(frozenset(species) for species in (predicted_species_list, include_list, exclude_list, whitelist_list))
+    key = (id(labels), len(labels)) + lists
+    cached = _class_filters.get(key)
+    if cached is None or cached[0] is not labels:
+        if len(_class_filters) >= _CLASS_FILTER_CACHE_SIZE:
+            _class_filters.clear()
+        reasons = np.array([_filter_reason(label, *lists) for label in labels], dtype='uint8')
+        cached = _class_filters[key] = (labels, reasons)
+    return cached[1]
+
+
+def get_detections(file_date, raw_detections, predicted_species_list):
+    include_list = loadCustomSpeciesList(os.path.expanduser("~/BirdNET-Pi/include_species_list.txt"))
+    exclude_list = loadCustomSpeciesList(os.path.expanduser("~/BirdNET-Pi/exclude_species_list.txt"))
+    whitelist_list = loadCustomSpeciesList(os.path.expanduser("~/BirdNET-Pi/whitelist_species_list.txt"))
+
+    conf = get_settings()
+    names = get_cached_language(conf['DATABASE_LANG'])
+    min_confidence = conf.getfloat('CONFIDENCE')
+
+    filtered = Counter()
     confident_detections = []
     for time_slot, entries in raw_detections.items():
         sci_name, confidence = entries[0]
         log.info('%s-(%s_%s, %s)', time_slot, sci_name, names.get(sci_name, sci_name), confidence)
-        for sci_name, confidence in entries:
-            if confidence >= conf.getfloat('CONFIDENCE'):
-                com_name = names.get(sci_name, sci_name)
-                if sci_name not in include_list and len(include_list) != 0:
-                    log.warning("Excluded as INCLUDE_LIST is active but this species is not in it: %s %s", sci_name, com_name)
-                elif sci_name in exclude_list and len(exclude_list) != 0:
-                    log.warning("Excluded as species in EXCLUDE_LIST: %s %s", sci_name, com_name)
-                elif sci_name not in predicted_species_list and len(predicted_species_list) != 0 and sci_name not in whitelist_list:
-                    log.warning("Excluded as below Species Occurrence Frequency Threshold: %s %s", sci_name, com_name)
-                else:
-                    d = Detection(
-                        file.file_date,
-                        time_slot.split(';')[0],
-                        time_slot.split(';')[1],
-                        sci_name,
-                        com_name,
-                        confidence,
-                    )
-                    confident_detections.append(d)
+        if isinstance(entries, Prediction):
+            # only the confident classes of the top k are looked at, their filter reason is a lookup by label index
+            reasons = get_class_filter(entries.labels, predicted_species_list, include_list, exclude_list, whitelist_list)
+            confident = entries.scores.astype('float64') >= min_confidence
+            candidates = [(entries.labels[i], score, reasons[i]) for i, score in zip(entries.indices[confident], entries.scores[confident])]
+        else:
+            candidates = [(sci_name, confidence, _filter_reason(sci_name, predicted_species_list, include_list, exclude_list, whitelist_list))
+                          for sci_name, confidence in entries if confidence >= min_confidence]
+
+        for sci_name, confidence, reason in candidates:
+            if reason:
+                filtered[(FILTER_REASONS[reason], sci_name)] += 1
+                continue
+            d = Detection(
+                file_date,
+                time_slot.split(';')[0],
+                time_slot.split(';')[1],
+                sci_name,
+                names.get(sci_name, sci_name),
+                confidence,
+            )
+            confident_detections.append(d)
+
+    if filtered:
+        filter_stats.update(filtered)
+        log.debug('Excluded %d predictions: %s', sum(filtered.values()),
+                  ', '.join(f'{sci_name} ({reason}) x{count}' for (reason, sci_name), count in filtered.items()))
     return confident_detections
 
 
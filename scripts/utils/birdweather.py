@@ -0,0 +1,264 @@
+import glob
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+import soundfile
+
+from .classes import Detection, ParseFileName
+from .helpers import get_settings
+
+log = logging.getLogger(__name__)
+
+_UPLOADER = None
+BIRDWEATHER_URL = 'https://app.birdweather.com/api/v1/stations'
+# sustained requests per second, and how many may go out at once after a quiet spell
+RATE = 1.0
+BURST = 5
+# seconds to wait after a failed request, doubled on each failure in a row
+BACKOFF = 5.0
+MAX_BACKOFF = 600.0
+# what an offline station keeps for later, the oldest jobs are dropped beyond it: about 2 days of 30 s recordings
+MAX_JOBS = 5000
+MAX_BYTES = 2 * 1024 ** 3
+
+
+class RateLimiter:
+    """Token bucket: rate tokens per second, at most burst of them saved up."""
+
+    def __init__(self, rate=RATE, burst=BURST, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = float(burst)
+        self.updated = clock()
+
+    def delay(self):
+        """Takes a token, returns the seconds to wait before it may be used."""
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+def _size(path):
+    # the uploader thread may have removed it in the meantime
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+class Retry(Exception):
+    pass
+
+
+class BirdWeatherUploader:
+    """Posts soundscapes and their detections to BirdWeather from a thread of its own.
+
+    submit() only spools the recording and the detections: a JSON job file next to a link or copy of the WAV. The
+    thread encodes the FLAC, posts the soundscape and then its detections over one requests.Session, and updates the
+    job after each step. Network errors, 429 and 5xx keep the job in the spool, to be retried with exponential backoff,
+    also after a restart. Anything else BirdWeather turns down is logged and dropped, as before.
+    """
+
+    def __init__(self, spool, url=BIRDWEATHER_URL, limiter=None, backoff=BACKOFF, max_backoff=MAX_BACKOFF, max_jobs=MAX_JOBS,
+                 max_bytes=MAX_BYTES):
+        self.spool = spool
+        self.max_jobs = max_jobs
+        self.max_bytes = max_bytes
+        self.current = None
+        self.url = url
+        self.limiter = RateLimiter() if limiter is None else limiter
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failures = 0
+        self.session = None
+        self.stop = threading.Event()
+        self.wake = threading.Event()
+        self.thread = None
+        os.makedirs(spool, exist_ok=True)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='birdweather', daemon=True)
+        self.thread.start()
+        return self
+
+    def submit(self, file: ParseFileName, detections: [Detection], conf=None):
+        conf = get_settings() if conf is None else conf
+        self.trim(os.path.getsize(file.file_name))
+        job_id = f'{time.time_ns()}-{os.path.splitext(os.path.basename(file.file_name))[0]}'
+        audio = f'{job_id}.wav'
+        try:
+            # the recording is removed once it is reported
+            os.link(file.file_name, os.path.join(self.spool, audio))
+        except OSError:
+            shutil.copyfile(file.file_name, os.path.join(self.spool, audio))
+        algorithm = '2p4' if conf['MODEL'] == 'BirdNET_GLOBAL_6K_V2.4_Model_FP16' else 'alpha'
+        job = {'station': conf['BIRDWEATHER_ID'], 'timestamp': file.iso8601, 'audio': audio, 'soundscape_id': None,
+               'detections': [{'timestamp': detection.iso8601, 'lat': conf['LATITUDE'], 'lon': conf['LONGITUDE'],
+                               'soundscapeStartTime': detection.start, 'soundscapeEndTime': detection.stop,
+                               'commonName': detection.common_name, 'scientificName': detection.scientific_name,
+                               'algorithm': algorithm, 'confidence': detection.confidence} for detection in detections]}
+        try:
+            self._save(os.path.join(self.spool, f'{job_id}.json'), job)
+        except OSError:
+            # no audio without its job
+            self._remove_audio(audio)
+            raise
+        self.wake.set()
+
+    def pending(self):
+        return sorted(glob.glob(os.path.join(self.spool, '*.json')))
+
+    def _job_size(self, job_file):
+        try:
+            with open(job_file) as f:
+                audio = os.path.join(self.spool, json.load(f)['audio'])
+            return _size(job_file) + _size(audio)
+        except (OSError, ValueError, KeyError):
+            return _size(job_file)
+
+    def trim(self, new_bytes=0):
+        """Drop the oldest jobs, but the one being uploaded, until there is room for one more of new_bytes."""
+        jobs = [job_file for job_file in self.pending() if job_file != self.current]
+        total = sum(_size(path) for path in glob.glob(os.path.join(self.spool, '*')))
+        dropped = 0
+        while jobs and (len(jobs) >= self.max_jobs or total + new_bytes > self.max_bytes):
+            total -= self._job_size(jobs[0])
+            self._remove_job(jobs.pop(0))
+            dropped += 1
+        if dropped:
+            log.warning('BirdWeather spool full, dropped the %d oldest uploads', dropped)
+
+    def run(self):
+        while not self.stop.is_set():
+            jobs = self.pending()
+            if not jobs:
+                self.wake.wait()
+                self.wake.clear()
+                continue
+            for job_file in jobs:
+                if not os.path.exists(job_file):
+                    # dropped by trim() since pending()
+                    continue
+                self.current = job_file
+                try:
+                    self.upload(job_file)
+                    self.failures = 0
+                except Retry as e:
+                    if self.stop.is_set():
+                        break
+                    self.failures += 1
+                    delay = min(self.max_backoff, self.backoff * 2 ** (self.failures - 1))
+                    log.warning('BirdWeather upload failed, retrying in %.0f s: %s', delay, e)
+                    self.stop.wait(delay)
+                    break
+                except FileNotFoundError:
+                    if os.path.exists(job_file):
+                        log.exception('BirdWeather upload of %s dropped', job_file)
+                        self._remove_job(job_file)
+                    # else trimmed before it was taken up
+                except Exception as e:
+                    log.exception('BirdWeather upload of %s dropped', job_file, exc_info=e)
+                    self._remove_job(job_file)
+                if self.stop.is_set():
+                    break
+
+    def upload(self, job_file):
+        with open(job_file) as f:
+            job = json.load(f)
+        url = f'{self.url}/{job["station"]}'
+        if job['soundscape_id'] is None:
+            sdata = self.post(f'{url}/soundscapes?timestamp={job["timestamp"]}', data=self.flac(job_file, job),
+                              headers={'Content-Type': 'audio/flac'}, timeout=30)
+            if not sdata.get('success'):
+                log.error(sdata.get('message'))
+                self._remove_job(job_file)
+                return
+            job['soundscape_id'] = sdata['soundscape']['id']
+            self._save(job_file, job)
+            self._remove_audio(job['audio'])
+
+        while job['detections']:
+            data = dict(job['detections'][0], soundscapeId=job['soundscape_id'])
+            log.debug(data)
+            self.post(f'{url}/detections', json=data, timeout=20)
+            job['detections'].pop(0)
+            self._save(job_file, job)
+        self._remove_job(job_file)
+
+    def flac(self, job_file, job):
+        # encoded once, a retry posts the spooled FLAC
+        if job['audio'].endswith('.wav'):
+            wav = os.path.join(self.spool, job['audio'])
+            data, samplerate = soundfile.read(wav)
+            job['audio'] = f'{os.path.splitext(job["audio"])[0]}.flac'
+            soundfile.write(os.path.join(self.spool, job['audio']), data, samplerate, format='FLAC')
+            self._save(job_file, job)
+            os.remove(wav)
+        with open(os.path.join(self.spool, job['audio']), 'rb') as f:
+            return f.read()
+
+    def post(self, url, **kwargs):
+        import requests
+        if self.session is None:
+            self.session = requests.Session()
+        if self.stop.wait(self.limiter.delay()):
+            raise Retry('stopping')
+        try:
+            response = self.session.post(url, **kwargs)
+        except requests.RequestException as e:
+            raise Retry(e) from e
+        log.info('%s POST Response Status - %d', 'Soundscape' if 'data' in kwargs else 'Detection', response.status_code)
+        if response.status_code == 429 or response.status_code >= 500:
+            raise Retry(f'HTTP {response.status_code}')
+        try:
+            return response.json()
+        except ValueError:
+            return {}
+
+    def _save(self, job_file, job):
+        with open(f'{job_file}.tmp', 'w') as f:
+            json.dump(job, f)
+        os.replace(f'{job_file}.tmp', job_file)
+
+    def _remove_audio(self, audio):
+        if os.path.exists(os.path.join(self.spool, audio)):
+            os.remove(os.path.join(self.spool, audio))
+
+    def _remove_job(self, job_file):
+        try:
+            with open(job_file) as f:
+                self._remove_audio(json.load(f)['audio'])
+            os.remove(job_file)
+        except (OSError, ValueError, KeyError):
+            if os.path.exists(job_file):
+                os.remove(job_file)
+
+    def close(self):
+        # what is still spooled goes out after the next start
+        self.stop.set()
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.session is not None:
+            self.session.close()
+
+
+def get_uploader():
+    global _UPLOADER
+    if _UPLOADER is None:
+        _UPLOADER = BirdWeatherUploader(os.path.join(get_settings()['RECS_DIR'], 'BirdWeather')).start()
+    return _UPLOADER
+
+
+def close_uploader():
+    global _UPLOADER
+    if _UPLOADER is not None:
+        _UPLOADER.close()
+        _UPLOADER = None
@@ -1,10 +1,24 @@
+import json
+import logging
+import os
 import sqlite3
+import threading
 import time as timeim
-from datetime import datetime
+from collections import Counter
+from datetime import datetime, timedelta
 
 from .helpers import DB_PATH
 
+log = logging.getLogger(__name__)
+
 _DB = None
+_WRITER = None
+_COUNTS = None
+# rows that could not be inserted, one JSON list per line, until the next write gets them in
+DB_SPOOL = os.path.expanduser('~/BirdNET-Pi/BirdDB_spool.txt')
+# how long a write waits for the readers of the web pages before it is spooled
+BUSY_TIMEOUT_MS = 10000
+INSERT_DETECTION = "INSERT INTO detections VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
 
 
 def get_db():
@@ -16,6 +30,182 @@ def get_db():
     return _DB
 
 
+class DetectionWriter:
+    """One connection, in WAL mode, that inserts the detections of a recording in a single transaction.
+
+    When the insert fails, e.g. because the database stays locked past BUSY_TIMEOUT_MS, the rows are appended to the
+    spool file and go in with the next batch, in the same transaction. Rows the database refuses are logged; spooled
+    rows it refuses are moved to the .rejected file next to the spool, so they no longer hold up the new ones.
+    """
+
+    def __init__(self, db_path=None, spool=None, busy_timeout=BUSY_TIMEOUT_MS):
+        self.db_path = db_path
+        self.spool = DB_SPOOL if spool is None else spool
+        self.busy_timeout = busy_timeout
+        self.con = None
+        self.lock = threading.Lock()
+        self.stats = {'batches': 0, 'rows': 0, 'spooled': 0, 'recovered': 0, 'failures': 0,
+                      'last_ms': 0.0, 'max_ms': 0.0, 'total_ms': 0.0}
+
+    def connect(self):
+        if self.con is None:
+            con = sqlite3.connect(self.db_path or DB_PATH, timeout=self.busy_timeout / 1000, check_same_thread=False)
+            con.execute(f'PRAGMA busy_timeout = {int(self.busy_timeout)}')
+            # readers of the pages no longer block the inserts, and a commit no longer rewrites the rollback journal
+            con.execute('PRAGMA journal_mode = WAL')
+            self.con = con
+        return self.con
+
+    def spooled_rows(self):
+        try:
+            with open(self.spool) as f:
+                return [tuple(json.loads(line)) for line in f if line.strip()]
+        except FileNotFoundError:
+            return []
+
+    def write(self, rows):
+        """Insert rows, and the spooled ones before them. Returns False when they were spooled instead."""
+        with self.lock:
+            rows = list(rows)
+            spooled = self.spooled_rows()
+            while True:
+                start = timeim.perf_counter()
+                try:
+                    con = self.connect()
+                    with con:
+                        con.executemany(INSERT_DETECTION, spooled + rows)
+                    break
+                except sqlite3.OperationalError as e:
+                    # locked, busy or an I/O error: worth another try
+                    self.close_connection()
+                    self.stats['failures'] += 1
+                    log.warning('Database write failed, spooling %d detections: %s', len(rows), e)
+                    self._spool(rows)
+                    return False
+                except sqlite3.Error as e:
+                    self.stats['failures'] += 1
+                    if not spooled:
+                        # the rows themselves are refused, spooling them would block every later batch
+                        log.error('Database refused %d detections: %s %s', len(rows), e, rows)
+                        return False
+                    # a spooled row may be the one refused: set them aside and try the new rows on their own
+                    log.error('Database refused %d spooled detections, moved to %s: %s', len(spooled), self.rejected, e)
+                    self._reject_spool()
+                    spooled = []
+            elapsed = (timeim.perf_counter() - start) * 1000
+            log.debug('Inserted %d detections in %.1f ms', len(rows) + len(spooled), elapsed)
+            if _COUNTS is not None:
+                _COUNTS.add(spooled + rows)
+            if spooled:
+                os.remove(self.spool)
+                log.info('Recovered %d spooled detections', len(spooled))
+            self.stats['batches'] += 1
+            self.stats['rows'] += len(rows) + len(spooled)
+            self.stats['recovered'] += len(spooled)
+            self.stats['last_ms'] = elapsed
+            self.stats['max_ms'] = max(self.stats['max_ms'], elapsed)
+            self.stats['total_ms'] += elapsed
+            return True
+
+    @property
+    def rejected(self):
+        return f'{self.spool}.rejected'
+
+    def _reject_spool(self):
+        # appended, kept for a look by hand
+        with open(self.spool) as src, open(self.rejected, 'a') as dst:
+            dst.write(src.read())
+        os.remove(self.spool)
+
+    def _spool(self, rows):
+        os.makedirs(os.path.dirname(os.path.abspath(self.spool)), exist_ok=True)
+        with open(self.spool, 'a') as f:
+            for row in rows:
+                f.write(json.dumps(row) + '\n')
+        self.stats['spooled'] += len(rows)
+
+    def summary(self):
+        batches = self.stats['batches']
+        mean = self.stats['total_ms'] / batches if batches else 0.0
+        return (f"{self.stats['rows']} rows in {batches} transactions, {mean:.1f} ms mean, {self.stats['max_ms']:.1f} ms max, "
+                f"{self.stats['spooled']} spooled, {self.stats['recovered']} recovered")
+
+    def close_connection(self):
+        if self.con is not None:
+            self.con.close()
+            self.con = None
+
+    def close(self):
+        with self.lock:
+            self.close_connection()
+        log.info('database writes: %s', self.summary())
+
+
+def get_db_writer():
+    global _WRITER
+    if _WRITER is None:
+        _WRITER = DetectionWriter()
+    return _WRITER
+
+
+class SpeciesCounts:
+    """Detections per species for each of the last 8 days, for the notification rules.
+
+    Counted once from the database, then kept up by the DetectionWriter as it commits. At the first lookup of a new day
+    they are counted again, which also picks up the detections deleted from the pages.
+    """
+
+    def __init__(self, now=datetime.now):
+        self.now = now
+        self.day = None
+        self.days = {}
+        self.lock = threading.Lock()
+
+    def _refresh(self):
+        now = self.now()
+        today = now.strftime("%Y-%m-%d")
+        if today == self.day:
+            return
+        first_day = (now - timedelta(days=7)).strftime("%Y-%m-%d")
+        try:
+            records = get_db().execute("SELECT Date, Sci_Name, COUNT(*) FROM detections WHERE Date >= ? GROUP BY Date, Sci_Name",
+                                       (first_day,)).fetchall()
+        except sqlite3.Error as e:
+            # counted at the next lookup
+            log.warning('Cannot count detections: %s', e)
+            self.day, self.days = None, {}
+            return
+        self.day, self.first_day, self.days = today, first_day, {}
+        for record in records:
+            self.days.setdefault(record[0], Counter())[record[1]] = record[2]
+
+    def add(self, rows):
+        # rows as inserted: Date, Time, Sci_Name, ...
+        with self.lock:
+            if self.day is None:
+                return
+            for row in rows:
+                if row[0] >= self.first_day:
+                    self.days.setdefault(row[0], Counter())[row[2]] += 1
+
+    def today(self, sci_name):
+        with self.lock:
+            self._refresh()
+            return self.days[self.day][sci_name] if self.day in self.days else 0
+
+    def this_week(self, sci_name):
+        with self.lock:
+            self._refresh()
+            return sum(counts[sci_name] for counts in self.days.values())
+
+
+def get_species_counts():
+    global _COUNTS
+    if _COUNTS is None:
+        _COUNTS = SpeciesCounts()
+    return _COUNTS
+
+
 def get_records(select_sql):
     con = get_db()
     try:
@@ -39,17 +229,11 @@ def get_latest():
 
 
 def get_todays_count_for(sci_name):
-    today = datetime.now().strftime("%Y-%m-%d")
-    select_sql = f"SELECT COUNT(*) FROM detections WHERE Date = DATE('{today}') AND Sci_Name = '{sci_name}'"
-    records = get_records(select_sql)
-    return records[0][0] if records else 0
+    return get_species_counts().today(sci_name)
 
 
 def get_this_weeks_count_for(sci_name):
-    today = datetime.now().strftime("%Y-%m-%d")
-    select_sql = f"SELECT COUNT(*) FROM detections WHERE Date >= DATE('{today}', '-7 day') AND Sci_Name = '{sci_name}'"
-    records = get_records(select_sql)
-    return records[0][0] if records else 0
+    return get_species_counts().this_week(sci_name)
 
 
 def get_summary():
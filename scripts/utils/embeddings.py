@@ -0,0 +1,110 @@
+import datetime
+import fcntl
+import json
+import logging
+import os
+
+import numpy as np
+
+from .helpers import get_settings
+
+log = logging.getLogger(__name__)
+
+INDEX_DTYPE = np.dtype([('timestamp', '<f8'), ('duration', '<f4'), ('stream', '<i4')])
+
+_stores = {}
+
+
+class EmbeddingStore:
+    """Append-only float16 embedding vectors, one row per analyzed chunk, in a directory per model.
+
+    vectors.f16 holds the rows back to back, index.bin the chunk start (epoch seconds), length and RTSP stream
+    of every row. Both are memory mapped for reading, so large stores are not loaded into memory.
+    """
+
+    def __init__(self, path, model_name, size):
+        self.path = path
+        self.size = size
+        self._vectors_file = os.path.join(path, 'vectors.f16')
+        self._index_file = os.path.join(path, 'index.bin')
+        os.makedirs(path, exist_ok=True)
+
+        meta_file = os.path.join(path, 'meta.json')
+        meta = {'model': model_name, 'size': size, 'dtype': 'float16'}
+        if os.path.exists(meta_file):
+            with open(meta_file) as f:
+                existing = json.load(f)
+            if existing != meta:
+                raise ValueError(f'{path} holds embeddings of {existing}, not {meta}')
+        else:
+            with open(meta_file, 'w') as f:
+                json.dump(meta, f)
+
+    def append(self, timestamps, duration, embeddings, stream=0):
+        embeddings = np.asarray(embeddings, dtype='float16').reshape(-1, self.size)
+        index = np.zeros(len(embeddings), dtype=INDEX_DTYPE)
+        index['timestamp'] = timestamps
+        index['duration'] = duration
+        index['stream'] = stream
+        # the index file is the lock: several analysis workers may append to the same store
+        with open(self._index_file, 'ab') as index_file:
+            fcntl.flock(index_file, fcntl.LOCK_EX)
+            rows = len(self)
+            index_file.truncate(rows * INDEX_DTYPE.itemsize)
+            with open(self._vectors_file, 'r+b' if os.path.exists(self._vectors_file) else 'wb') as vectors_file:
+                # drop vectors of an append that was interrupted before its index was written
+                vectors_file.truncate(rows * self.size * 2)
+                vectors_file.seek(0, os.SEEK_END)
+                vectors_file.write(embeddings.tobytes())
+            index_file.write(index.tobytes())
+
+    def __len__(self):
+        try:
+            return os.path.getsize(self._index_file) // INDEX_DTYPE.itemsize
+        except OSError:
+            return 0
+
+    def index(self):
+        rows = len(self)
+        if rows == 0:
+            return np.zeros(0, dtype=INDEX_DTYPE)
+        return np.memmap(self._index_file, dtype=INDEX_DTYPE, mode='r', shape=(rows,))
+
+    def vectors(self):
+        rows = len(self)
+        if rows == 0:
+            return np.zeros((0, self.size), dtype='float16')
+        return np.memmap(self._vectors_file, dtype='float16', mode='r', shape=(rows, self.size))
+
+    def lookup(self, when, stream=0, tolerance=1.0):
+        """Row of the chunk of stream starting closest to the datetime (or epoch seconds) when, or None.
+
+        The default tolerance finds the chunk of a detection from the whole-second Date/Time of its DB row.
+        """
+        if isinstance(when, datetime.datetime):
+            when = when.timestamp()
+        index = self.index()
+        distance = np.where(index['stream'] == stream, np.abs(index['timestamp'] - when), np.inf)
+        if len(distance) == 0 or distance.min() >= tolerance:
+            return None
+        return int(np.argmin(distance))
+
+
+def get_embedding_store(model):
+    """The EmbeddingStore for model when EMBEDDINGS=1, otherwise None."""
+    conf = get_settings()
+    if str(conf.get('EMBEDDINGS', '0')) != '1':
+        return None
+    if model.model_name not in _stores:
+        if model.embedding_size is None:
+            log.warning('EMBEDDINGS is set, but %s has no embedding output', model.model_name)
+            _stores[model.model_name] = None
+        else:
+            base = conf.get('EMBEDDINGS_DIR', '') or os.path.expanduser('~/BirdSongs/Embeddings')
+            _stores[model.model_name] = EmbeddingStore(os.path.join(base, model.model_name), model.model_name, model.embedding_size)
+    return _stores[model.model_name]
+
+
+def get_stream(file):
+    # RTSP_2- -> 2, recordings of the local microphone are stream 0
+    return int(file.RTSP_id[5:-1]) if file.RTSP_id else 0
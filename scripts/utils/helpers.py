@@ -6,13 +6,16 @@ import subprocess
 from collections import OrderedDict
 from configparser import ConfigParser
 from itertools import chain
+from types import MappingProxyType
 
 _settings = None
+_assets = {}
 
 BASE_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
 DB_PATH = os.path.join(BASE_PATH, 'scripts/birds.db')
 MODEL_PATH = os.path.join(BASE_PATH, 'model')
 FONT_DIR = os.path.join(BASE_PATH, 'homepage/static')
+CACHE_DIR = os.path.expanduser('~/.cache/birdnet')
 ANALYZING_NOW = os.path.expanduser('~/BirdSongs/StreamData/analyzing_now.txt')
 
 
@@ -82,13 +85,61 @@ def get_wav_files():
     return files
 
 
+def get_asset(path, loader):
+    # parsed assets are shared between calls and only re-read when the file changes on disk (e.g. from the web UI)
+    try:
+        stat = os.stat(path)
+        version = (stat.st_mtime_ns, stat.st_size)
+    except FileNotFoundError:
+        version = None
+    cached = _assets.get((path, loader))
+    if cached is None or cached[0] != version:
+        cached = (version, loader(path))
+        _assets[(path, loader)] = cached
+    return cached[1]
+
+
+def _read_json(file_name):
+    with open(file_name) as f:
+        return json.loads(f.read())
+
+
+def _read_language(file_name):
+    return MappingProxyType(_read_json(file_name))
+
+
+def _read_species_list(file_name):
+    if not os.path.isfile(file_name):
+        return frozenset()
+    with open(file_name) as f:
+        return frozenset(line.strip().split('_')[0] for line in f.readlines())
+
+
+def _read_model_labels(file_name):
+    with open(file_name) as f:
+        labels = [line.strip() for line in f.readlines()]
+    if labels and labels[0].count('_') == 1:
+        labels = [re.sub(r'_.+$', '', label) for label in labels]
+    return tuple(labels)
+
+
+def get_custom_species_list(path):
+    return get_asset(path, _read_species_list)
+
+
 def get_language(language=None):
     if language is None:
         language = get_settings()['DATABASE_LANG']
     file_name = os.path.join(MODEL_PATH, f'l18n/labels_{language}.json')
-    with open(file_name) as f:
-        ret = json.loads(f.read())
-    return ret
+    return _read_json(file_name)
+
+
+def get_cached_language(language=None):
+    # read-only view, use get_language() for a copy that can be modified
+    if language is None:
+        language = get_settings()['DATABASE_LANG']
+    file_name = os.path.join(MODEL_PATH, f'l18n/labels_{language}.json')
+    return get_asset(file_name, _read_language)
 
 
 def save_language(labels, language):
@@ -101,11 +152,7 @@ def get_model_labels(model=None):
     if model is None:
         model = get_settings()['MODEL']
     file_name = os.path.join(MODEL_PATH, f'{model}_Labels.txt')
-    with open(file_name) as f:
-        labels = [line.strip() for line in f.readlines()]
-    if labels and labels[0].count('_') == 1:
-        labels = [re.sub(r'_.+$', '', label) for label in labels]
-    return labels
+    return list(get_asset(file_name, _read_model_labels))
 
 
 def set_label_file():
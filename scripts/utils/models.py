@@ -2,10 +2,11 @@ import logging
 import math
 import operator
 import os
+import time
 
 import numpy as np
 
-from .helpers import get_settings, get_model_labels, MODEL_PATH
+from .helpers import get_settings, get_model_labels, CACHE_DIR, MODEL_PATH
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 os.environ['CUDA_VISIBLE_DEVICES'] = ''
@@ -13,8 +14,10 @@ np.set_printoptions(legacy="1.21")
 
 try:
     import tflite_runtime.interpreter as tflite
+    OpResolverType = tflite.OpResolverType
 except ImportError:
     from tensorflow import lite as tflite
+    OpResolverType = tflite.experimental.OpResolverType
 
 log = logging.getLogger(__name__)
 
@@ -34,6 +37,63 @@ def get_model(model=None):
         return BirdNETGo20250916(conf.getfloat('SENSITIVITY'))
 
 
+def get_interpreter_options(conf=None):
+    if conf is None:
+        conf = get_settings()
+    try:
+        num_threads = int(conf.get('TFLITE_THREADS', 0) or 0)
+    except ValueError:
+        num_threads = 0
+    return {'num_threads': num_threads or None, 'xnnpack': str(conf.get('TFLITE_XNNPACK', '1')) != '0'}
+
+
+def make_interpreter(model_path, num_threads=None, xnnpack=True):
+    kwargs = {}
+    if num_threads:
+        kwargs['num_threads'] = num_threads
+    if not xnnpack:
+        kwargs['experimental_op_resolver_type'] = OpResolverType.BUILTIN_WITHOUT_DEFAULT_DELEGATES
+    return tflite.Interpreter(model_path, **kwargs)
+
+
+def benchmark_interpreter(model_path, batch_size=1, runs=5):
+    """Log the invoke latency of model_path for a range of thread counts, with and without XNNPACK."""
+    cpus = os.cpu_count() or 1
+    for num_threads in sorted({1, 2, 4, cpus}):
+        if num_threads > cpus:
+            continue
+        for xnnpack in (True, False):
+            try:
+                interpreter = make_interpreter(model_path, num_threads, xnnpack)
+                input_details = interpreter.get_input_details()
+                for detail in input_details:
+                    interpreter.resize_tensor_input(detail['index'], [batch_size] + list(detail['shape'][1:]))
+                interpreter.allocate_tensors()
+                for detail in interpreter.get_input_details():
+                    interpreter.set_tensor(detail['index'], np.zeros(detail['shape'], dtype=detail['dtype']))
+                interpreter.invoke()  # warm up
+
+                start = time.perf_counter()
+                for _ in range(runs):
+                    interpreter.invoke()
+                elapsed = (time.perf_counter() - start) / runs
+                log.info('BENCHMARK %s: threads=%d xnnpack=%s batch=%d: %.1f ms per invoke',
+                         os.path.basename(model_path), num_threads, xnnpack, batch_size, elapsed * 1000)
+            except (ValueError, RuntimeError) as e:
+                log.warning('BENCHMARK %s: threads=%d xnnpack=%s failed: %s', os.path.basename(model_path), num_threads, xnnpack, e)
+
+
+def sensitivity_slope(sens):
+    return max(0.5, min(1.0 - (sens - 1.0), 1.5))
+
+
+def scores_from_logits(model_name, logits, norm, sensitivity):
+    """Scores of (stored) logits of model_name, as its scores() gives them for the full output at this sensitivity."""
+    if model_name == Perch.model_name:
+        return np.exp(logits - np.asarray(norm)[..., np.newaxis])
+    return 1 / (1.0 + np.exp(-sensitivity_slope(sensitivity) * logits))
+
+
 def get_meta_model(model=None, version=None):
     conf = get_settings()
     if model is None:
@@ -50,6 +110,60 @@ def get_meta_model(model=None, version=None):
         return MDataModel2(conf.getfloat('SF_THRESH'))
 
 
+def rank_of_best(scores, indices):
+    """Rank (0-based, in label() order) of the best scoring class among indices, per row of scores."""
+    scores = np.atleast_2d(scores)
+    if len(indices) == 0:
+        return np.full(len(scores), scores.shape[1])
+    best = indices[np.argmax(scores[:, indices], axis=1)]
+    best_scores = scores[np.arange(len(scores)), best][:, np.newaxis]
+    above = np.count_nonzero(scores > best_scores, axis=1)
+    ties = np.count_nonzero((scores == best_scores) & (np.arange(scores.shape[1]) < best[:, np.newaxis]), axis=1)
+    return above + ties
+
+
+class Prediction:
+    """Top-k classes of one chunk, ordered like Basemodel.label() but without sorting every label."""
+
+    def __init__(self, scores, labels, k=10, human_indices=None):
+        k = min(k, len(scores))
+        # Everything above the k-th best score, plus the lowest-index ties, mirrors a stable descending sort
+        kth = np.partition(scores, len(scores) - k)[len(scores) - k] if k else np.inf
+        above = np.flatnonzero(scores > kth)
+        ties = np.flatnonzero(scores == kth)[:k - len(above)]
+        top = np.concatenate([above, ties])
+
+        self.indices = top[np.argsort(-scores[top], kind='stable')]
+        self.scores = scores[self.indices]
+        self.names = [labels[i] for i in self.indices]
+        self.labels = labels
+        self._all_scores = scores
+        self._human_indices = human_indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __iter__(self):
+        return iter(zip(self.names, self.scores))
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return list(zip(self.names[item], self.scores[item]))
+        return self.names[item], self.scores[item]
+
+    def __repr__(self):
+        return f'Prediction({list(self)})'
+
+    def rank_of_best(self, indices):
+        return int(rank_of_best(self._all_scores, indices)[0])
+
+    def any_ranked_within(self, indices, n):
+        return self.rank_of_best(indices) < n
+
+    def has_human_within(self, n):
+        return self.any_ranked_within(self._human_indices, n)
+
+
 class Basemodel:
     chunk_duration = None
     sample_rate = None
@@ -58,23 +172,138 @@ class Basemodel:
     _output_layer = 0
 
     def __init__(self):
-        model_path = os.path.join(MODEL_PATH, f'{self.model_name}.tflite')
-        self.interpreter = tflite.Interpreter(model_path)
+        conf = get_settings()
+        self.labels = get_model_labels(self.model_name)
+        model_path = self._get_model_path(conf)
+        options = get_interpreter_options(conf)
+        log.info('Using %s (threads=%s, xnnpack=%s)', os.path.basename(model_path), options['num_threads'] or 'default', options['xnnpack'])
+
+        self.interpreter = make_interpreter(model_path, **options)
         self.interpreter.allocate_tensors()
         input_details = self.interpreter.get_input_details()
         output_details = self.interpreter.get_output_details()
 
         self._input_layer_idx = input_details[self._input_layer]['index']
+        self._input_shape = list(input_details[self._input_layer]['shape'])
         self._output_layer_idx = output_details[self._output_layer]['index']
+        self._batch_size = self._input_shape[0]
+        self._batching = True
 
-        self.labels = get_model_labels(self.model_name)
+        self.human_indices = np.array([i for i, label in enumerate(self.labels) if 'Human' in label], dtype=int)
+        self._embedding_idx = self._get_embedding_idx()
+
+        if str(conf.get('TFLITE_BENCHMARK', '0')) == '1':
+            benchmark_interpreter(model_path, batch_size=max(1, int(conf.getfloat('RECORDING_LENGTH') // self.chunk_duration)))
+
+    def _get_model_path(self, conf):
+        model_path = os.path.join(MODEL_PATH, f'{self.model_name}.tflite')
+        quantized = conf.get('TFLITE_QUANTIZED_MODEL', '')
+        if not quantized:
+            return model_path
+
+        quantized_path = os.path.join(MODEL_PATH, quantized)
+        try:
+            probe = tflite.Interpreter(quantized_path)
+        except ValueError as e:
+            log.warning('Cannot use %s, falling back to %s: %s', quantized, os.path.basename(model_path), e)
+            return model_path
+        # the replacement has to take the same audio and predict the same classes as the labels of this model
+        samples = list(probe.get_input_details()[self._input_layer]['shape'][1:])
+        classes = probe.get_output_details()[self._output_layer]['shape'][-1]
+        if samples != [self.chunk_duration * self.sample_rate] or classes != len(self.labels):
+            log.warning('%s (input %s, %d classes) does not match %s, falling back to %s',
+                        quantized, samples, classes, self.model_name, os.path.basename(model_path))
+            return model_path
+        return quantized_path
+
+    def _get_embedding_idx(self):
+        # a second (batch, features) output next to the logits, like the embedding output of Perch
+        for i, details in enumerate(self.interpreter.get_output_details()):
+            if i != self._output_layer and len(details['shape']) == 2:
+                return details['index']
+        return None
+
+    @property
+    def embedding_size(self):
+        if self._embedding_idx is None:
+            return None
+        return int(self.interpreter.get_tensor_details()[self._embedding_idx]['shape'][-1])
 
     def label(self, logits):
         p_labels = dict(zip(self.labels, logits))
         return sorted(p_labels.items(), key=operator.itemgetter(1), reverse=True)
 
+    def top_k(self, scores, k=10):
+        return Prediction(scores, self.labels, k, self.human_indices)
+
+    def human_ranks(self, scores):
+        return rank_of_best(scores, self.human_indices)
+
+    def scores(self, logits):
+        return logits
+
+    def score_norm(self, logits):
+        # what scores_from_logits() needs besides the top logits of a chunk, to reproduce scores()
+        return np.zeros(len(logits), dtype='float32')
+
+    def _resize_inputs(self, batch_size):
+        self.interpreter.resize_tensor_input(self._input_layer_idx, [batch_size] + self._input_shape[1:])
+
+    def _set_batch_size(self, batch_size):
+        if batch_size == self._batch_size:
+            return
+        self._resize_inputs(batch_size)
+        # resized even if the allocation fails, so the fallback to single chunks resizes it back
+        self._batch_size = batch_size
+        self.interpreter.allocate_tensors()
+
+    def _invoke(self, batch):
+        self.interpreter.set_tensor(self._input_layer_idx, batch)
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self._output_layer_idx)
+
+    def _invoke_embeddings(self, batch):
+        logits = self._invoke(batch)
+        return logits, self.interpreter.get_tensor(self._embedding_idx).copy()
+
+    def predict_batch(self, chunks, embeddings=False):
+        """Scores (N, classes) of chunks; with embeddings=True also the (N, features) embeddings of the same invoke."""
+        if embeddings:
+            logits, vectors = self.predict_logits(chunks, embeddings=True)
+            return self.scores(logits), vectors
+        return self.scores(self.predict_logits(chunks))
+
+    def predict_logits(self, chunks, embeddings=False):
+        if embeddings and self._embedding_idx is None:
+            raise ValueError(f'{self.model_name} has no embedding output')
+        invoke = self._invoke_embeddings if embeddings else self._invoke
+
+        batch = np.asarray(chunks, dtype='float32')
+        if len(batch) == 0:
+            logits = np.empty((0, len(self.labels)), dtype='float32')
+            return (logits, np.empty((0, self.embedding_size), dtype='float32')) if embeddings else logits
+        if batch.ndim == 1:
+            batch = batch[np.newaxis, :]
+
+        outputs = None
+        if self._batching:
+            try:
+                self._set_batch_size(len(batch))
+                outputs = [invoke(batch)]
+            except (ValueError, RuntimeError) as e:
+                log.warning('Batched inference not supported by %s, falling back to single chunks: %s', self.model_name, e)
+                self._batching = False
+
+        if outputs is None:
+            self._set_batch_size(1)
+            outputs = [invoke(batch[i:i + 1]) for i in range(len(batch))]
+
+        if embeddings:
+            return np.concatenate([o[0] for o in outputs]), np.concatenate([o[1] for o in outputs])
+        return np.concatenate(outputs)
+
     def predict(self, chunk):
-        raise NotImplementedError
+        return self.label(self.predict_batch(chunk)[0])
 
     def set_meta_data(self, lat, lon, week):
         pass
@@ -82,6 +311,9 @@ class Basemodel:
     def get_species_list(self):
         return []
 
+    def get_species_mask(self):
+        return None
+
 
 class BirdNet(Basemodel):
     chunk_duration = 3
@@ -92,14 +324,25 @@ class BirdNet(Basemodel):
 
         self._mdata_model = self._set_meta_model()
 
-        self._sensitivity = max(0.5, min(1.0 - (sens - 1.0), 1.5))
+        self._sensitivity = sensitivity_slope(sens)
 
     def scale(self, logits):
         return 1 / (1.0 + np.exp(-self._sensitivity * logits))
 
+    def scores(self, logits):
+        return self.scale(logits)
+
     def _set_meta_model(self):
         return None
 
+    def _get_embedding_idx(self):
+        # global average pool, the tensor right before the classification layer
+        idx = self._output_layer_idx - 1
+        details = [d for d in self.interpreter.get_tensor_details() if d['index'] == idx]
+        if details and len(details[0]['shape']) == 2 and details[0]['shape'][-1] != len(self.labels):
+            return idx
+        return None
+
 
 class BirdNetV1(BirdNet):
     model_name = 'BirdNET_6K_GLOBAL_MODEL'
@@ -113,14 +356,14 @@ class BirdNetV1(BirdNet):
         input_details = self.interpreter.get_input_details()
         return input_details[1]['index']
 
-    def predict(self, chunk):
-        self.interpreter.set_tensor(self._input_layer_idx, np.array(chunk, dtype='float32')[np.newaxis, :])
-        self.interpreter.set_tensor(self._mdata_model, np.array(self._mdata, dtype='float32'))
+    def _resize_inputs(self, batch_size):
+        super()._resize_inputs(batch_size)
+        self.interpreter.resize_tensor_input(self._mdata_model, [batch_size, 6])
 
-        self.interpreter.invoke()
-        logits = self.interpreter.get_tensor(self._output_layer_idx)[0]
-
-        return self.label(self.scale(logits))
+    def _invoke(self, batch):
+        mdata = np.repeat(np.array(self._mdata, dtype='float32'), len(batch), axis=0)
+        self.interpreter.set_tensor(self._mdata_model, mdata)
+        return super()._invoke(batch)
 
     def _convert_metadata(self, m):
         # Convert week to cosine
@@ -150,15 +393,8 @@ class BirdNetV2_4(BirdNet):
     model_name = 'BirdNET_GLOBAL_6K_V2.4_Model_FP16'
 
     def _set_meta_model(self):
-        return get_meta_model()
-
-    def predict(self, chunk):
-        self.interpreter.set_tensor(self._input_layer_idx, np.array(chunk, dtype='float32')[np.newaxis, :])
-
-        self.interpreter.invoke()
-        logits = self.interpreter.get_tensor(self._output_layer_idx)[0]
-
-        return self.label(self.scale(logits))
+        # its own, also when it is the ENSEMBLE_MODEL next to a MODEL without one
+        return get_meta_model(self.model_name)
 
     def set_meta_data(self, lat, lon, week):
         self._mdata_model.set_meta_data(lat, lon, week)
@@ -166,6 +402,9 @@ class BirdNetV2_4(BirdNet):
     def get_species_list(self):
         return self._mdata_model.get_species_list(self.labels)
 
+    def get_species_mask(self):
+        return self._mdata_model.get_species_mask(self.labels)
+
 
 class Perch(Basemodel):
     chunk_duration = 5
@@ -173,14 +412,14 @@ class Perch(Basemodel):
     model_name = 'Perch_v2'
     _output_layer = 3
 
-    def predict(self, chunk):
-        self.interpreter.set_tensor(self._input_layer_idx, np.array(chunk, dtype='float32')[np.newaxis, :])
+    def scores(self, logits):
+        exp_x = np.exp(logits - np.max(logits, axis=-1, keepdims=True))  # Stabilizing to prevent overflow
+        return exp_x / np.sum(exp_x, axis=-1, keepdims=True)
 
-        self.interpreter.invoke()
-        logits = self.interpreter.get_tensor(self._output_layer_idx)[0]
-
-        exp_x = np.exp(logits - np.max(logits))  # Stabilizing to prevent overflow
-        return self.label(exp_x / np.sum(exp_x))
+    def score_norm(self, logits):
+        # log of the softmax denominator
+        top = np.max(logits, axis=-1)
+        return (top + np.log(np.sum(np.exp(logits - top[:, np.newaxis]), axis=-1))).astype('float32')
 
 
 class BirdNETGo20250916(BirdNetV2_4):
@@ -189,36 +428,92 @@ class BirdNETGo20250916(BirdNetV2_4):
 
 class MDataModel:
     model_name = None
+    # the analysis passes ISO weeks, so the table covers 53 of them
+    weeks = range(1, 54)
 
     def __init__(self, sf_thresh):
         model_path = os.path.join(MODEL_PATH, f'{self.model_name}.tflite')
-        self.interpreter = tflite.Interpreter(model_path)
+        self.interpreter = make_interpreter(model_path, **get_interpreter_options())
         self.interpreter.allocate_tensors()
         input_details = self.interpreter.get_input_details()
         output_details = self.interpreter.get_output_details()
 
         self._input_layer_idx = input_details[0]['index']
         self._output_layer_idx = output_details[0]['index']
+        self._classes = output_details[0]['shape'][-1]
         self._sf_thresh = sf_thresh
 
         self._mdata_params = None
         self._mdata = None
+        self._table = None
+        self._table_params = None
+        self._species = {}
 
     def set_meta_data(self, lat, lon, week):
         if self._mdata_params != (lat, lon, week):
             self._mdata = None
         self._mdata_params = (lat, lon, week)
 
-    def get_species_list_details(self, labels):
-        if self._mdata is None:
-            lat, lon, week = self._mdata_params
-            sample = np.expand_dims(np.array([lat, lon, week], dtype='float32'), 0)
-
-            # Run inference
-            self.interpreter.set_tensor(self._input_layer_idx, sample)
+    def _invoke(self, samples):
+        samples = np.array(samples, dtype='float32')
+        try:
+            self.interpreter.resize_tensor_input(self._input_layer_idx, list(samples.shape))
+            self.interpreter.allocate_tensors()
+            self.interpreter.set_tensor(self._input_layer_idx, samples)
             self.interpreter.invoke()
+            return self.interpreter.get_tensor(self._output_layer_idx)
+        except (ValueError, RuntimeError) as e:
+            if len(samples) == 1:
+                raise
+            log.warning('Batched inference not supported by %s, falling back to single weeks: %s', self.model_name, e)
+            return np.concatenate([self._invoke(samples[i:i + 1]) for i in range(len(samples))])
+
+    def get_week_table(self, lat, lon):
+        """Occurrence scores (weeks, classes) for a location, from the cache dir or one invoke for all weeks."""
+        if self._table_params == (lat, lon):
+            return self._table
+
+        cache_file = os.path.join(CACHE_DIR, f'{self.model_name}_{lat}_{lon}.npy')
+        table = None
+        try:
+            table = np.load(cache_file)
+            if table.shape != (len(self.weeks), self._classes):
+                table = None
+        except (OSError, ValueError):
+            pass
+
+        if table is None:
+            log.info('Computing species occurrence for %s/%s, weeks %d-%d', lat, lon, self.weeks[0], self.weeks[-1])
+            table = self._invoke([[lat, lon, week] for week in self.weeks])
+            try:
+                os.makedirs(CACHE_DIR, exist_ok=True)
+                tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+                with open(tmp_file, 'wb') as f:
+                    np.save(f, table)
+                os.replace(tmp_file, cache_file)
+            except OSError as e:
+                log.warning('Cannot cache species occurrence in %s: %s', CACHE_DIR, e)
+
+        self._table, self._table_params = table, (lat, lon)
+        return table
+
+    def get_scores(self):
+        lat, lon, week = self._mdata_params
+        if week in self.weeks:
+            return self.get_week_table(lat, lon)[week - self.weeks[0]]
+        return self._invoke([[lat, lon, week]])[0]
+
+    def get_species_mask(self, labels):
+        """Boolean mask over labels of the species above the occurrence threshold this week."""
+        l_filter = self.get_scores()
+        mask = np.zeros(len(labels), dtype=bool)
+        n = min(len(labels), len(l_filter))
+        mask[:n] = l_filter[:n] >= float(self._sf_thresh)
+        return mask
 
-            l_filter = self.interpreter.get_tensor(self._output_layer_idx)[0]
+    def get_species_list_details(self, labels):
+        if self._mdata is None:
+            l_filter = self.get_scores()
 
             # Apply threshold
             l_filter = np.where(l_filter >= float(self._sf_thresh), l_filter, 0)
@@ -234,8 +529,11 @@ class MDataModel:
         return self._mdata
 
     def get_species_list(self, labels):
-        l_filter = self.get_species_list_details(labels)
-        return [s[1].split('_')[0] for s in l_filter]
+        # a set per week, the analysis only checks membership
+        if self._mdata_params not in self._species:
+            mask = self.get_species_mask(labels)
+            self._species[self._mdata_params] = frozenset(label.split('_')[0] for label in np.array(labels)[mask])
+        return self._species[self._mdata_params]
 
 
 class MDataModel1(MDataModel):
@@ -1,20 +1,107 @@
 import apprise
+import functools
+import logging
 import os
+import re
 import socket
 import requests
 import html
+import threading
 import time
+from collections import OrderedDict
+from queue import Full, Queue
 
 from .db import get_todays_count_for, get_this_weeks_count_for
 from .helpers import get_settings
 
+log = logging.getLogger(__name__)
+
 userDir = os.path.expanduser('~')
 APPRISE_CONFIG = userDir + '/BirdNET-Pi/apprise.txt'
 APPRISE_BODY = userDir + '/BirdNET-Pi/body.txt'
 
 apobj = None
-images = {}
 species_last_notified = {}
+# notifications waiting for the dispatcher thread, more are dropped while a provider is down
+NOTIFY_QUEUE_SIZE = 32
+FIELDS = ['sciname', 'comname', 'confidencepct', 'confidence', 'listenurl', 'friendlyurl', 'date', 'time', 'week', 'latitude',
+          'longitude', 'cutoff', 'sens', 'flickrimage', 'image', 'overlap', 'reason']
+# longest alternatives first, so $confidencepct is not taken for $confidence
+TEMPLATE_FIELDS = re.compile(r'\$(' + '|'.join(sorted(FIELDS, key=len, reverse=True)) + ')')
+_body = (None, None)
+_dispatcher = None
+
+
+class ImageCache:
+    """Image URLs by species: the maxsize most recently used, each for at most ttl seconds."""
+
+    def __init__(self, maxsize=256, ttl=24 * 3600, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if self.clock() - entry[1] > self.ttl:
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, value):
+        self.entries[key] = (value, self.clock())
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+
+images = ImageCache()
+
+
+class NotificationDispatcher:
+    """Sends the notifications from a thread of its own, a slow provider no longer holds up the reporting thread."""
+
+    def __init__(self, queue_size=NOTIFY_QUEUE_SIZE):
+        self.queue = Queue(maxsize=queue_size)
+        self.thread = threading.Thread(target=self.run, name='apprise', daemon=True)
+        self.thread.start()
+
+    def submit(self, messages):
+        try:
+            self.queue.put_nowait(messages)
+        except Full:
+            log.warning('Apprise queue full, dropped %d notification(s)', len(messages))
+
+    def run(self):
+        while True:
+            messages = self.queue.get()
+            if messages is None:
+                break
+            try:
+                send_notification(messages)
+            except Exception as e:
+                log.exception('Apprise notification failed', exc_info=e)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+def get_dispatcher():
+    global _dispatcher
+    if _dispatcher is None:
+        _dispatcher = NotificationDispatcher()
+    return _dispatcher
+
+
+def close_dispatcher():
+    global _dispatcher
+    if _dispatcher is not None:
+        _dispatcher.close()
+        _dispatcher = None
 
 
 def notify(body, title, attached=""):
@@ -44,79 +131,106 @@ def notify(body, title, attached=""):
         )
 
 
-def sendAppriseNotifications(sci_name, com_name, confidence, confidencepct, path, date, time_of_day, week, latitude, longitude, cutoff, sens, overlap):
-    def render_template(template, reason=""):
-        ret = template.replace("$sciname", sci_name) \
-            .replace("$comname", com_name) \
-            .replace("$confidencepct", str(confidencepct)) \
-            .replace("$confidence", str(confidence)) \
-            .replace("$listenurl", listenurl) \
-            .replace("$friendlyurl", friendlyurl) \
-            .replace("$date", str(date)) \
-            .replace("$time", str(time_of_day)) \
-            .replace("$week", str(week)) \
-            .replace("$latitude", str(latitude)) \
-            .replace("$longitude", str(longitude)) \
-            .replace("$cutoff", str(cutoff)) \
-            .replace("$sens", str(sens)) \
-            .replace("$flickrimage", image_url if "{" in body else "") \
-            .replace("$image", image_url if "{" in body else "") \
-            .replace("$overlap", str(overlap)) \
-            .replace("$reason", reason)
-        return ret
+@functools.lru_cache(maxsize=32)
+def compile_template(template):
+    # text and field names, alternating
+    return tuple(TEMPLATE_FIELDS.split(template))
 
-    if not should_notify(com_name):
-        return
 
-    settings_dict = get_settings()
-    title = html.unescape(settings_dict.get('APPRISE_NOTIFICATION_TITLE'))
-    f = open(APPRISE_BODY, 'r')
-    body = f.read()
+def render_template(template, values):
+    return ''.join(values[part] if i % 2 else part for i, part in enumerate(compile_template(template)))
 
-    websiteurl = settings_dict.get('BIRDNETPI_URL')
-    if websiteurl is None or len(websiteurl) == 0:
-        websiteurl = f"http://{socket.gethostname()}.local"
 
-    listenurl = f"{websiteurl}?filename={path}"
-    friendlyurl = f"[Listen here]({listenurl})"
+@functools.lru_cache(maxsize=8)
+def unescape_title(title):
+    return html.unescape(title)
+
+
+def read_body():
+    # read again only when body.txt is changed
+    global _body
+    key = (APPRISE_BODY, os.stat(APPRISE_BODY).st_mtime_ns)
+    if _body[0] != key:
+        with open(APPRISE_BODY, 'r') as f:
+            _body = (key, f.read())
+    return _body[1]
 
-    image_url = ""
-    if "$flickrimage" in body or "$image" in body:
-        if com_name not in images:
-            try:
-                url = f"http://localhost/api/v1/image/{sci_name}"
-                resp = requests.get(url=url, timeout=10).json()
-                images[com_name] = resp['data']['image_url']
-            except Exception as e:
-                print("IMAGE API ERROR:", e)
-        image_url = images.get(com_name, "")
 
+def get_image_url(sci_name, com_name):
+    image_url = images.get(com_name)
+    if image_url is None:
+        try:
+            url = f"http://localhost/api/v1/image/{sci_name}"
+            resp = requests.get(url=url, timeout=10).json()
+            image_url = resp['data']['image_url']
+            images.put(com_name, image_url)
+        except Exception as e:
+            print("IMAGE API ERROR:", e)
+            image_url = ""
+    return image_url
+
+
+def notification_messages(sci_name, com_name, confidence, confidencepct, path, date, time_of_day, week, latitude, longitude, cutoff, sens, overlap):
+    """One message per reason to notify of this detection, from the settings and the detections in the database."""
+    if not should_notify(com_name):
+        return []
+
+    settings_dict = get_settings()
+    detection = {'sciname': sci_name, 'comname': com_name, 'confidencepct': str(confidencepct), 'confidence': str(confidence),
+                 'path': path, 'date': str(date), 'time': str(time_of_day), 'week': str(week), 'latitude': str(latitude),
+                 'longitude': str(longitude), 'cutoff': str(cutoff), 'sens': str(sens), 'overlap': str(overlap)}
+    reasons = []
     if settings_dict.get('APPRISE_NOTIFY_EACH_DETECTION') == "1":
-        reason = "detection"
-        notify_body = render_template(body, reason)
-        notify_title = render_template(title, reason)
-        notify(notify_body, notify_title, image_url)
+        reasons.append("detection")
         species_last_notified[com_name] = int(time.time())
 
     APPRISE_NOTIFICATION_NEW_SPECIES_DAILY_COUNT_LIMIT = 1  # Notifies the first N per day.
     if settings_dict.get('APPRISE_NOTIFY_NEW_SPECIES_EACH_DAY') == "1":
         numberDetections = get_todays_count_for(sci_name)
         if 0 < numberDetections <= APPRISE_NOTIFICATION_NEW_SPECIES_DAILY_COUNT_LIMIT:
-            reason = "first time today"
-            notify_body = render_template(body, reason)
-            notify_title = render_template(title, reason)
-            notify(notify_body, notify_title, image_url)
+            reasons.append("first time today")
             species_last_notified[com_name] = int(time.time())
 
     if settings_dict.get('APPRISE_NOTIFY_NEW_SPECIES') == "1":
         numberDetections = get_this_weeks_count_for(sci_name)
         if 0 < numberDetections <= 5:
-            reason = f"only seen {numberDetections} times in last 7d"
-            notify_body = render_template(body, reason)
-            notify_title = render_template(title, reason)
-            notify(notify_body, notify_title, image_url)
+            reasons.append(f"only seen {numberDetections} times in last 7d")
             species_last_notified[com_name] = int(time.time())
 
+    return [dict(detection, reason=reason) for reason in reasons]
+
+
+def send_notification(messages):
+    """Render and send messages as a single notification, titled after the first one."""
+    settings_dict = get_settings()
+    title = unescape_title(settings_dict.get('APPRISE_NOTIFICATION_TITLE'))
+    body = read_body()
+
+    websiteurl = settings_dict.get('BIRDNETPI_URL')
+    if websiteurl is None or len(websiteurl) == 0:
+        websiteurl = f"http://{socket.gethostname()}.local"
+
+    bodies = []
+    titles = []
+    attached = ""
+    for message in messages:
+        listenurl = f"{websiteurl}?filename={message['path']}"
+        image_url = ""
+        if "$flickrimage" in body or "$image" in body:
+            image_url = get_image_url(message['sciname'], message['comname'])
+        values = dict(message, listenurl=listenurl, friendlyurl=f"[Listen here]({listenurl})",
+                      flickrimage=image_url if "{" in body else "", image=image_url if "{" in body else "")
+        bodies.append(render_template(body, values))
+        titles.append(render_template(title, values))
+        attached = attached or image_url
+    notify("\n\n".join(bodies), titles[0], attached)
+
+
+def sendAppriseNotifications(sci_name, com_name, confidence, confidencepct, path, date, time_of_day, week, latitude, longitude, cutoff, sens, overlap):
+    for message in notification_messages(sci_name, com_name, confidence, confidencepct, path, date, time_of_day, week,
+                                         latitude, longitude, cutoff, sens, overlap):
+        send_notification([message])
+
 
 def should_notify(com_name):
     settings_dict = get_settings()
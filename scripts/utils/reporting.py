@@ -1,27 +1,22 @@
+import datetime
+import functools
 import glob
+import itertools
 import json
 import logging
+import math
 import os
-import sqlite3
 import subprocess
 import tempfile
-import io
+import threading
 import soundfile
-from time import sleep
+from queue import PriorityQueue
 
-import requests
-from PIL import Image, ImageDraw, ImageFont
 import numpy as np
-import librosa
-import librosa.display  # type: ignore
-import matplotlib.pyplot as plt
-import matplotlib.ticker as mticker
-from scipy import signal
-plt.rcParams["image.interpolation"] = "lanczos"
-
-from .helpers import get_settings, get_font, DB_PATH
+
+from .db import get_db_writer
+from .helpers import get_settings, get_font
 from .classes import Detection, ParseFileName
-from .notifications import sendAppriseNotifications
 
 log = logging.getLogger(__name__)
 NOISE_PROFILE_PERCENTILE = 25
@@ -29,6 +24,14 @@ EPSILON = 1e-6
 # Fixed 2:1 aspect with higher DPI for crisper labels (10x5in @200 dpi)
 TARGET_DPI = 200
 TARGET_FIGSIZE = (10.0, 5.0)
+# zlib level of the spectrogram PNGs: 3 writes them in under half the time of the default 6, for 15% more bytes
+PNG_COMPRESS_LEVEL = 3
+ENSEMBLE_FILE = os.path.expanduser('~/BirdNET-Pi/BirdDB_ensemble.txt')
+# AUDIOFMT extensions libsndfile can write, everything else is extracted with sox
+SOUNDFILE_FORMATS = {'wav': 'WAV', 'flac': 'FLAC', 'mp3': 'MP3', 'ogg': 'OGG', 'vorbis': 'OGG', 'aif': 'AIFF', 'aiff': 'AIFF',
+                     'au': 'AU', 'snd': 'AU', 'caf': 'CAF', 'w64': 'W64', 'voc': 'VOC'}
+# constant 128 kbps like sox/lame: libsndfile maps the level linearly from 320 down to 32 kbps
+MP3_OPTIONS = {'bitrate_mode': 'CONSTANT', 'compression_level': (320 - 128) / (320 - 32)}
 
 
 def extract(in_file, out_file, start, stop):
@@ -41,8 +44,9 @@ def extract(in_file, out_file, start, stop):
     return ret
 
 
-def extract_safe(in_file, out_file, start, stop):
-    conf = get_settings()
+def extraction_window(start, stop, conf=None):
+    if conf is None:
+        conf = get_settings()
     # This section sets the SPACER that will be used to pad the audio clip with
     # context. If EXTRACTION_LENGTH is 10, for instance, 3 seconds are removed
     # from that value and divided by 2, so that the 3 seconds of the call are
@@ -54,61 +58,154 @@ def extract_safe(in_file, out_file, start, stop):
     spacer = (ex_len - 3) / 2
     safe_start = max(0, start - spacer)
     safe_stop = min(conf.getint('RECORDING_LENGTH'), stop + spacer)
+    return safe_start, safe_stop
+
 
-    extract(in_file, out_file, safe_start, safe_stop)
+def extract_safe(in_file, out_file, start, stop):
+    extract_clips(in_file, [(out_file, *extraction_window(start, stop))])
 
 
-def spectrogram(in_file, title, comment, raw=0):
-    fd, tmp_file = tempfile.mkstemp(suffix=".png")
-    os.close(fd)
+def _clip_format(out_file, source):
+    # soundfile arguments for writing out_file like sox would, None if libsndfile cannot write it
+    fmt = SOUNDFILE_FORMATS.get(os.path.splitext(out_file)[1][1:].lower())
+    if fmt is None or fmt not in soundfile.available_formats():
+        return None
+    if fmt in ('MP3', 'OGG'):
+        # lossy: the encoder defaults of sox (lame at 128 kbps CBR, vorbis)
+        return {'format': fmt, **MP3_OPTIONS} if fmt == 'MP3' else {'format': fmt}
+    # lossless: the sample format of the recording, as sox keeps it
+    subtype = source.subtype if soundfile.check_format(fmt, source.subtype) else None
+    return {'format': fmt, 'subtype': subtype}
+
+
+def extract_clips(in_file, clips):
+    """Write the (out_file, start, stop) clips of in_file in one pass over it, in-process where libsndfile can.
+
+    Every clip only reads its own frames; formats libsndfile cannot write (see AUDIOFMT) still go through sox.
+    """
+    if not clips:
+        return
+    try:
+        source = soundfile.SoundFile(in_file)
+    except RuntimeError as e:
+        log.debug('Extracting with sox, cannot open %s: %s', in_file, e)
+        for out_file, start, stop in clips:
+            extract(in_file, out_file, start, stop)
+        return
+
+    with source:
+        # reading PCM as int32 makes the copy into a PCM file of the same subtype lossless
+        dtype = 'int32' if source.subtype.startswith('PCM') else 'float32'
+        for out_file, start, stop in clips:
+            fmt = _clip_format(out_file, source)
+            if fmt is not None:
+                first = min(source.frames, int(round(start * source.samplerate)))
+                last = min(source.frames, max(first, int(round(stop * source.samplerate))))
+                source.seek(first)
+                data = source.read(last - first, dtype=dtype, always_2d=True)
+                try:
+                    soundfile.write(out_file, data, source.samplerate, **fmt)
+                    continue
+                except (TypeError, RuntimeError) as e:
+                    # e.g. a soundfile without the MP3 bitrate options
+                    log.debug('Extracting %s with sox: %s', out_file, e)
+                    if os.path.exists(out_file):
+                        os.remove(out_file)
+            extract(in_file, out_file, start, stop)
+
+
+class SpectrogramPlan:
+    """The parts of the detection spectrogram that only depend on the sample rate: filter, window, mel filterbank.
+
+    Noise is gated in the magnitude domain, on the one STFT the mel spectrogram is taken from.
+    """
+    n_fft = 8192
+    hop_length = 1228
+    n_mels = 1024
+    fmin = 900
+    fmax = 14000
+    highpass_hz = 1000
+
+    def __init__(self, sr):
+        import librosa
+        from scipy import signal, sparse
+        self.sr = sr
+        self.sos = signal.butter(4, self.highpass_hz, btype="highpass", fs=sr, output="sos")
+        self.window = signal.get_window("hann", self.n_fft, fftbins=True).astype("float32")
+        # each band only covers a few of the 4097 bins, as a sparse matrix the projection is ~100x faster
+        self.mel_basis = sparse.csr_matrix(
+            librosa.filters.mel(sr=sr, n_fft=self.n_fft, n_mels=self.n_mels, fmin=self.fmin, fmax=self.fmax)
+        )
+
+    def magnitude(self, y):
+        # |STFT| (bins, frames) with the framing of librosa.stft(center=True)
+        from scipy import fft
+        from numpy.lib.stride_tricks import sliding_window_view
+        padded = np.pad(y.astype("float32", copy=False), self.n_fft // 2)
+        frames = sliding_window_view(padded, self.n_fft)[::self.hop_length]
+        return np.abs(fft.rfft(frames * self.window, axis=-1)).T
+
+    def matrix(self, y):
+        import librosa
+        from scipy import signal
+        # High-pass filter at 1000 Hz
+        y = signal.sosfilt(self.sos, y)
+
+        # Noise reduction (spectral gating)
+        magnitude = self.magnitude(y)
+        noise_profile = np.percentile(magnitude, NOISE_PROFILE_PERCENTILE, axis=1, keepdims=True).astype("float32")
+        S = self.mel_basis @ np.maximum(magnitude - noise_profile, 0.0)
+
+        # PCEN (no dB!)
+        return librosa.pcen(
+            S + EPSILON,
+            sr=self.sr,
+            hop_length=self.hop_length,
+            gain=0.7,
+            bias=9.0,
+            power=1.0,
+        )
+
+
+@functools.lru_cache(maxsize=4)
+def get_spectrogram_plan(sr):
+    return SpectrogramPlan(sr)
+
+
+def spectrogram_matrix(in_file):
+    """PCEN mel spectrogram (1024 bands from 900 to 14000 Hz, frames) of in_file and its duration in seconds."""
+    import librosa
 
     try:
         y, sr = librosa.load(in_file, sr=48000, mono=True)
     except Exception as exc:  # pragma: no cover
         raise RuntimeError(f"Failed to load audio for spectrogram: {exc}") from exc
 
-    # High-pass filter at 1000 Hz
-    sos = signal.butter(4, 1000, btype="highpass", fs=sr, output="sos")
-    y = signal.sosfilt(sos, y)
+    return get_spectrogram_plan(sr).matrix(y), len(y) / sr
 
-    # Noise reduction (spectral gating)
-    n_fft = 8192
-    hop_length = 1228
 
-    D = librosa.stft(y, n_fft=n_fft, hop_length=hop_length, window="hann")
-    magnitude = np.abs(D)
-    noise_profile = np.percentile(
-        magnitude, NOISE_PROFILE_PERCENTILE, axis=1, keepdims=True
-    )
-    reduced_mag = np.maximum(magnitude - noise_profile, 0.0)
-    y = librosa.istft(
-        reduced_mag * np.exp(1j * np.angle(D)),
-        hop_length=hop_length,
-        length=len(y),
-    )
+def spectrogram(in_file, title, comment, raw=0):
+    conf = get_settings()
+    S_pcen, duration = spectrogram_matrix(in_file)
+    if conf.get('SPECTROGRAM_RENDERER', 'pil') == 'matplotlib':
+        spectrogram_figure(in_file, S_pcen, duration, title, comment)
+    else:
+        # straight from the matrix to the PNG, the plotting stack is not needed
+        from .spectrogram_image import render
+        # the pages may load it while it is written, as it follows the detection
+        render(S_pcen, duration, title, comment).save(f"{in_file}.png.tmp", format='PNG', compress_level=PNG_COMPRESS_LEVEL)
+        os.replace(f"{in_file}.png.tmp", f"{in_file}.png")
 
-    # Mel spectrogram
-    S = librosa.feature.melspectrogram(
-        y=y,
-        sr=sr,
-        n_fft=n_fft,
-        hop_length=hop_length,
-        window="hann",
-        n_mels=1024,
-        fmin=900,
-        fmax=14000,
-        power=1.0,
-    )
 
-    # PCEN (no dB!)
-    S_pcen = librosa.pcen(
-        S + EPSILON,
-        sr=sr,
-        hop_length=hop_length,
-        gain=0.7,
-        bias=9.0,
-        power=1.0,
-    )
+def spectrogram_figure(in_file, S_pcen, duration, title, comment):
+    # the matplotlib rendering, loaded with the first spectrogram that uses it
+    import matplotlib.pyplot as plt
+    import matplotlib.ticker as mticker
+    from PIL import Image, ImageDraw, ImageFont
+    plt.rcParams["image.interpolation"] = "lanczos"
+
+    fd, tmp_file = tempfile.mkstemp(suffix=".png")
+    os.close(fd)
 
     # ---- FIGURE ----
     fig, ax = plt.subplots(
@@ -129,7 +226,7 @@ def spectrogram(in_file, title, comment, raw=0):
         cmap="plasma",
         extent=[
             0,
-            len(y) / sr,
+            duration,
             900,
             14000,
         ],
@@ -217,41 +314,139 @@ def spectrogram(in_file, title, comment, raw=0):
     os.remove(tmp_file)
 
 
+class SpectrogramPool:
+    """Renders the spectrograms in worker processes, the reporting thread only queues them.
+
+    Jobs wait in a bounded priority queue and are handed to the workers one free worker at a time, so the clips of
+    recordings that just came in (LIVE, what the pages show) overtake those of a backlog (BACKFILL).
+    """
+    LIVE, BACKFILL = 0, 1
+
+    def __init__(self, workers, queue_size=64, make_executor=None, render=None):
+        if make_executor is None:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            make_executor = functools.partial(ProcessPoolExecutor, workers, mp_context=multiprocessing.get_context('spawn'))
+        self.make_executor = make_executor
+        self.executor = make_executor()
+        self.render = spectrogram if render is None else render
+        self.queue = PriorityQueue(maxsize=queue_size)
+        self.slots = threading.Semaphore(workers)
+        self.sequence = itertools.count()
+        self.lock = threading.Condition()
+        self.pending = 0
+        self.completed = 0
+        self.failed = 0
+        self.dispatcher = threading.Thread(target=self._dispatch, name='spectrograms')
+        self.dispatcher.start()
+
+    @classmethod
+    def priority(cls, file: ParseFileName, conf=None):
+        conf = get_settings() if conf is None else conf
+        # a recording older than two of its length, plus margin, was not picked up as it came in
+        live = datetime.timedelta(seconds=2 * conf.getint('RECORDING_LENGTH') + 30)
+        return cls.LIVE if datetime.datetime.now() - file.file_date <= live else cls.BACKFILL
+
+    def submit(self, in_file, title, comment, raw=0, priority=LIVE):
+        with self.lock:
+            self.pending += 1
+        # ties in FIFO order
+        self.queue.put((priority, next(self.sequence), (in_file, title, comment, raw)))
+
+    def _dispatch(self):
+        while True:
+            self.slots.acquire()
+            _, _, job = self.queue.get()
+            if job is None:
+                break
+            try:
+                future = self._submit(job)
+            except Exception as e:
+                self._done(job[0], None, error=e)
+                continue
+            future.add_done_callback(functools.partial(self._done, job[0]))
+
+    def _submit(self, job):
+        try:
+            return self.executor.submit(self.render, *job)
+        except Exception as e:
+            # e.g. BrokenProcessPool, after a worker was killed for running out of memory
+            log.warning('Spectrogram workers failed, starting new ones: %s', e)
+            self.executor.shutdown(wait=False)
+            self.executor = self.make_executor()
+            return self.executor.submit(self.render, *job)
+
+    def _done(self, in_file, future, error=None):
+        self.slots.release()
+        if future is not None:
+            error = future.exception()
+        if error is not None:
+            log.error('Spectrogram of %s failed: %s', in_file, error)
+        with self.lock:
+            self.pending -= 1
+            if error is None:
+                self.completed += 1
+            else:
+                self.failed += 1
+            self.lock.notify_all()
+
+    def wait(self, timeout=None):
+        """True once every submitted spectrogram is written or failed."""
+        with self.lock:
+            return self.lock.wait_for(lambda: self.pending == 0, timeout)
+
+    def close(self):
+        # after everything already queued, whatever its priority
+        self.queue.put((math.inf, next(self.sequence), None))
+        self.dispatcher.join()
+        self.executor.shutdown(wait=True)
+        log.info('spectrograms: %d written, %d failed', self.completed, self.failed)
+
+
 def extract_detection(file: ParseFileName, detection: Detection):
+    return extract_detections(file, [detection])[0]
+
+
+def extract_detections(file: ParseFileName, detections: [Detection], render_spectrogram=None):
+    """Clip and spectrogram of each detection of file, all clips cut from a single read of the recording.
+
+    The spectrograms are made by render_spectrogram, e.g. SpectrogramPool.submit to have them follow asynchronously.
+    """
     conf = get_settings()
-    new_file_name = f'{detection.common_name_safe}-{detection.confidence_pct}-{detection.date}-birdnet-{file.RTSP_id}{detection.time}.{conf["AUDIOFMT"]}'
-    new_dir = os.path.join(conf['EXTRACTED'], 'By_Date', f'{detection.date}', f'{detection.common_name_safe}')
-    new_file = os.path.join(new_dir, new_file_name)
-    if os.path.isfile(new_file):
-        log.warning('Extraction exists. Moving on: %s', new_file)
-    else:
-        os.makedirs(new_dir, exist_ok=True)
-        extract_safe(file.file_name, new_file, detection.start, detection.stop)
-        spectrogram(new_file, detection.common_name, new_file.replace(os.path.expanduser('~/'), ''), conf['RAW_SPECTROGRAM'])
-    return new_file
+    render_spectrogram = spectrogram if render_spectrogram is None else render_spectrogram
+    new_files = []
+    clips = []
+    for detection in detections:
+        new_file_name = f'{detection.common_name_safe}-{detection.confidence_pct}-{detection.date}-birdnet-{file.RTSP_id}{detection.time}.{conf["AUDIOFMT"]}'
+        new_dir = os.path.join(conf['EXTRACTED'], 'By_Date', f'{detection.date}', f'{detection.common_name_safe}')
+        new_file = os.path.join(new_dir, new_file_name)
+        new_files.append(new_file)
+        if os.path.isfile(new_file) or any(new_file == clip[0] for clip, _ in clips):
+            log.warning('Extraction exists. Moving on: %s', new_file)
+        else:
+            os.makedirs(new_dir, exist_ok=True)
+            clips.append(((new_file, *extraction_window(detection.start, detection.stop, conf)), detection))
+
+    extract_clips(file.file_name, [clip for clip, _ in clips])
+    for (new_file, _, _), detection in clips:
+        render_spectrogram(new_file, detection.common_name, new_file.replace(os.path.expanduser('~/'), ''), conf['RAW_SPECTROGRAM'])
+    return new_files
 
 
 def write_to_db(file: ParseFileName, detection: Detection):
+    write_detections_to_db(file, [detection])
+
+
+def write_detections_to_db(file: ParseFileName, detections: [Detection]):
     conf = get_settings()
-    # Connect to SQLite Database
-    for attempt_number in range(3):
-        try:
-            con = sqlite3.connect(DB_PATH)
-            cur = con.cursor()
-            cur.execute("INSERT INTO detections VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                        (detection.date, detection.time, detection.scientific_name, detection.common_name, detection.confidence,
-                         conf['LATITUDE'], conf['LONGITUDE'], conf['CONFIDENCE'], str(detection.week), conf['SENSITIVITY'],
-                         conf['OVERLAP'], os.path.basename(detection.file_name_extr)))
-            # (Date, Time, Sci_Name, Com_Name, str(score),
-            # Lat, Lon, Cutoff, Week, Sens,
-            # Overlap, File_Name))
-
-            con.commit()
-            con.close()
-            break
-        except BaseException as e:
-            log.warning("Database busy: %s", e)
-            sleep(2)
+    # (Date, Time, Sci_Name, Com_Name, str(score),
+    # Lat, Lon, Cutoff, Week, Sens,
+    # Overlap, File_Name))
+    rows = [(detection.date, detection.time, detection.scientific_name, detection.common_name, detection.confidence,
+             conf['LATITUDE'], conf['LONGITUDE'], conf['CONFIDENCE'], str(detection.week), conf['SENSITIVITY'],
+             conf['OVERLAP'], os.path.basename(detection.file_name_extr)) for detection in detections]
+    if rows:
+        get_db_writer().write(rows)
 
 
 def summary(file: ParseFileName, detection: Detection):
@@ -270,6 +465,20 @@ def write_to_file(file: ParseFileName, detection: Detection):
         rfile.write(f'{summary(file, detection)}\n')
 
 
+def write_ensemble_file(file: ParseFileName, results: {str: [Detection]}):
+    # Model;Date;Time;Sci_Name;Com_Name;Confidence;Best confidence of the other models for this species at that time
+    lines = []
+    for model, detections in results.items():
+        others = [other for name, dets in results.items() if name != model for other in dets]
+        for detection in detections:
+            agreement = max((other.confidence for other in others if other.scientific_name == detection.scientific_name
+                             and other.start < detection.stop and detection.start < other.stop), default=0.0)
+            lines.append(f'{model};{detection.date};{detection.time};{detection.scientific_name};{detection.common_name};'
+                         f'{detection.confidence};{agreement}\n')
+    with open(ENSEMBLE_FILE, 'a') as rfile:
+        rfile.writelines(lines)
+
+
 def update_json_file(file: ParseFileName, detections: [Detection]):
     if file.RTSP_id is None:
         mask = f'{os.path.dirname(file.file_name)}/*.json'
@@ -294,76 +503,50 @@ def write_to_json_file(file: ParseFileName, detections: [Detection]):
 
 
 def apprise(file: ParseFileName, detections: [Detection]):
+    from .notifications import get_dispatcher, notification_messages
     species_apprised_this_run = []
     conf = get_settings()
 
+    messages = []
     for detection in detections:
         # Apprise of detection if not already alerted this run.
         if detection.species not in species_apprised_this_run:
             try:
-                sendAppriseNotifications(detection.scientific_name, detection.common_name, str(detection.confidence), str(detection.confidence_pct),
-                                         os.path.basename(detection.file_name_extr), detection.date, detection.time, str(detection.week),
-                                         conf['LATITUDE'], conf['LONGITUDE'], conf['CONFIDENCE'], conf['SENSITIVITY'], conf['OVERLAP'])
+                messages.extend(notification_messages(detection.scientific_name, detection.common_name, str(detection.confidence),
+                                                      str(detection.confidence_pct), os.path.basename(detection.file_name_extr),
+                                                      detection.date, detection.time, str(detection.week), conf['LATITUDE'],
+                                                      conf['LONGITUDE'], conf['CONFIDENCE'], conf['SENSITIVITY'], conf['OVERLAP']))
 
             except BaseException as e:
                 log.exception('Error during Apprise:', exc_info=e)
 
             species_apprised_this_run.append(detection.species)
 
+    # decided here, while the database holds what was detected up to this recording, sent from the dispatcher thread
+    if conf.get('APPRISE_ONE_MESSAGE_PER_RECORDING', '0') == '1' and messages:
+        get_dispatcher().submit(messages)
+    else:
+        for message in messages:
+            get_dispatcher().submit([message])
+
 
 def bird_weather(file: ParseFileName, detections: [Detection]):
     conf = get_settings()
     if conf['BIRDWEATHER_ID'] == "":
         return
     if detections:
+        # spooled here, encoded and posted by the uploader thread
+        from .birdweather import get_uploader
         try:
-            data, samplerate = soundfile.read(file.file_name)
-            buf = io.BytesIO()
-            soundfile.write(buf, data, samplerate, format='FLAC')
-            flac_data = buf.getvalue()
+            get_uploader().submit(file, detections, conf)
         except Exception as e:
-            log.error("Error during FLAC conversion: %s", e)
-            return
-
-        # POST soundscape to server
-        soundscape_url = (f'https://app.birdweather.com/api/v1/stations/'
-                          f'{conf["BIRDWEATHER_ID"]}/soundscapes?timestamp={file.iso8601}')
-
-        try:
-            response = requests.post(url=soundscape_url, data=flac_data, timeout=30,
-                                     headers={'Content-Type': 'audio/flac'})
-            log.info("Soundscape POST Response Status - %d", response.status_code)
-            sdata = response.json()
-        except BaseException as e:
-            log.error("Cannot POST soundscape: %s", e)
-            return
-        if not sdata.get('success'):
-            log.error(sdata.get('message'))
-            return
-        soundscape_id = sdata['soundscape']['id']
-
-        for detection in detections:
-            # POST detection to server
-            detection_url = f'https://app.birdweather.com/api/v1/stations/{conf["BIRDWEATHER_ID"]}/detections'
-
-            data = {'timestamp': detection.iso8601, 'lat': conf['LATITUDE'], 'lon': conf['LONGITUDE'],
-                    'soundscapeId': soundscape_id,
-                    'soundscapeStartTime': detection.start, 'soundscapeEndTime': detection.stop,
-                    'commonName': detection.common_name, 'scientificName': detection.scientific_name,
-                    'algorithm': '2p4' if conf['MODEL'] == 'BirdNET_GLOBAL_6K_V2.4_Model_FP16' else 'alpha',
-                    'confidence': detection.confidence}
-
-            log.debug(data)
-            try:
-                response = requests.post(detection_url, json=data, timeout=20)
-                log.info("Detection POST Response Status - %d", response.status_code)
-            except BaseException as e:
-                log.error("Cannot POST detection: %s", e)
+            log.error("Cannot spool BirdWeather upload: %s", e)
 
 
 def heartbeat():
     conf = get_settings()
     if conf['HEARTBEAT_URL']:
+        import requests
         try:
             result = requests.get(url=conf['HEARTBEAT_URL'], timeout=10)
             log.info('Heartbeat: %s', result.text)
@@ -0,0 +1,110 @@
+import datetime
+import fcntl
+import logging
+import os
+
+import numpy as np
+
+from .helpers import get_settings
+
+log = logging.getLogger(__name__)
+
+TOP_K = 10
+RECORD_DTYPE = np.dtype([
+    ('file', '<f8'),           # file_date of the recording (epoch seconds)
+    ('start', '<f8'),          # chunk start within the recording
+    ('duration', '<f4'),
+    ('stream', '<i2'),
+    ('human_rank', '<u2'),     # rank of the best human class, for the privacy filter
+    ('norm', '<f4'),           # see Basemodel.score_norm()
+    ('labels', '<u2', (TOP_K,)),
+    ('logits', '<f2', (TOP_K,)),
+])
+
+_stores = {}
+
+
+class ScoreStore:
+    """Top-k logits of every analyzed chunk, one file of fixed size records per day: enough to redo the detections."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def _day_file(self, day):
+        return os.path.join(self.path, f'{day:%Y-%m-%d}.bin')
+
+    def append(self, file_date, starts, duration, top, logits, norm, human_ranks, stream=0):
+        """Keep the logits of the top (N, TOP_K) label indices (Prediction.indices) of each chunk of a recording."""
+        top = np.asarray(top, dtype=int).reshape(len(logits), TOP_K)
+        records = np.zeros(len(logits), dtype=RECORD_DTYPE)
+        records['file'] = file_date.timestamp()
+        records['start'] = starts
+        records['duration'] = duration
+        records['stream'] = stream
+        records['human_rank'] = np.minimum(human_ranks, np.iinfo('<u2').max)
+        records['norm'] = norm
+        records['labels'] = top
+        records['logits'] = np.take_along_axis(logits, top, axis=1)
+
+        os.makedirs(self.path, exist_ok=True)
+        with open(self._day_file(file_date), 'ab') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            # a record cut short by a crash would shift every later one
+            f.truncate(f.tell() - f.tell() % RECORD_DTYPE.itemsize)
+            f.write(records.tobytes())
+
+    def read(self, day):
+        file_name = self._day_file(day)
+        if not os.path.exists(file_name):
+            return np.zeros(0, dtype=RECORD_DTYPE)
+        with open(file_name, 'rb') as f:
+            data = f.read()
+        return np.frombuffer(data[:len(data) - len(data) % RECORD_DTYPE.itemsize], dtype=RECORD_DTYPE)
+
+
+def get_score_store_path(model_name, conf=None):
+    if conf is None:
+        conf = get_settings()
+    base = conf.get('SCORES_DIR', '') or os.path.expanduser('~/BirdSongs/Scores')
+    return os.path.join(base, model_name)
+
+
+def get_score_store(model):
+    """The ScoreStore of model when SCORES=1, otherwise None."""
+    conf = get_settings()
+    if str(conf.get('SCORES', '0')) != '1':
+        return None
+    if model.model_name not in _stores:
+        _stores[model.model_name] = ScoreStore(get_score_store_path(model.model_name, conf))
+    return _stores[model.model_name]
+
+
+def rescore(records, model_name, labels, sensitivity, meta_model=None):
+    """Detections of stored records at the current settings (CONFIDENCE, PRIVACY_THRESHOLD, species lists), per recording.
+
+    Yields (file_date, stream, detections) without running the model: scores come from the stored logits at the given
+    sensitivity, the occurrence filter from meta_model (week tables are cached on disk, see MDataModel).
+    """
+    from .analysis import filter_humans, get_detections
+    from .models import scores_from_logits
+
+    conf = get_settings()
+    # records of one recording are written together
+    bounds = np.flatnonzero((np.diff(records['file']) != 0) | (np.diff(records['stream']) != 0)) + 1
+    for chunk in np.split(records, bounds):
+        if len(chunk) == 0:
+            continue
+        scores = scores_from_logits(model_name, chunk['logits'].astype('float32'), chunk['norm'], sensitivity)
+        predictions = []
+        for top, row in zip(chunk['labels'], scores):
+            order = np.argsort(-row, kind='stable')
+            predictions.append([(labels[i], score) for i, score in zip(top[order], row[order])])
+
+        file_date = datetime.datetime.fromtimestamp(chunk['file'][0])
+        raw = {f'{start};{start + duration}': p
+               for start, duration, p in zip(chunk['start'], chunk['duration'], filter_humans(predictions, chunk['human_rank']))}
+        species = []
+        if meta_model is not None:
+            meta_model.set_meta_data(conf.getfloat('LATITUDE'), conf.getfloat('LONGITUDE'), file_date.isocalendar()[1])
+            species = meta_model.get_species_list(labels)
+        yield file_date, int(chunk['stream'][0]), get_detections(file_date, raw, species)
@@ -0,0 +1,156 @@
+import functools
+import math
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+from .helpers import get_font
+
+# the extraction spectrograms: 2000x1000, the size of the matplotlib figure (10x5in @200 dpi) they replace
+WIDTH, HEIGHT = 2000, 1000
+DPI = 200
+FMIN, FMAX = 900, 14000
+# plasma, every 16th entry of the 256 of matplotlib: the interpolated LUT is within 5/255 of it
+PLASMA = ['#0d0887', '#310597', '#4c02a1', '#6600a7', '#7e03a8', '#9511a1', '#aa2395', '#bc3587', '#cc4778', '#d9586a',
+          '#e56b5d', '#f07f4f', '#f89441', '#fdab33', '#fdc328', '#f9dd25', '#f0f921']
+
+
+def _px(points):
+    return int(round(points * DPI / 72))
+
+
+TICK_FONT = _px(11)
+LABEL_FONT = _px(13)
+CBAR_LABEL_FONT = _px(12)
+MAJOR_TICK = _px(4)
+MINOR_TICK = _px(2)
+PAD = _px(4)
+
+
+@functools.lru_cache(maxsize=None)
+def colormap_lut():
+    anchors = np.array([[int(c[i:i + 2], 16) for i in (1, 3, 5)] for c in PLASMA], dtype='float64')
+    positions = np.linspace(0, 255, len(anchors))
+    return np.stack([np.interp(np.arange(256), positions, anchors[:, i]) for i in range(3)], axis=1).round().astype('uint8')
+
+
+@functools.lru_cache(maxsize=16)
+def load_font(path, size):
+    return ImageFont.truetype(path, size)
+
+
+def _text_size(draw, text, font):
+    left, top, right, bottom = draw.textbbox((0, 0), text, font=font)
+    return right - left, bottom - top, left, top
+
+
+def _vertical_text(text, font):
+    # rotated label, white on transparent
+    bbox = font.getbbox(text)
+    label = Image.new('LA', (bbox[2], bbox[3]), (255, 0))
+    ImageDraw.Draw(label).text((0, 0), text, fill=(255, 255), font=font)
+    return label.rotate(90, expand=True)
+
+
+def _ticks(step, lo, hi):
+    return [i * step for i in range(math.ceil(lo / step - 1e-9), math.floor(hi / step + 1e-9) + 1)]
+
+
+def _khz(value):
+    return f'{int(value / 1000)} kHz'
+
+
+@functools.lru_cache(maxsize=8)
+def layout(font_path):
+    """Plot and colorbar boxes (left, top, right, bottom) that leave room for the axis and colorbar labels."""
+    draw = ImageDraw.Draw(Image.new('RGB', (1, 1)))
+    tick_font, label_font = load_font(font_path, TICK_FONT), load_font(font_path, LABEL_FONT)
+    tick_w = max(_text_size(draw, _khz(v), tick_font)[0] for v in _ticks(1000, FMIN, FMAX))
+    label_h = _text_size(draw, 'Frequency (Hz)', label_font)[1]
+    left = PAD + label_h + 2 * PAD + tick_w + PAD + MAJOR_TICK
+    bottom = HEIGHT - (PAD + _text_size(draw, 'Time (s)', label_font)[1] + 2 * PAD + TICK_FONT + PAD + MAJOR_TICK)
+    top = _px(7)
+
+    # colorbar: 3.5% of the plot width, tick labels and the label to the right of it
+    cbar_label_w = CBAR_LABEL_FONT + 2 * PAD
+    cbar_tick_w = _text_size(draw, '-0.00', tick_font)[0] + MAJOR_TICK + PAD
+    cbar_right = WIDTH - PAD - cbar_label_w - cbar_tick_w
+    right = int((cbar_right - _px(3.6) + 0.035 * left) / 1.035)
+    cbar_left = cbar_right - int(0.035 * (right - left))
+    return (left, top, right, bottom), (cbar_left, top, cbar_right, bottom)
+
+
+@functools.lru_cache(maxsize=8)
+def chrome(duration, font_path):
+    """Everything around the spectrogram for clips of duration seconds: frame, ticks, labels and the colorbar."""
+    (left, top, right, bottom), (cb_left, cb_top, cb_right, cb_bottom) = layout(font_path)
+    img = Image.new('RGB', (WIDTH, HEIGHT), 'black')
+    draw = ImageDraw.Draw(img)
+    tick_font, label_font = load_font(font_path, TICK_FONT), load_font(font_path, LABEL_FONT)
+
+    def x_of(t):
+        return left + t / duration * (right - left)
+
+    def y_of(f):
+        return bottom - (f - FMIN) / (FMAX - FMIN) * (bottom - top)
+
+    for t in _ticks(0.1, 0, duration):
+        major = abs(t - round(t)) < 1e-6
+        x = round(x_of(t))
+        draw.line([(x, bottom), (x, bottom + (MAJOR_TICK if major else MINOR_TICK))], fill='white')
+        if major:
+            label = f'{round(t)}'
+            w, h, ox, oy = _text_size(draw, label, tick_font)
+            draw.text((x - w / 2 - ox, bottom + MAJOR_TICK + PAD - oy), label, fill='white', font=tick_font)
+    for f in _ticks(500, FMIN, FMAX):
+        major = f % 1000 == 0
+        y = round(y_of(f))
+        draw.line([(left - (MAJOR_TICK if major else MINOR_TICK), y), (left, y)], fill='white')
+        if major:
+            w, h, ox, oy = _text_size(draw, _khz(f), tick_font)
+            draw.text((left - MAJOR_TICK - PAD - w - ox, y - h / 2 - oy), _khz(f), fill='white', font=tick_font)
+
+    w, h, ox, oy = _text_size(draw, 'Time (s)', label_font)
+    draw.text(((left + right) / 2 - w / 2 - ox, HEIGHT - PAD - h - oy), 'Time (s)', fill='white', font=label_font)
+    ylabel = _vertical_text('Frequency (Hz)', label_font)
+    img.paste(ylabel, (PAD, round((top + bottom) / 2 - ylabel.height / 2)), ylabel)
+
+    # colorbar from vmin at the bottom to vmax at the top, its two tick labels are drawn per image
+    gradient = colormap_lut()[np.linspace(255, 0, cb_bottom - cb_top).round().astype(int)]
+    img.paste(Image.fromarray(np.repeat(gradient[:, np.newaxis], cb_right - cb_left, axis=1)), (cb_left, cb_top))
+    draw.rectangle([cb_left, cb_top, cb_right, cb_bottom], outline='white')
+    for y in (cb_top, cb_bottom):
+        draw.line([(cb_right, y), (cb_right + MAJOR_TICK, y)], fill='white')
+    cbar_label = _vertical_text('PCEN dB', load_font(font_path, CBAR_LABEL_FONT))
+    img.paste(cbar_label, (WIDTH - PAD - cbar_label.width, round((cb_top + cb_bottom) / 2 - cbar_label.height / 2)), cbar_label)
+    draw.rectangle([left - 1, top - 1, right, bottom], outline='white')
+    return img
+
+
+def render(matrix, duration, title, comment, font_path=None):
+    """The spectrogram image of a (bands, frames) matrix, lowest band at the bottom, colors scaled to its min and max."""
+    if font_path is None:
+        font_path = get_font()['path']
+    (left, top, right, bottom), (cb_left, cb_top, cb_right, cb_bottom) = layout(font_path)
+    img = chrome(round(duration, 3), font_path).copy()
+
+    vmin, vmax = float(np.min(matrix)), float(np.max(matrix))
+    # 256 equal bins like matplotlib's Normalize, vmax into the last one
+    scale = 256 / (vmax - vmin) if vmax > vmin else 0.0
+    indices = ((matrix[::-1] - vmin) * scale).clip(0, 255).astype('uint8')
+    spec = Image.fromarray(colormap_lut()[indices]).resize((right - left, bottom - top), Image.LANCZOS)
+    img.paste(spec, (left, top))
+
+    draw = ImageDraw.Draw(img)
+    tick_font = load_font(font_path, TICK_FONT)
+    for value, y in ((vmax, cb_top), (vmin, cb_bottom)):
+        w, h, ox, oy = _text_size(draw, f'{value:.2f}', tick_font)
+        draw.text((cb_right + MAJOR_TICK + PAD - ox, min(max(y - h / 2, 0), HEIGHT - h) - oy), f'{value:.2f}', fill='white', font=tick_font)
+
+    title_font = load_font(font_path, 13)
+    tw = draw.textbbox((0, 0), title, font=title_font)[2]
+    draw.text(((WIDTH - tw) / 2, 6), title, fill='white', font=title_font)
+    comment_font = load_font(font_path, 11)
+    ch = draw.textbbox((0, 0), comment, font=comment_font)[3]
+    draw.text((4, HEIGHT - ch - 4), comment, fill='white', font=comment_font)
+    return img
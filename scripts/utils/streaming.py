@@ -0,0 +1,182 @@
+import datetime
+import logging
+import os
+import socket
+import sys
+
+import numpy as np
+import soundfile
+
+from .analysis import apply_highpass_filter, filter_humans, get_detections, load_global_model, resample, _get_numeric_setting
+from .classes import ParseFileName
+from .embeddings import get_embedding_store
+from .scores import get_score_store
+from .helpers import get_settings
+
+log = logging.getLogger(__name__)
+
+# arecord -f S16_LE / ffmpeg -f s16le
+PCM_DTYPE = np.dtype('<i2')
+BLOCK_SECONDS = 0.5
+
+
+def open_pcm_source(source):
+    # '-' for stdin, tcp://host:port for a socket, anything else is a FIFO or file
+    if source == '-':
+        return sys.stdin.buffer
+    if source.startswith('tcp://'):
+        host, port = source[len('tcp://'):].rsplit(':', 1)
+        return socket.create_connection((host, int(port))).makefile('rb')
+    return open(source, 'rb')
+
+
+def read_pcm_blocks(stream, rate, channels=1, block_seconds=BLOCK_SECONDS):
+    """Yield mono float32 blocks of interleaved S16_LE PCM read from stream, until EOF."""
+    frame_bytes = channels * PCM_DTYPE.itemsize
+    block_bytes = int(rate * block_seconds) * frame_bytes
+    pending = b''
+    while True:
+        data = stream.read(block_bytes)
+        if not data:
+            break
+        data = pending + data
+        usable = len(data) - len(data) % frame_bytes
+        pending = data[usable:]
+        frames = np.frombuffer(data[:usable], dtype=PCM_DTYPE).reshape(-1, channels)
+        if channels > 1:
+            block = np.mean(frames, axis=1, dtype='float32')
+        else:
+            block = frames[:, 0].astype('float32')
+        # same scaling as soundfile uses for 16 bit PCM
+        block /= 32768.0
+        yield block
+
+
+class RingBuffer:
+    """The last capacity samples of a stream, addressed by absolute sample position."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._buf = np.zeros(capacity, dtype='float32')
+        self.end = 0
+
+    @property
+    def start(self):
+        return max(0, self.end - self.capacity)
+
+    def write(self, samples):
+        n = len(samples)
+        skip = max(0, n - self.capacity)
+        samples = samples[skip:]
+        pos = (self.end + skip) % self.capacity
+        first = min(len(samples), self.capacity - pos)
+        self._buf[pos:pos + first] = samples[:first]
+        self._buf[:len(samples) - first] = samples[first:]
+        self.end += n
+
+    def read(self, start, stop):
+        if start < self.start or stop > self.end:
+            raise IndexError(f'samples {start}-{stop} not in buffer ({self.start}-{self.end})')
+        pos = start % self.capacity
+        first = min(stop - start, self.capacity - pos)
+        return np.concatenate((self._buf[pos:pos + first], self._buf[:stop - start - first]))
+
+
+class StreamAnalyzer:
+    """Analyze a live PCM stream window by window, as soon as each window has filled.
+
+    A window is reported once the next one has been scored, so the privacy filter still sees both
+    neighbours. Only windows with detections are written to disk, as a short WAV segment in StreamData
+    that report() hands on to the regular reporting (extraction, DB, notifications).
+    """
+
+    def __init__(self, rate, report, start_time=None):
+        conf = get_settings()
+        self.model = load_global_model()
+        self.rate = rate
+        self.report = report
+        self.start_time = start_time if start_time is not None else datetime.datetime.now()
+        self.segment_dir = os.path.join(conf['RECS_DIR'], 'StreamData')
+        self.highpass_hz = _get_numeric_setting(conf, 'HIGHPASS_HZ', 0.0)
+
+        self.window = int(self.model.chunk_duration * rate)
+        self.step = int((self.model.chunk_duration - conf.getfloat('OVERLAP')) * rate)
+        try:
+            ex_len = conf.getint('EXTRACTION_LENGTH')
+        except ValueError:
+            ex_len = 6
+        # context around the window for the extracted clip, as in reporting.extract_safe
+        self.spacer = int(max(0, (ex_len - self.model.chunk_duration) / 2) * rate)
+        self.buffer = RingBuffer(2 * self.window + self.step + 2 * self.spacer)
+
+        self.next_window = 0
+        self.pending = []
+
+    def feed(self, samples):
+        # at most one step at a time, so a large block cannot overwrite windows that are still pending
+        for i in range(0, len(samples), self.step):
+            self.buffer.write(samples[i:i + self.step])
+            while self.next_window + self.window <= self.buffer.end:
+                self._analyze(self.next_window)
+                self.next_window += self.step
+
+    def close(self):
+        if self.pending:
+            self._finalize(len(self.pending) - 1)
+        self.pending = []
+
+    def _analyze(self, start):
+        chunk = self.buffer.read(start, start + self.window)
+        if self.highpass_hz > 0:
+            chunk = apply_highpass_filter(chunk, self.rate, self.highpass_hz)
+        if self.rate != self.model.sample_rate:
+            chunk = resample(chunk, self.rate, self.model.sample_rate)
+            samples = int(self.model.chunk_duration * self.model.sample_rate)
+            chunk = np.pad(chunk[:samples], (0, max(0, samples - len(chunk))))
+        embedding_store = get_embedding_store(self.model)
+        if embedding_store is not None:
+            logits, embeddings = self.model.predict_logits(chunk, embeddings=True)
+            chunk_time = self.start_time + datetime.timedelta(seconds=start / self.rate)
+            embedding_store.append([chunk_time.timestamp()], self.model.chunk_duration, embeddings)
+        else:
+            logits = self.model.predict_logits(chunk)
+        scores = self.model.scores(logits)
+        prediction, human_rank = self.model.top_k(scores[0]), self.model.human_ranks(scores)[0]
+
+        score_store = get_score_store(self.model)
+        if score_store is not None:
+            # the whole stream counts as one recording, starting at start_time
+            score_store.append(self.start_time, [start / self.rate], self.model.chunk_duration, [prediction.indices], logits,
+                               self.model.score_norm(logits), [human_rank])
+
+        self.pending.append((start, prediction, human_rank))
+        if len(self.pending) >= 2:
+            self._finalize(len(self.pending) - 2)
+        del self.pending[:-2]
+
+    def _finalize(self, idx):
+        conf = get_settings()
+        start = self.pending[idx][0]
+        prediction = filter_humans([p for _, p, _ in self.pending], [r for _, _, r in self.pending])[idx]
+
+        seg_start = max(self.buffer.start, start - self.spacer)
+        seg_stop = min(self.buffer.end, start + self.window + self.spacer)
+        seg_time = self.start_time + datetime.timedelta(seconds=seg_start / self.rate)
+        # windows less than a second apart (OVERLAP > chunk length - 1) would share a name: numbered after the window
+        file_name = os.path.join(self.segment_dir, f'{seg_time:%Y-%m-%d}-birdnet-W{start // self.step}-{seg_time:%H:%M:%S}.wav')
+        file = ParseFileName(file_name)
+
+        # offsets relative to the whole second the segment file is named after
+        offset = (self.start_time + datetime.timedelta(seconds=start / self.rate) - file.file_date).total_seconds()
+        time_slot = f'{offset};{offset + self.model.chunk_duration}'
+        self.model.set_meta_data(conf.getfloat('LATITUDE'), conf.getfloat('LONGITUDE'), file.week)
+        detections = get_detections(file.file_date, {time_slot: prediction}, self.model.get_species_list())
+        if not detections:
+            return
+
+        # leading silence so positions in the file line up with file_date
+        lead = np.zeros(int(round((seg_time - file.file_date).total_seconds() * self.rate)), dtype='float32')
+        os.makedirs(self.segment_dir, exist_ok=True)
+        soundfile.write(file_name, np.concatenate((lead, self.buffer.read(seg_start, seg_stop))), self.rate, subtype='PCM_16')
+        log.debug('wrote %s for %d detections', file_name, len(detections))
+        self.report(file, detections)
@@ -1,11 +1,21 @@
 import os
+import subprocess
+import sys
+import tempfile
 import unittest
+from types import SimpleNamespace
 from unittest.mock import patch
 
-from scripts.utils.analysis import run_analysis, _get_numeric_setting
+import librosa
+import numpy as np
+import soundfile
+
+from scripts.utils.analysis import run_analysis, decode_audio, load_audio, load_ensemble_model, readAudioData, resample, splitSignal, \
+    _get_numeric_setting
 from scripts.utils.classes import ParseFileName
 from tests.helpers import TESTDATA, Settings
-from scripts.utils.analysis import filter_humans
+from scripts.utils.analysis import filter_humans, get_class_filter, get_detections
+from scripts.utils.models import Prediction, rank_of_best
 
 
 class DummyConf:
@@ -58,6 +68,134 @@ class TestRunAnalysis(unittest.TestCase):
             self.assertEqual(det.scientific_name, expected['sci_name'])
 
 
+class FakeEnsembleModel:
+    """A 32 kHz model with 5s windows that is sure about Pica pica in every window."""
+    model_name = 'Perch_v2'
+    sample_rate = 32000
+    chunk_duration = 5.0
+
+    def __init__(self):
+        self.labels = ['Pica pica'] + [f'Species {i}' for i in range(1, 19)] + ['Human vocal']
+        self.human_indices = np.array([19])
+        self.chunks = None
+
+    def set_meta_data(self, lat, lon, week):
+        pass
+
+    def get_species_list(self):
+        return []
+
+    def predict_logits(self, chunks):
+        self.chunks = chunks
+        logits = np.full((len(chunks), len(self.labels)), 0.01, dtype='float32')
+        logits[:, 0] = 0.95
+        logits[:, 19] = 0.0
+        return logits
+
+    def scores(self, logits):
+        return logits
+
+    def score_norm(self, logits):
+        return np.zeros(len(logits), dtype='float32')
+
+    def top_k(self, scores, k=10):
+        return Prediction(scores, self.labels, k, self.human_indices)
+
+    def human_ranks(self, scores):
+        return rank_of_best(scores, self.human_indices)
+
+
+class TestEnsemble(unittest.TestCase):
+
+    def setUp(self):
+        source = os.path.join(TESTDATA, 'Pica pica_30s.wav')
+        self.test_file = os.path.join(TESTDATA, '2024-02-24-birdnet-16:19:37.wav')
+        if os.path.exists(self.test_file):
+            os.unlink(self.test_file)
+        os.symlink(source, self.test_file)
+        self.addCleanup(os.unlink, self.test_file)
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.ensemble_file = os.path.join(tmp.name, 'BirdDB_ensemble.txt')
+        self.settings = settings = Settings.with_defaults()
+        settings['ENSEMBLE_MODEL'] = FakeEnsembleModel.model_name
+        self.ensemble = FakeEnsembleModel()
+        for target, kwargs in [('scripts.utils.helpers._load_settings', {'return_value': settings}),
+                               ('scripts.utils.analysis.loadCustomSpeciesList', {'return_value': []}),
+                               ('scripts.utils.analysis.ENSEMBLE', {'new': self.ensemble}),
+                               ('scripts.utils.reporting.ENSEMBLE_FILE', {'new': self.ensemble_file})]:
+            patcher = patch(target, **kwargs)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_shared_decode(self):
+        with patch('scripts.utils.analysis.decode_audio', wraps=decode_audio) as mock_decode:
+            chunks, ensemble_chunks = load_audio(ParseFileName(self.test_file))
+        mock_decode.assert_called_once()
+        self.assertEqual(chunks.shape, (10, 144000))
+        self.assertEqual(ensemble_chunks.shape, (6, 160000))
+
+    def test_each_model_resampled_from_the_file(self):
+        # MODEL at 32 kHz, the ensemble model at the 48 kHz of the file: not resampled at all
+        birdnet = SimpleNamespace(sample_rate=48000, chunk_duration=3.0)
+        with patch('scripts.utils.analysis.load_global_model', return_value=self.ensemble), \
+                patch('scripts.utils.analysis.ENSEMBLE', birdnet), \
+                patch('scripts.utils.analysis.resample', wraps=resample) as mock_resample:
+            chunks, ensemble_chunks = load_audio(ParseFileName(self.test_file))
+        self.assertEqual([c.args[1:] for c in mock_resample.call_args_list], [(48000, 32000), (48000, 48000)])
+        self.assertEqual(chunks.shape, (6, 160000))
+        np.testing.assert_array_equal(ensemble_chunks, readAudioData(self.test_file, 0.0, 48000, 3.0))
+
+    def test_unknown_model_reported_once(self):
+        with patch('scripts.utils.analysis.ENSEMBLE', None), patch('scripts.utils.analysis._ensemble_failed', None), \
+                patch.dict(self.settings, {'ENSEMBLE_MODEL': 'No_such_model'}):
+            with self.assertLogs('scripts.utils.analysis', 'ERROR') as logs:
+                self.assertIsNone(load_ensemble_model())
+                self.assertIsNone(load_ensemble_model())
+        self.assertEqual(len([r for r in logs.records if r.levelname == 'ERROR']), 1)
+
+    def test_provenance(self):
+        detections = run_analysis(ParseFileName(self.test_file))
+        # only the detections of MODEL are reported
+        self.assertEqual([d.scientific_name for d in detections], ['Pica pica'] * 3)
+        self.assertEqual(len(self.ensemble.chunks), 6)
+
+        with open(self.ensemble_file) as f:
+            lines = [line.strip().split(';') for line in f]
+        models = [line[0] for line in lines]
+        self.assertEqual(models, ['BirdNET_GLOBAL_6K_V2.4_Model_FP16'] * 3 + ['Perch_v2'] * 6)
+        self.assertEqual({line[3] for line in lines}, {'Pica pica'})
+        # every BirdNET window overlaps a Perch one
+        self.assertEqual([float(line[6]) for line in lines[:3]], [0.95] * 3)
+        # the last Perch window (25-30s) has no BirdNET detection above CONFIDENCE
+        self.assertEqual(float(lines[-1][6]), 0.0)
+
+    def test_birdnet_next_to_a_model_without_meta_model(self):
+        with patch('scripts.utils.analysis.load_global_model', return_value=self.ensemble), \
+                patch('scripts.utils.analysis.ENSEMBLE', None), patch('scripts.utils.analysis._ensemble_failed', None), \
+                patch.dict(self.settings, {'MODEL': 'Perch_v2', 'ENSEMBLE_MODEL': 'BirdNET_GLOBAL_6K_V2.4_Model_FP16'}):
+            detections = run_analysis(ParseFileName(self.test_file))
+        self.assertEqual([d.scientific_name for d in detections], ['Pica pica'] * 6)
+        with open(self.ensemble_file) as f:
+            models = [line.split(';')[0] for line in f]
+        self.assertEqual(models, ['Perch_v2'] * 6 + ['BirdNET_GLOBAL_6K_V2.4_Model_FP16'] * 3)
+
+    def test_failed_ensemble_keeps_the_detections(self):
+        with patch.object(self.ensemble, 'predict_logits', side_effect=RuntimeError('invoke failed')):
+            with self.assertLogs('scripts.utils.analysis', 'ERROR'):
+                detections = run_analysis(ParseFileName(self.test_file))
+        self.assertEqual([d.scientific_name for d in detections], ['Pica pica'] * 3)
+
+    def test_model_that_fails_to_load_reported_once(self):
+        with patch('scripts.utils.analysis.ENSEMBLE', None), patch('scripts.utils.analysis._ensemble_failed', None), \
+                patch('scripts.utils.analysis.get_model', side_effect=ValueError('no such file')) as mock_get_model:
+            with self.assertLogs('scripts.utils.analysis', 'ERROR'):
+                self.assertIsNone(load_ensemble_model())
+                self.assertIsNone(load_ensemble_model())
+        mock_get_model.assert_called_once()
+
+
 class TestHighPassConfig(unittest.TestCase):
 
     def test_dict_conf_uses_default(self):
@@ -69,6 +207,71 @@ class TestHighPassConfig(unittest.TestCase):
         self.assertEqual(_get_numeric_setting(DummyConf('invalid'), 'HIGHPASS_HZ', 120.0), 120.0)
 
 
+class TestDecodeAudio(unittest.TestCase):
+
+    def setUp(self):
+        self.source = os.path.join(TESTDATA, 'Pica pica_30s.wav')
+
+    def test_native_rate_matches_librosa(self):
+        sig, rate = decode_audio(self.source, 48000)
+        expected, _ = librosa.load(self.source, sr=48000, mono=True)
+        self.assertEqual(rate, 48000)
+        self.assertEqual(sig.dtype, np.float32)
+        np.testing.assert_array_equal(sig, expected)
+
+    def test_resample(self):
+        sig, rate = decode_audio(self.source, 32000)
+        self.assertEqual(rate, 32000)
+        self.assertEqual(sig.dtype, np.float32)
+        self.assertEqual(len(sig), 30 * 32000)
+
+    def test_stereo_downmix(self):
+        left = np.linspace(-0.5, 0.5, 4800, dtype='float32')
+        with tempfile.NamedTemporaryFile(suffix='.wav') as tmp:
+            soundfile.write(tmp.name, np.stack([left, np.zeros_like(left)], axis=1), 48000, subtype='FLOAT')
+            sig, _ = decode_audio(tmp.name, 48000)
+        np.testing.assert_allclose(sig, left / 2)
+
+
+class TestSplitSignal(unittest.TestCase):
+
+    @staticmethod
+    def reference_split(sig, rate, overlap, seconds=3.0, minlen=1.5):
+        sig_splits = []
+        for i in range(0, len(sig), int((seconds - overlap) * rate)):
+            split = sig[i:i + int(seconds * rate)]
+            if len(split) < int(minlen * rate):
+                break
+            if len(split) < int(rate * seconds):
+                temp = np.zeros((int(rate * seconds)))
+                temp[:len(split)] = split
+                split = temp
+            sig_splits.append(split)
+        return np.array(sig_splits, dtype='float32').reshape(-1, int(seconds * rate))
+
+    def test_matches_reference(self):
+        rate = 100
+        for length in [0, 100, 149, 150, 300, 1500, 1580, 1650]:
+            for overlap in [0.0, 0.5, 1.5, 2.9]:
+                sig = np.random.default_rng(length).standard_normal(length).astype('float32')
+                chunks = splitSignal(sig, rate, overlap)
+                expected = self.reference_split(sig, rate, overlap)
+                self.assertEqual(chunks.dtype, np.float32)
+                np.testing.assert_array_equal(chunks, expected, err_msg=f'length={length} overlap={overlap}')
+
+    def test_full_windows_are_views(self):
+        sig = np.arange(1500, dtype='float32')
+        chunks = splitSignal(sig, 100, 1.0)
+        self.assertTrue(np.shares_memory(chunks, sig))
+        self.assertFalse(chunks.flags.writeable)
+
+    def test_float64_is_converted(self):
+        sig = np.linspace(-1, 1, 1500)
+        chunks = splitSignal(sig, 100, 0.0)
+        self.assertEqual(chunks.shape, (5, 300))
+        self.assertEqual(chunks.dtype, np.float32)
+
+
 class TestFilterHumans(unittest.TestCase):
 
     @patch('scripts.utils.helpers._load_settings')
@@ -216,5 +419,110 @@ class TestFilterHumans(unittest.TestCase):
         self.assertEqual(result, expected)
 
 
+class TestFilterHumansScoreMatrix(unittest.TestCase):
+    labels = ['Bird_A', 'Bird_B', 'Bird_C', 'Bird_D', 'Human_Human'] + [f'Bird_{i}' for i in range(20)]
+    human_indices = np.array([4])
+    HUMAN = [('Human_Human', 0.0)]
+
+    def filter(self, rows):
+        # every bird gets a small background score, humans none, unless set by the row
+        scores = np.full((len(rows), len(self.labels)), 0.01, dtype='float32')
+        scores[:, self.human_indices] = 0.0
+        for scores_row, row in zip(scores, rows):
+            scores_row[:len(row)] = row
+        predictions = [Prediction(row, self.labels, 10, self.human_indices) for row in scores]
+        result = filter_humans(predictions, rank_of_best(scores, self.human_indices))
+        return [r if r == self.HUMAN else [name for name, _ in r[:2]] for r in result]
+
+    @patch('scripts.utils.helpers._load_settings')
+    def test_no_human(self, mock_load_settings):
+        mock_load_settings.return_value = Settings.with_defaults()
+        result = self.filter([[0.9, 0.8], [0.6, 0.7]])
+        self.assertEqual(result, [['Bird_A', 'Bird_B'], ['Bird_B', 'Bird_A']])
+
+    @patch('scripts.utils.helpers._load_settings')
+    def test_empty(self, mock_load_settings):
+        mock_load_settings.return_value = Settings.with_defaults()
+        self.assertEqual(self.filter([]), [])
+
+    @patch('scripts.utils.helpers._load_settings')
+    def test_human_neighbour(self, mock_load_settings):
+        mock_load_settings.return_value = Settings.with_defaults()
+        result = self.filter([
+            [0.9, 0.8],
+            [0.0, 0.0, 0.9, 0.8],
+            [0.0, 0.0, 0.7, 0.0, 0.95],
+            [0.0, 0.6, 0.0, 0.5],
+            [0.9, 0.8],
+        ])
+        self.assertEqual(result, [['Bird_A', 'Bird_B'], self.HUMAN, self.HUMAN, self.HUMAN, ['Bird_A', 'Bird_B']])
+
+    @patch('scripts.utils.helpers._load_settings')
+    def test_deep_human_respects_threshold(self, mock_load_settings):
+        # Human ranked 11th: outside the default cutoff of 10, inside the 60 of PRIVACY_THRESHOLD=1
+        rows = [[0.5] * 4 + [0.1] + [0.5] * 6, [0.9, 0.8]]
+        settings = Settings.with_defaults()
+        mock_load_settings.return_value = settings
+        self.assertEqual(self.filter(rows), [['Bird_A', 'Bird_B'], ['Bird_A', 'Bird_B']])
+
+        settings['PRIVACY_THRESHOLD'] = 1
+        self.assertEqual(self.filter(rows), [self.HUMAN, self.HUMAN])
+
+
+class TestGetDetections(unittest.TestCase):
+    labels = ['Pica pica', 'Corvus corone', 'Garrulus glandarius', 'Sturnus vulgaris'] + [f'Species {i}' for i in range(20)]
+    lists = {'include': [], 'exclude': ['Corvus corone'], 'whitelist': ['Garrulus glandarius']}
+    file_date = ParseFileName('2024-02-24-birdnet-16:19:37.wav').file_date
+
+    def setUp(self):
+        patcher = patch('scripts.utils.helpers._load_settings', return_value=Settings.with_defaults())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch('scripts.utils.analysis.loadCustomSpeciesList',
+                        side_effect=lambda path: next(v for k, v in self.lists.items() if k in os.path.basename(path)))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def detections(self, rows, predicted):
+        scores = np.full((len(rows), len(self.labels)), 0.01, dtype='float32')
+        for scores_row, row in zip(scores, rows):
+            scores_row[:len(row)] = row
+        raw = {f'{3 * i}.0;{3 * i + 3}.0': Prediction(row, self.labels) for i, row in enumerate(scores)}
+        # the same through the (name, score) path used for privacy filtered and legacy predictions
+        legacy = {slot: list(prediction) for slot, prediction in raw.items()}
+        result = [(d.start, d.scientific_name, d.confidence) for d in get_detections(self.file_date, raw, predicted)]
+        self.assertEqual(result, [(d.start, d.scientific_name, d.confidence) for d in get_detections(self.file_date, legacy, predicted)])
+        return result
+
+    def test_lists_and_occurrence(self):
+        rows = [[0.9, 0.8, 0.75, 0.72], [0.5, 0.95, 0.0, 0.0]]
+        with self.assertLogs('scripts.utils.analysis', level='DEBUG') as logs:
+            result = self.detections(rows, frozenset(['Pica pica', 'Corvus corone']))
+        # Corvus is excluded, Sturnus is not expected this week, Garrulus is whitelisted
+        self.assertEqual(result, [(0.0, 'Pica pica', 0.9), (0.0, 'Garrulus glandarius', 0.75)])
+        self.assertIn('Excluded 3 predictions: Corvus corone (in EXCLUDE_LIST) x2', logs.output[-1])
+
+    def test_include_list(self):
+        self.lists = dict(self.lists, include=['Sturnus vulgaris'])
+        result = self.detections([[0.9, 0.8, 0.75, 0.72]], [])
+        self.assertEqual(result, [(0.0, 'Sturnus vulgaris', 0.72)])
+
+    def test_class_filter_cached(self):
+        first = get_class_filter(self.labels, frozenset(['Pica pica']), [], ['Corvus corone'], [])
+        self.assertIs(get_class_filter(self.labels, frozenset(['Pica pica']), [], ['Corvus corone'], []), first)
+        self.assertEqual(list(first[:4]), [0, 2, 3, 3])
+        self.assertIsNot(get_class_filter(self.labels, frozenset(['Pica pica']), [], [], []), first)
+
+
+class TestLazyImports(unittest.TestCase):
+
+    def test_analysis_and_reporting_defer_heavy_modules(self):
+        code = ('import sys; import scripts.utils.analysis, scripts.utils.reporting; '
+                'print(sorted(m for m in ["scipy.signal", "librosa", "matplotlib", "PIL", "requests", "apprise"] if m in sys.modules))')
+        result = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.dirname(__file__)),
+                                capture_output=True, text=True, check=True)
+        self.assertEqual(result.stdout.strip(), '[]')
+
+
 if __name__ == '__main__':
     unittest.main()
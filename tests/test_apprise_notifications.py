@@ -1,12 +1,14 @@
 import os
 import sqlite3
+import threading
 import unittest
 from datetime import datetime
 from unittest.mock import patch
 
 from scripts.utils import db
 from scripts.utils import notifications
-from scripts.utils.notifications import sendAppriseNotifications
+from scripts.utils.notifications import ImageCache, NotificationDispatcher, notification_messages, read_body, send_notification, \
+    sendAppriseNotifications
 
 from tests.helpers import Settings
 
@@ -15,6 +17,7 @@ class TestAppriseNotifications(unittest.TestCase):
 
     def setUp(self):
         db.DB_PATH = self.db_file
+        db._COUNTS = None
 
     @classmethod
     def setUpClass(cls):
@@ -188,6 +191,83 @@ class TestAppriseNotifications(unittest.TestCase):
         sendAppriseNotifications(**self.get_default_params())
         self.assertEqual(mock_notify.call_count, 1)
 
+    @patch('scripts.utils.helpers._load_settings')
+    @patch('scripts.utils.notifications.notify')
+    def test_one_message_for_several_species(self, mock_notify, mock_load_settings):
+        self.create_test_db()
+        self.create_apprise_config()
+        settings_dict = Settings.with_defaults()
+        settings_dict["APPRISE_NOTIFY_EACH_DETECTION"] = "1"
+        mock_load_settings.return_value = settings_dict
+        messages = notification_messages(**self.get_default_params())
+        messages += notification_messages(**dict(self.get_default_params(), sci_name="Pica pica", com_name="Eurasian Magpie"))
+
+        send_notification(messages)
+        self.assertEqual(mock_notify.call_count, 1)
+        self.assertEqual(mock_notify.call_args[0][0].split("\n\n"), [
+            "A Great Crested Flycatcher (Myiarchus crinitus) was just detected with a confidence of 91 (detection)",
+            "A Eurasian Magpie (Pica pica) was just detected with a confidence of 91 (detection)"])
+        self.assertEqual(mock_notify.call_args[0][1], "New backyard bird!")
+
+    @patch('scripts.utils.helpers._load_settings')
+    @patch('scripts.utils.notifications.notify')
+    def test_dispatcher(self, mock_notify, mock_load_settings):
+        self.create_test_db()
+        self.create_apprise_config()
+        settings_dict = Settings.with_defaults()
+        settings_dict["APPRISE_NOTIFY_EACH_DETECTION"] = "1"
+        mock_load_settings.return_value = settings_dict
+        dispatcher = NotificationDispatcher(queue_size=1)
+        dispatcher.submit(notification_messages(**self.get_default_params()))
+        dispatcher.close()
+        self.assertEqual(mock_notify.call_count, 1)
+
+    def test_dispatcher_logs_and_goes_on(self):
+        sending = threading.Event()
+        release = threading.Event()
+
+        def send(messages):
+            sending.set()
+            release.wait()
+            if messages == ['broken']:
+                raise RuntimeError('provider down')
+
+        with patch('scripts.utils.notifications.send_notification', side_effect=send) as mock_send:
+            dispatcher = NotificationDispatcher(queue_size=1)
+            with self.assertLogs('scripts.utils.notifications', 'WARNING') as logs:
+                dispatcher.submit(['broken'])
+                sending.wait(5)
+                dispatcher.submit(['queued'])
+                dispatcher.submit(['dropped'])
+                release.set()
+                dispatcher.close()
+        self.assertEqual([c.args[0] for c in mock_send.call_args_list], [['broken'], ['queued']])
+        self.assertEqual([r.levelname for r in logs.records], ['WARNING', 'ERROR'])
+
+    def test_body_read_again_when_changed(self):
+        self.create_apprise_config()
+        self.assertIn('$comname', read_body())
+        with open(self.apprise_body_file, 'w') as f:
+            f.write('$comname: $reason')
+        os.utime(self.apprise_body_file, ns=(0, 0))
+        self.assertEqual(read_body(), '$comname: $reason')
+
+
+class TestImageCache(unittest.TestCase):
+
+    def test_lru_with_ttl(self):
+        now = [0]
+        cache = ImageCache(maxsize=2, ttl=10, clock=lambda: now[0])
+        cache.put('a', 'url a')
+        cache.put('b', 'url b')
+        self.assertEqual(cache.get('a'), 'url a')
+        # b is the least recently used
+        cache.put('c', 'url c')
+        self.assertEqual([cache.get(k) for k in 'abc'], ['url a', None, 'url c'])
+        now[0] = 11
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache.entries), 1)
+
 
 if __name__ == '__main__':
     unittest.main()
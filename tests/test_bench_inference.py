@@ -0,0 +1,26 @@
+import json
+import unittest
+
+from benchmarks.bench_inference import MODELS, STAGES, run
+
+
+class TestBenchInference(unittest.TestCase):
+
+    def test_all_models_with_fake_interpreter(self):
+        report = run(repeat=1)
+
+        self.assertEqual(report['interpreter'], 'fake')
+        self.assertEqual([(r['model'], r['input']) for r in report['results']],
+                         [(model, name) for model in MODELS for name in ['Pica pica_30s.wav', 'noise_30s.wav']])
+        for result in report['results']:
+            self.assertEqual(list(result['stages']), STAGES)
+            self.assertEqual(result['chunks'], 6 if result['model'] == 'Perch_v2' else 10)
+        json.dumps(report)
+
+    def test_deterministic(self):
+        first, second = run(['BirdNET_GLOBAL_6K_V2.4_Model_FP16'], repeat=1), run(['BirdNET_GLOBAL_6K_V2.4_Model_FP16'], repeat=1)
+        self.assertEqual([r['detections'] for r in first['results']], [r['detections'] for r in second['results']])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+import os
+import sys
+import tempfile
+import threading
+import unittest
+from queue import Queue
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'scripts'))
+
+import birdnet_analysis  # noqa: E402
+from birdnet_analysis import ANALYSIS_QUEUE_SIZE, DECODE_QUEUE_SIZE, AnalysisPipeline, AnalysisWorkerPool  # noqa: E402
+
+
+def echo_worker(file_queue, result_queue):
+    # stands in for analysis_worker in the spawned processes: reports which worker got each file
+    while True:
+        file_name = file_queue.get()
+        if file_name is None:
+            break
+        if file_name == 'die':
+            os._exit(1)
+        result_queue.put((file_name, os.getpid()))
+    result_queue.put(None)
+
+
+def dead_worker(file_queue, result_queue):
+    # as when load_global_model() raises
+    raise RuntimeError('no model')
+
+
+def reports(report_queue):
+    results = []
+    while (msg := report_queue.get(timeout=60)) is not None:
+        results.append(msg)
+    return results
+
+
+def wait_for(condition):
+    for _ in range(500):
+        if condition():
+            return
+        threading.Event().wait(0.01)
+    raise AssertionError('timed out')
+
+
+class TestAnalysisPipeline(unittest.TestCase):
+
+    def setUp(self):
+        birdnet_analysis.shutdown = False
+        self.addCleanup(setattr, birdnet_analysis, 'shutdown', False)
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.files = []
+        for second in range(12):
+            file_name = os.path.join(tmp.name, f'2024-02-24-birdnet-16:19:{second:02d}.wav')
+            with open(file_name, 'wb') as f:
+                f.write(b'RIFF')
+            self.files.append(file_name)
+        self.addCleanup(patch.stopall)
+        patch('birdnet_analysis.load_global_model').start()
+        patch('birdnet_analysis.load_ensemble_model').start()
+        patch('birdnet_analysis.ANALYZING_NOW', os.path.join(tmp.name, 'analyzing_now.txt')).start()
+        self.load_audio = patch('birdnet_analysis.load_audio', side_effect=lambda file: f'audio of {file.file_name}').start()
+        self.report_queue = Queue()
+
+    def run_analysis(self, side_effect):
+        return patch('birdnet_analysis.run_analysis', side_effect=side_effect).start()
+
+    def test_files_reported_in_order(self):
+        self.run_analysis(lambda file, audio_data: [audio_data])
+        pipeline = AnalysisPipeline(self.report_queue)
+        for file_name in self.files:
+            pipeline.submit(file_name)
+        pipeline.close()
+
+        results = reports(self.report_queue)
+        self.assertEqual([file.file_name for file, _ in results], self.files)
+        self.assertEqual([detections for _, detections in results], [[f'audio of {file_name}'] for file_name in self.files])
+
+    def test_slow_analysis_holds_back_decoding(self):
+        release = threading.Event()
+        self.run_analysis(lambda file, audio_data: release.wait() and [])
+        pipeline = AnalysisPipeline(self.report_queue)
+        self.assertEqual(pipeline.decode_queue.maxsize, DECODE_QUEUE_SIZE)
+        submitter = threading.Thread(target=lambda: [pipeline.submit(file_name) for file_name in self.files])
+        submitter.start()
+
+        # one file in analysis, a full analysis queue, one decoded file waiting for room, a full decode queue
+        decoded = 1 + ANALYSIS_QUEUE_SIZE + 1
+        wait_for(lambda: self.load_audio.call_count == decoded and pipeline.decode_queue.full())
+        threading.Event().wait(0.2)
+        self.assertEqual(self.load_audio.call_count, decoded)
+        self.assertTrue(submitter.is_alive())
+
+        release.set()
+        submitter.join()
+        pipeline.close()
+        self.assertEqual(len(reports(self.report_queue)), len(self.files))
+
+    def test_shutdown_leaves_the_rest(self):
+        def stop(file, audio_data):
+            birdnet_analysis.shutdown = True
+            return []
+        self.run_analysis(stop)
+        pipeline = AnalysisPipeline(self.report_queue)
+        for file_name in self.files:
+            pipeline.submit(file_name)
+        pipeline.close()
+
+        # the None signal still reaches the reporting queue
+        self.assertEqual([file.file_name for file, _ in reports(self.report_queue)], self.files[:1])
+        self.assertLessEqual(self.load_audio.call_count, 1 + ANALYSIS_QUEUE_SIZE + 1)
+        # picked up as backlog on the next start
+        self.assertTrue(all(os.path.exists(file_name) for file_name in self.files))
+
+
+class TestAnalysisWorkerPool(unittest.TestCase):
+
+    def setUp(self):
+        birdnet_analysis.shutdown = False
+        self.addCleanup(setattr, birdnet_analysis, 'shutdown', False)
+        self.report_queue = Queue()
+
+    def test_worker_for(self):
+        pool = AnalysisWorkerPool.__new__(AnalysisWorkerPool)
+        pool.file_queues = [None, None]
+        self.assertEqual([pool.worker_for(name) for name in ['2024-02-24-birdnet-RTSP_0-16:19:37.wav', '2024-02-24-birdnet-RTSP_3-16:19:37.wav',
+                                                             '2024-02-24-birdnet-16:19:37.wav']], [0, 1, 0])
+
+    def test_streams_in_order_on_their_worker(self):
+        pool = AnalysisWorkerPool(self.report_queue, 2, target=echo_worker)
+        files = [f'2024-02-24-birdnet-RTSP_{stream}-16:19:{second:02d}.wav' for second in range(0, 30, 3) for stream in (0, 1)]
+        for file_name in files:
+            pool.submit(file_name)
+        pool.close()
+
+        results = reports(self.report_queue)
+        for stream in ('RTSP_0', 'RTSP_1'):
+            names = [name for name, _ in results if stream in name]
+            self.assertEqual(names, [name for name in files if stream in name])
+            self.assertEqual(len({pid for name, pid in results if stream in name}), 1)
+        self.assertFalse(birdnet_analysis.shutdown)
+
+    def test_dead_worker_stops_instead_of_hanging(self):
+        pool = AnalysisWorkerPool(self.report_queue, 1, target=dead_worker)
+        with self.assertLogs('birdnet_analysis', 'ERROR'):
+            # more than its queue holds
+            for second in range(10):
+                pool.submit(f'2024-02-24-birdnet-16:19:{second:02d}.wav')
+            pool.close()
+        self.assertEqual(reports(self.report_queue), [])
+        self.assertTrue(birdnet_analysis.shutdown)
+
+    def test_worker_dying_mid_run(self):
+        pool = AnalysisWorkerPool(self.report_queue, 2, target=echo_worker)
+        with self.assertLogs('birdnet_analysis', 'ERROR'):
+            pool.submit('2024-02-24-birdnet-RTSP_1-16:19:00.wav')
+            pool.file_queues[0].put('die')
+            for second in range(10):
+                pool.submit(f'2024-02-24-birdnet-RTSP_0-16:19:{second:02d}.wav')
+            pool.close()
+        # the other worker finished its file
+        self.assertEqual([name for name, _ in reports(self.report_queue)], ['2024-02-24-birdnet-RTSP_1-16:19:00.wav'])
+        self.assertTrue(birdnet_analysis.shutdown)
+
+
+if __name__ == '__main__':
+    unittest.main()
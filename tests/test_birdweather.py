@@ -0,0 +1,186 @@
+import datetime
+import io
+import json
+import os
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+
+import soundfile
+
+from scripts.utils.birdweather import BirdWeatherUploader, RateLimiter
+from scripts.utils.classes import Detection, ParseFileName
+from scripts.utils.reporting import bird_weather
+from tests.helpers import TESTDATA, Settings
+
+
+class StationHandler(BaseHTTPRequestHandler):
+    # keep-alive, so a reused connection shows up as a single client port
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        server = self.server
+        server.requests.append((self.path, self.headers['Content-Type'], body, self.client_address[1]))
+        status = server.statuses.pop(0) if server.statuses else 200
+        if status >= 400:
+            reply = {'success': False, 'message': 'rejected'}
+        elif self.path.split('?')[0].endswith('/soundscapes'):
+            reply = {'success': True, 'soundscape': {'id': 42}}
+        else:
+            reply = {'success': True}
+        data = json.dumps(reply).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestBirdWeatherUploader(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StationHandler)
+        self.server.requests = []
+        self.server.statuses = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/api/v1/stations'
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.spool = os.path.join(tmp.name, 'BirdWeather')
+        self.recording = os.path.join(tmp.name, '2024-02-24-birdnet-16:19:37.wav')
+        data, rate = soundfile.read(os.path.join(TESTDATA, 'Pica pica_30s.wav'), frames=48000 * 3)
+        soundfile.write(self.recording, data, rate)
+        self.settings = Settings.with_defaults()
+        self.settings.update({'BIRDWEATHER_ID': 'station', 'MODEL': 'BirdNET_GLOBAL_6K_V2.4_Model_FP16'})
+        file_date = datetime.datetime(2024, 2, 24, 16, 19, 37)
+        self.detections = [Detection(file_date, start, start + 3, 'Pica pica', 'Eurasian Magpie', 0.9) for start in (0, 3)]
+
+    def uploader(self, **kwargs):
+        uploader = BirdWeatherUploader(self.spool, url=self.url, limiter=RateLimiter(1000, 10), **kwargs)
+        self.addCleanup(uploader.close)
+        return uploader
+
+    def submit(self, uploader, keep=False):
+        uploader.submit(ParseFileName(self.recording), self.detections, self.settings)
+        # the reporting thread is done with the recording
+        if not keep:
+            os.remove(self.recording)
+
+    def wait_for_spool(self, uploader):
+        for _ in range(500):
+            if not uploader.pending():
+                return
+            threading.Event().wait(0.01)
+        self.fail('spool not emptied')
+
+    def test_soundscape_then_detections_on_one_connection(self):
+        uploader = self.uploader().start()
+        self.submit(uploader)
+        self.wait_for_spool(uploader)
+
+        paths = [r[0].split('?')[0] for r in self.server.requests]
+        self.assertEqual(paths, ['/api/v1/stations/station/soundscapes'] + ['/api/v1/stations/station/detections'] * 2)
+        _, content_type, body, _ = self.server.requests[0]
+        self.assertEqual(content_type, 'audio/flac')
+        self.assertEqual(soundfile.info(io.BytesIO(body)).frames, 48000 * 3)
+        posted = [json.loads(r[2]) for r in self.server.requests[1:]]
+        self.assertEqual([(d['soundscapeId'], d['soundscapeStartTime'], d['algorithm']) for d in posted], [(42, 0, '2p4'), (42, 3, '2p4')])
+        self.assertEqual(len({r[3] for r in self.server.requests}), 1)
+        self.assertEqual(os.listdir(self.spool), [])
+
+    def test_retry_with_backoff(self):
+        self.server.statuses = [503, 200, 429]
+        uploader = self.uploader(backoff=0.01).start()
+        with self.assertLogs('scripts.utils.birdweather', 'WARNING') as logs:
+            self.submit(uploader)
+            self.wait_for_spool(uploader)
+        self.assertEqual(len([line for line in logs.output if 'retrying' in line]), 2)
+        paths = [r[0].split('?')[0].rsplit('/', 1)[1] for r in self.server.requests]
+        # the soundscape is not posted again once it has an id
+        self.assertEqual(paths, ['soundscapes', 'soundscapes', 'detections', 'detections', 'detections'])
+
+    def test_spool_survives_restart(self):
+        self.submit(self.uploader())
+        self.assertEqual(self.server.requests, [])
+
+        uploader = self.uploader().start()
+        self.wait_for_spool(uploader)
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_rejected_soundscape_is_dropped(self):
+        self.server.statuses = [400]
+        uploader = self.uploader()
+        self.submit(uploader)
+        with self.assertLogs('scripts.utils.birdweather', 'ERROR'):
+            uploader.upload(uploader.pending()[0])
+        self.assertEqual(os.listdir(self.spool), [])
+
+    def test_spool_is_capped(self):
+        uploader = self.uploader(max_jobs=3)
+        for _ in range(3):
+            self.submit(uploader, keep=True)
+        first = uploader.pending()
+        with self.assertLogs('scripts.utils.birdweather', 'WARNING'):
+            self.submit(uploader, keep=True)
+        self.assertEqual(len(uploader.pending()), 3)
+        self.assertNotIn(first[0], uploader.pending())
+        # the audio of the dropped job went with it
+        self.assertEqual(len(os.listdir(self.spool)), 6)
+
+        # room for two recordings and their jobs
+        uploader.max_jobs, uploader.max_bytes = 100, 2 * os.path.getsize(self.recording) + 5000
+        with self.assertLogs('scripts.utils.birdweather', 'WARNING'):
+            self.submit(uploader)
+        self.assertEqual(len(uploader.pending()), 2)
+
+    def test_trimmed_jobs_are_skipped_quietly(self):
+        uploader = self.uploader()
+        for _ in range(3):
+            self.submit(uploader, keep=True)
+        upload = uploader.upload
+
+        def trimmed(job_file):
+            # as if trim() ran on the reporting thread after run() listed the jobs
+            for pending in uploader.pending():
+                uploader._remove_job(pending)
+            upload(job_file)
+
+        with patch.object(uploader, 'upload', side_effect=trimmed) as mock_upload, \
+                self.assertNoLogs('scripts.utils.birdweather', 'ERROR'):
+            uploader.start()
+            self.wait_for_spool(uploader)
+            uploader.close()
+        mock_upload.assert_called_once()
+        self.assertEqual(self.server.requests, [])
+
+    def test_spool_errors_do_not_stop_reporting(self):
+        self.settings['RECS_DIR'] = os.path.dirname(self.spool)
+        with patch('scripts.utils.helpers._load_settings', return_value=self.settings), \
+                patch('scripts.utils.birdweather.BirdWeatherUploader.submit', side_effect=OSError('No space left on device')), \
+                patch('scripts.utils.birdweather._UPLOADER', self.uploader()):
+            with self.assertLogs('scripts.utils.reporting', 'ERROR'):
+                bird_weather(ParseFileName(self.recording), self.detections)
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_burst_then_rate(self):
+        now = [0.0]
+        limiter = RateLimiter(rate=2, burst=3, clock=lambda: now[0])
+        self.assertEqual([limiter.delay() for _ in range(3)], [0.0, 0.0, 0.0])
+        self.assertEqual(limiter.delay(), 0.5)
+        now[0] = 10.0
+        self.assertEqual(limiter.delay(), 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
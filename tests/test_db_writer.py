@@ -0,0 +1,125 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+from datetime import datetime
+from unittest.mock import patch
+
+from scripts.utils import db
+from scripts.utils.db import DetectionWriter, SpeciesCounts
+
+SCHEMA = """CREATE TABLE detections (Date DATE, Time TIME, Sci_Name VARCHAR(100) NOT NULL, Com_Name VARCHAR(100) NOT NULL,
+            Confidence FLOAT, Lat FLOAT, Lon FLOAT, Cutoff FLOAT, Week INT, Sens FLOAT, Overlap FLOAT,
+            File_Name VARCHAR(100) NOT NULL)"""
+
+
+def row(time, name='Pica pica', date='2024-02-24'):
+    return (date, time, name, 'Eurasian Magpie', 0.9, 50, 5, 0.7, '8', 1.25, 0.0, f'Eurasian_Magpie-90-{time}.wav')
+
+
+class TestDetectionWriter(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.db_path = os.path.join(tmp.name, 'birds.db')
+        self.spool = os.path.join(tmp.name, 'spool.txt')
+        con = sqlite3.connect(self.db_path)
+        con.execute(SCHEMA)
+        con.close()
+        self.writer = DetectionWriter(self.db_path, self.spool, busy_timeout=50)
+        self.addCleanup(self.writer.close_connection)
+
+    def times(self):
+        con = sqlite3.connect(self.db_path)
+        try:
+            return [r[0] for r in con.execute('SELECT Time FROM detections ORDER BY Time')]
+        finally:
+            con.close()
+
+    def test_batch_in_wal_mode(self):
+        self.assertTrue(self.writer.write([row('16:19:37'), row('16:19:40')]))
+        self.assertEqual(self.times(), ['16:19:37', '16:19:40'])
+        self.assertEqual(self.writer.connect().execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        self.assertEqual((self.writer.stats['batches'], self.writer.stats['rows']), (1, 2))
+
+    def test_failed_rows_are_spooled_and_retried(self):
+        self.writer.write([row('16:19:37')])
+        locker = sqlite3.connect(self.db_path)
+        locker.execute('BEGIN EXCLUSIVE')
+        with self.assertLogs('scripts.utils.db', 'WARNING'):
+            self.assertFalse(self.writer.write([row('16:19:40'), row('16:19:43')]))
+        self.assertEqual(self.writer.spooled_rows(), [row('16:19:40'), row('16:19:43')])
+        locker.rollback()
+        locker.close()
+
+        self.assertTrue(self.writer.write([row('16:19:46')]))
+        self.assertEqual(self.times(), ['16:19:37', '16:19:40', '16:19:43', '16:19:46'])
+        self.assertFalse(os.path.exists(self.spool))
+        self.assertEqual({k: self.writer.stats[k] for k in ('spooled', 'recovered', 'failures', 'rows')},
+                         {'spooled': 2, 'recovered': 2, 'failures': 1, 'rows': 4})
+
+    def test_batch_is_all_or_nothing(self):
+        with self.assertLogs('scripts.utils.db', 'ERROR'):
+            self.assertFalse(self.writer.write([row('16:19:37'), row('16:19:40', name=None)]))
+        self.assertEqual(self.times(), [])
+        # not spooled, or the next batches would fail with it
+        self.assertEqual(self.writer.spooled_rows(), [])
+        self.assertTrue(self.writer.write([row('16:19:43')]))
+
+    def test_refused_spooled_row_is_set_aside(self):
+        # e.g. spooled by an older version, or edited by hand
+        self.writer._spool([row('16:19:37'), row('16:19:40', name=None)])
+        with self.assertLogs('scripts.utils.db', 'ERROR'):
+            self.assertTrue(self.writer.write([row('16:19:43')]))
+        self.assertEqual(self.times(), ['16:19:43'])
+        self.assertFalse(os.path.exists(self.spool))
+        with open(self.writer.rejected) as f:
+            self.assertEqual(len(f.readlines()), 2)
+
+        self.assertTrue(self.writer.write([row('16:19:46')]))
+        self.assertEqual(self.times(), ['16:19:43', '16:19:46'])
+
+
+class TestSpeciesCounts(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        db_path = os.path.join(tmp.name, 'birds.db')
+        con = sqlite3.connect(db_path)
+        con.execute(SCHEMA)
+        con.executemany(db.INSERT_DETECTION, [row('06:00:00', date='2024-02-24'), row('06:00:00', date='2024-02-20'),
+                                              row('06:00:00', date='2024-02-10'), row('06:00:00', 'Corvus corone', '2024-02-24')])
+        con.commit()
+        con.close()
+        patcher = patch.multiple(db, DB_PATH=db_path, _DB=None, _COUNTS=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(lambda: db._DB and db._DB.close())
+        self.writer = DetectionWriter(db_path, os.path.join(tmp.name, 'spool.txt'))
+        self.addCleanup(self.writer.close_connection)
+        self.now = datetime(2024, 2, 24, 12)
+        db._COUNTS = SpeciesCounts(now=lambda: self.now)
+
+    def test_seeded_then_counted_on_commit(self):
+        counts = db.get_species_counts()
+        self.assertEqual((counts.today('Pica pica'), counts.this_week('Pica pica')), (1, 2))
+        self.assertEqual(counts.today('Sturnus vulgaris'), 0)
+
+        with patch.object(db, 'get_db', side_effect=AssertionError('counted again')):
+            self.writer.write([row('12:00:00'), row('12:00:03')])
+            self.assertEqual((db.get_todays_count_for('Pica pica'), db.get_this_weeks_count_for('Pica pica')), (3, 4))
+
+    def test_rolls_over_at_midnight(self):
+        counts = db.get_species_counts()
+        self.assertEqual(counts.today('Corvus corone'), 1)
+        self.now = datetime(2024, 2, 25, 0, 1)
+        self.assertEqual((counts.today('Corvus corone'), counts.this_week('Corvus corone')), (0, 1))
+        self.now = datetime(2024, 2, 28, 0, 1)
+        # the detection of the 20th is out of the 7 days
+        self.assertEqual(counts.this_week('Pica pica'), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
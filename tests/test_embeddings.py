@@ -0,0 +1,65 @@
+import datetime
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from scripts.utils.embeddings import EmbeddingStore
+
+
+class TestEmbeddingStore(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, 'BirdNET_GLOBAL_6K_V2.4_Model_FP16')
+        self.rng = np.random.default_rng(0)
+
+    def test_append_and_read(self):
+        store = EmbeddingStore(self.path, 'BirdNET_GLOBAL_6K_V2.4_Model_FP16', 16)
+        first = self.rng.standard_normal((5, 16)).astype('float32')
+        second = self.rng.standard_normal((3, 16)).astype('float32')
+        store.append(1000.0 + np.arange(5) * 3, 3, first)
+        store.append(1000.0 + np.arange(3) * 3, 3, second, stream=2)
+
+        # a new instance reads what the analysis wrote
+        store = EmbeddingStore(self.path, 'BirdNET_GLOBAL_6K_V2.4_Model_FP16', 16)
+        self.assertEqual(len(store), 8)
+        self.assertEqual(store.vectors().dtype, np.float16)
+        np.testing.assert_allclose(store.vectors(), np.concatenate([first, second]), rtol=1e-3, atol=1e-3)
+        self.assertEqual(list(store.index()['stream']), [0] * 5 + [2] * 3)
+        self.assertEqual(os.path.getsize(os.path.join(self.path, 'vectors.f16')), 8 * 16 * 2)
+
+    def test_lookup(self):
+        store = EmbeddingStore(self.path, 'BirdNET_GLOBAL_6K_V2.4_Model_FP16', 4)
+        start = datetime.datetime(2024, 2, 24, 16, 19, 37)
+        store.append(start.timestamp() + np.arange(4) * 1.5, 3, np.zeros((4, 4)))
+        store.append(start.timestamp() + np.arange(4) * 1.5, 3, np.zeros((4, 4)), stream=1)
+
+        # DB rows have whole seconds: 16:19:38 is the chunk that started at 16:19:38.5
+        self.assertEqual(store.lookup(start + datetime.timedelta(seconds=1)), 1)
+        self.assertEqual(store.lookup(start + datetime.timedelta(seconds=4.5)), 3)
+        self.assertEqual(store.lookup(start + datetime.timedelta(seconds=4.5), stream=1), 7)
+        self.assertIsNone(store.lookup(start + datetime.timedelta(seconds=10)))
+        self.assertIsNone(store.lookup(start, stream=3))
+
+    def test_interrupted_append_is_dropped(self):
+        store = EmbeddingStore(self.path, 'BirdNET_GLOBAL_6K_V2.4_Model_FP16', 4)
+        store.append([1.0, 4.0], 3, np.ones((2, 4)))
+        # vectors written, but the process died before the index was
+        with open(os.path.join(self.path, 'vectors.f16'), 'ab') as f:
+            f.write(np.zeros((1, 4), dtype='float16').tobytes())
+        store.append([7.0], 3, np.full((1, 4), 2.0))
+
+        self.assertEqual(len(store), 3)
+        np.testing.assert_array_equal(store.vectors()[:, 0], [1.0, 1.0, 2.0])
+
+    def test_other_model_in_path(self):
+        EmbeddingStore(self.path, 'BirdNET_GLOBAL_6K_V2.4_Model_FP16', 1024)
+        with self.assertRaises(ValueError):
+            EmbeddingStore(self.path, 'Perch_v2', 1536)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,168 @@
+import datetime
+import os
+import tempfile
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+import numpy as np
+import soundfile
+
+from scripts.utils.classes import Detection, ParseFileName
+from scripts.utils.reporting import SpectrogramPool, extract_clips, extract_detections
+from tests.helpers import TESTDATA, Settings
+
+SOURCE = os.path.join(TESTDATA, 'Pica pica_30s.wav')
+
+
+def render_or_die(in_file, title, comment, raw=0):
+    # in a worker process: as if it was killed for running out of memory
+    if in_file == 'killed':
+        os._exit(1)
+
+
+class TestExtractClips(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+
+    def test_wav_is_exact_slice(self):
+        out_file = os.path.join(self.tmp, 'clip.wav')
+        extract_clips(SOURCE, [(out_file, 1.5, 7.5)])
+        source, rate = soundfile.read(SOURCE, dtype='int16')
+        clip, clip_rate = soundfile.read(out_file, dtype='int16')
+        self.assertEqual(clip_rate, rate)
+        self.assertEqual(soundfile.info(out_file).subtype, soundfile.info(SOURCE).subtype)
+        np.testing.assert_array_equal(clip, source[int(1.5 * rate):int(7.5 * rate)])
+
+    def test_stop_past_end(self):
+        out_file = os.path.join(self.tmp, 'clip.flac')
+        extract_clips(SOURCE, [(out_file, 27.0, 33.0)])
+        self.assertEqual(soundfile.info(out_file).frames, 3 * 48000)
+
+    @unittest.skipUnless('MP3' in soundfile.available_formats(), 'libsndfile without MP3')
+    def test_mp3(self):
+        out_file = os.path.join(self.tmp, 'clip.mp3')
+        with patch('scripts.utils.reporting.extract') as mock_extract:
+            extract_clips(SOURCE, [(out_file, 0.0, 6.0)])
+        mock_extract.assert_not_called()
+        self.assertAlmostEqual(soundfile.info(out_file).duration, 6.0, delta=0.1)
+
+    def test_sox_for_other_formats(self):
+        clips = [(os.path.join(self.tmp, 'clip.gsm'), 0.0, 6.0), (os.path.join(self.tmp, 'clip.wav'), 6.0, 12.0)]
+        with patch('scripts.utils.reporting.extract') as mock_extract:
+            extract_clips(SOURCE, clips)
+        mock_extract.assert_called_once_with(SOURCE, *clips[0])
+        self.assertTrue(os.path.exists(clips[1][0]))
+
+
+class TestExtractDetections(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.settings = Settings.with_defaults()
+        self.settings.update({'EXTRACTED': tmp.name, 'AUDIOFMT': 'wav', 'RECORDING_LENGTH': '30', 'RAW_SPECTROGRAM': '0'})
+        patcher = patch('scripts.utils.helpers._load_settings', return_value=self.settings)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch('scripts.utils.reporting.spectrogram')
+        self.spectrogram = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.file = ParseFileName(os.path.join(TESTDATA, '2024-02-24-birdnet-16:19:37.wav'))
+        self.file.file_name = SOURCE
+
+    def test_one_read_for_all_clips(self):
+        file_date = datetime.datetime(2024, 2, 24, 16, 19, 37)
+        detections = [Detection(file_date, start, start + 3, 'Pica pica', 'Eurasian Magpie', 0.9) for start in (0, 12, 27)]
+        with patch('scripts.utils.reporting.soundfile.SoundFile', wraps=soundfile.SoundFile) as mock_open:
+            new_files = extract_detections(self.file, detections)
+        # the clips themselves are written through SoundFile too
+        self.assertEqual([c.args for c in mock_open.call_args_list if len(c.args) == 1], [(SOURCE,)])
+
+        self.assertEqual([os.path.basename(f) for f in new_files],
+                         [f'Eurasian_Magpie-90-2024-02-24-birdnet-{t}.wav' for t in ('16:19:37', '16:19:49', '16:20:04')])
+        # EXTRACTION_LENGTH 6: 1.5s around each detection, within the recording
+        self.assertEqual([soundfile.info(f).duration for f in new_files], [4.5, 6.0, 4.5])
+        self.assertEqual(self.spectrogram.call_count, 3)
+
+    def test_existing_clip_is_kept(self):
+        file_date = datetime.datetime(2024, 2, 24, 16, 19, 37)
+        detections = [Detection(file_date, 12, 15, 'Pica pica', 'Eurasian Magpie', 0.9)] * 2
+        first, second = extract_detections(self.file, detections)
+        self.assertEqual(first, second)
+        self.assertEqual(self.spectrogram.call_count, 1)
+
+    def test_spectrograms_handed_off(self):
+        file_date = datetime.datetime(2024, 2, 24, 16, 19, 37)
+        detections = [Detection(file_date, 12, 15, 'Pica pica', 'Eurasian Magpie', 0.9)]
+        submitted = []
+        new_files = extract_detections(self.file, detections, lambda *args: submitted.append(args))
+        self.spectrogram.assert_not_called()
+        self.assertEqual([args[:2] for args in submitted], [(new_files[0], 'Eurasian Magpie')])
+
+
+class TestSpectrogramPool(unittest.TestCase):
+
+    def setUp(self):
+        self.rendered = []
+        self.started = threading.Event()
+        self.gate = threading.Event()
+
+    def render(self, in_file, title, comment, raw=0):
+        self.started.set()
+        self.gate.wait(5)
+        if in_file == 'broken':
+            raise ValueError('no audio')
+        self.rendered.append(in_file)
+
+    def test_live_before_backfill(self):
+        pool = SpectrogramPool(1, make_executor=lambda: ThreadPoolExecutor(1), render=self.render)
+        # the first job takes the only worker, the others queue up behind it
+        pool.submit('first', 't', 'c', priority=SpectrogramPool.BACKFILL)
+        self.assertTrue(self.started.wait(5))
+        pool.submit('backfill 1', 't', 'c', priority=SpectrogramPool.BACKFILL)
+        pool.submit('backfill 2', 't', 'c', priority=SpectrogramPool.BACKFILL)
+        pool.submit('live', 't', 'c', priority=SpectrogramPool.LIVE)
+        self.assertEqual(pool.pending, 4)
+        self.gate.set()
+        self.assertTrue(pool.wait(5))
+        pool.close()
+        self.assertEqual(self.rendered, ['first', 'live', 'backfill 1', 'backfill 2'])
+        self.assertEqual((pool.pending, pool.completed, pool.failed), (0, 4, 0))
+
+    def test_failures_are_counted(self):
+        self.gate.set()
+        pool = SpectrogramPool(2, make_executor=lambda: ThreadPoolExecutor(2), render=self.render)
+        pool.submit('broken', 't', 'c')
+        pool.submit('clip', 't', 'c')
+        with self.assertLogs('scripts.utils.reporting', 'ERROR'):
+            pool.close()
+        self.assertEqual((pool.completed, pool.failed), (1, 1))
+
+    def test_killed_worker(self):
+        pool = SpectrogramPool(1, queue_size=2, render=render_or_die)
+        with self.assertLogs('scripts.utils.reporting', 'WARNING'):
+            pool.submit('killed', 't', 'c')
+            # more than the queue holds, none of them may block
+            for n in range(4):
+                pool.submit(f'clip {n}', 't', 'c')
+            self.assertTrue(pool.wait(60))
+            pool.close()
+        self.assertEqual((pool.pending, pool.completed, pool.failed), (0, 4, 1))
+
+    def test_priority_of_recording(self):
+        settings = Settings.with_defaults()
+        settings['RECORDING_LENGTH'] = '15'
+        now = datetime.datetime.now()
+        live = ParseFileName(os.path.join(TESTDATA, f'{now:%Y-%m-%d}-birdnet-{now:%H:%M:%S}.wav'))
+        self.assertEqual(SpectrogramPool.priority(live, settings), SpectrogramPool.LIVE)
+        old = ParseFileName(os.path.join(TESTDATA, '2024-02-24-birdnet-16:19:37.wav'))
+        self.assertEqual(SpectrogramPool.priority(old, settings), SpectrogramPool.BACKFILL)
+
+
+if __name__ == '__main__':
+    unittest.main()
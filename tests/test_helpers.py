@@ -1,5 +1,9 @@
+import os
+import tempfile
 import unittest
-from scripts.utils.helpers import PHPConfigParser
+from types import MappingProxyType
+
+from scripts.utils.helpers import PHPConfigParser, get_asset, get_cached_language, get_custom_species_list, get_language
 
 
 class TestPHPConfigParser(unittest.TestCase):
@@ -45,5 +49,55 @@ class TestPHPConfigParser(unittest.TestCase):
         self.assertEqual(result, '"quoted_value"')
 
 
+class TestAssetCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'include_species_list.txt')
+        self.loads = 0
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write(self, content, mtime):
+        with open(self.path, 'w') as f:
+            f.write(content)
+        os.utime(self.path, (mtime, mtime))
+
+    def counting_loader(self, path):
+        self.loads += 1
+        with open(path) as f:
+            return f.read()
+
+    def test_reads_file_once_until_it_changes(self):
+        self.write('a', 1000)
+        self.assertEqual(get_asset(self.path, self.counting_loader), 'a')
+        self.assertEqual(get_asset(self.path, self.counting_loader), 'a')
+        self.assertEqual(self.loads, 1)
+
+        self.write('b', 2000)
+        self.assertEqual(get_asset(self.path, self.counting_loader), 'b')
+        self.assertEqual(self.loads, 2)
+
+    def test_species_list(self):
+        self.assertEqual(get_custom_species_list(self.path), frozenset())
+
+        self.write('Pica pica_Eurasian Magpie\nTurdus merula_Eurasian Blackbird\n', 1000)
+        species = get_custom_species_list(self.path)
+        self.assertIsInstance(species, frozenset)
+        self.assertEqual(species, {'Pica pica', 'Turdus merula'})
+
+        os.remove(self.path)
+        self.assertEqual(get_custom_species_list(self.path), frozenset())
+
+    def test_cached_language_is_read_only(self):
+        names = get_cached_language('en')
+        self.assertIs(names, get_cached_language('en'))
+        self.assertIsInstance(names, MappingProxyType)
+        self.assertEqual(names['Pica pica'], 'Eurasian Magpie')
+        # get_language still returns a fresh dict that callers may modify
+        self.assertIsNot(get_language('en'), get_language('en'))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,264 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import numpy as np
+
+from scripts.utils.models import BirdNetV2_4, MDataModel1, Perch, Prediction, get_interpreter_options, rank_of_best
+from tests.helpers import Settings
+
+
+class FakeInterpreter:
+    """Deterministic stand-in for tflite.Interpreter: logits are a fixed projection of the input."""
+
+    def __init__(self, n_samples, n_classes, batching=True):
+        self.n_samples = n_samples
+        self.weights = np.random.default_rng(0).standard_normal((n_samples, n_classes)).astype('float32')
+        self.batching = batching
+        self.shape = [1, n_samples]
+        self.invokes = 0
+        self._input = None
+
+    def resize_tensor_input(self, idx, shape):
+        if not self.batching and shape[0] != 1:
+            raise RuntimeError('fixed batch size')
+        self.shape = list(shape)
+
+    def allocate_tensors(self):
+        pass
+
+    def set_tensor(self, idx, value):
+        assert list(value.shape) == self.shape, (value.shape, self.shape)
+        self._input = value
+
+    def invoke(self):
+        self.invokes += 1
+
+    def get_tensor(self, idx):
+        return self._input @ self.weights
+
+
+class FakeEmbeddingInterpreter(FakeInterpreter):
+    """Also has an embedding tensor (index 1): the first 8 samples of each chunk."""
+
+    def get_tensor(self, idx):
+        return self._input[:, :8] if idx == 1 else super().get_tensor(idx)
+
+
+class FakeAllocationInterpreter(FakeInterpreter):
+    """Takes any batch size, but runs out of memory for more than one chunk."""
+
+    def allocate_tensors(self):
+        if self.shape[0] != 1:
+            raise RuntimeError('cannot allocate tensors')
+
+
+def make_model(cls, interpreter, n_classes, **attrs):
+    model = cls.__new__(cls)
+    model.interpreter = interpreter
+    model._input_layer_idx = 0
+    model._input_shape = [1, interpreter.n_samples]
+    model._output_layer_idx = 0
+    model._batch_size = 1
+    model._batching = True
+    model.labels = [f'Species {i}_Common {i}' for i in range(n_classes)]
+    model.human_indices = np.array([], dtype=int)
+    for key, value in attrs.items():
+        setattr(model, key, value)
+    return model
+
+
+class TestPredictBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.chunks = np.random.default_rng(1).standard_normal((5, 64)).astype('float32')
+
+    def test_batch_matches_single_chunks(self):
+        model = make_model(BirdNetV2_4, FakeInterpreter(64, 20), 20, _sensitivity=1.0)
+        single = [model.predict_batch(chunk)[0] for chunk in self.chunks]
+        model.interpreter.invokes = 0
+
+        scores = model.predict_batch(self.chunks)
+
+        self.assertEqual(scores.shape, (5, 20))
+        self.assertEqual(model.interpreter.invokes, 1)
+        np.testing.assert_allclose(scores, single, rtol=1e-5)
+
+    def test_perch_softmax_per_row(self):
+        model = make_model(Perch, FakeInterpreter(64, 20), 20)
+        scores = model.predict_batch(self.chunks)
+        np.testing.assert_allclose(scores.sum(axis=1), np.ones(5), rtol=1e-5)
+
+    def test_fallback_without_dynamic_batch(self):
+        model = make_model(BirdNetV2_4, FakeInterpreter(64, 20, batching=False), 20, _sensitivity=1.0)
+        with self.assertLogs('scripts.utils.models', level='WARNING'):
+            scores = model.predict_batch(self.chunks)
+
+        self.assertEqual(scores.shape, (5, 20))
+        self.assertEqual(model.interpreter.invokes, 5)
+        self.assertFalse(model._batching)
+
+    def test_fallback_when_allocation_fails(self):
+        model = make_model(BirdNetV2_4, FakeAllocationInterpreter(64, 20), 20, _sensitivity=1.0)
+        with self.assertLogs('scripts.utils.models', level='WARNING'):
+            scores = model.predict_batch(self.chunks)
+
+        self.assertEqual(scores.shape, (5, 20))
+        self.assertEqual(model.interpreter.shape, [1, 64])
+        self.assertEqual(model.predict_batch(self.chunks[0]).shape, (1, 20))
+
+    def test_embeddings_of_the_same_invoke(self):
+        for batching in [True, False]:
+            model = make_model(BirdNetV2_4, FakeEmbeddingInterpreter(64, 20, batching=batching), 20, _sensitivity=1.0, _embedding_idx=1)
+            scores, embeddings = model.predict_batch(self.chunks, embeddings=True)
+            np.testing.assert_allclose(scores, model.predict_batch(self.chunks), rtol=1e-5)
+            np.testing.assert_array_equal(embeddings, self.chunks[:, :8])
+
+    def test_no_embedding_output(self):
+        model = make_model(BirdNetV2_4, FakeInterpreter(64, 20), 20, _sensitivity=1.0, _embedding_idx=None)
+        with self.assertRaises(ValueError):
+            model.predict_batch(self.chunks, embeddings=True)
+
+    def test_empty_batch(self):
+        model = make_model(BirdNetV2_4, FakeInterpreter(64, 20), 20, _sensitivity=1.0)
+        self.assertEqual(model.predict_batch([]).shape, (0, 20))
+
+
+class TestPrediction(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(2)
+        # Rounded scores so the ordering has plenty of ties
+        self.scores = np.round(rng.random(500), 2).astype('float32')
+        self.labels = [f'Species {i}_Common {i}' for i in range(500)]
+        self.labels[40] = 'Human vocal_Human vocal'
+        self.labels[41] = 'Human whistle_Human whistle'
+        self.model = make_model(BirdNetV2_4, FakeInterpreter(64, 500), 500, labels=self.labels,
+                                human_indices=np.array([40, 41]))
+
+    def test_top_k_matches_full_sort(self):
+        full = self.model.label(self.scores)
+        for k in [1, 10, 37, 500]:
+            prediction = self.model.top_k(self.scores, k)
+            self.assertEqual(len(prediction), k)
+            self.assertEqual(prediction[:k], full[:k])
+            self.assertEqual(list(prediction), full[:k])
+            self.assertEqual(prediction[0], full[0])
+
+    def test_human_rank_matches_full_sort(self):
+        full = [name for name, _ in self.model.label(self.scores)]
+        rank = min(full.index(self.labels[40]), full.index(self.labels[41]))
+        prediction = self.model.top_k(self.scores)
+
+        self.assertEqual(prediction.rank_of_best(self.model.human_indices), rank)
+        self.assertTrue(prediction.has_human_within(rank + 1))
+        self.assertFalse(prediction.has_human_within(rank))
+
+    def test_human_ranks_over_score_matrix(self):
+        matrix = np.round(np.random.default_rng(3).random((8, 500)), 2).astype('float32')
+        ranks = self.model.human_ranks(matrix)
+        expected = [self.model.top_k(row).rank_of_best(self.model.human_indices) for row in matrix]
+        self.assertEqual(list(ranks), expected)
+        self.assertEqual(list(rank_of_best(matrix, np.array([], dtype=int))), [500] * 8)
+
+    def test_no_human_labels(self):
+        prediction = Prediction(self.scores, self.labels, 10, np.array([], dtype=int))
+        self.assertFalse(prediction.has_human_within(500))
+
+
+class FakeMDataInterpreter(FakeInterpreter):
+    """Occurrence of class c in week w is (c + w) % 10 / 10, whatever the location."""
+
+    def __init__(self, n_classes):
+        super().__init__(3, n_classes)
+        self.shape = [1, 3]
+
+    def get_tensor(self, idx):
+        weeks = self._input[:, 2:3]
+        return ((np.arange(self.weights.shape[1]) + weeks) % 10 / 10).astype('float32')
+
+
+def make_mdata_model(n_classes, sf_thresh):
+    model = MDataModel1.__new__(MDataModel1)
+    model.interpreter = FakeMDataInterpreter(n_classes)
+    model._input_layer_idx = 0
+    model._output_layer_idx = 0
+    model._classes = n_classes
+    model._sf_thresh = sf_thresh
+    model._mdata_params = None
+    model._mdata = None
+    model._table = None
+    model._table_params = None
+    model._species = {}
+    return model
+
+
+class TestSpeciesOccurrence(unittest.TestCase):
+
+    def setUp(self):
+        self.labels = [f'Species {i}_Common {i}' for i in range(20)]
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.cache_dir = os.path.join(tmp.name, 'cache')
+        patcher = patch('scripts.utils.models.CACHE_DIR', self.cache_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_all_weeks_in_one_invoke(self):
+        model = make_mdata_model(20, 0.75)
+        for week in model.weeks:
+            model.set_meta_data(50.0, 5.0, week)
+            mask = model.get_species_mask(self.labels)
+            expected = [(i + week) % 10 >= 8 for i in range(20)]
+            self.assertEqual(list(mask), expected)
+            self.assertEqual(model.get_species_list(self.labels),
+                             {label.split('_')[0] for label, e in zip(self.labels, expected) if e})
+            details = model.get_species_list_details(self.labels)
+            self.assertEqual({name.split('_')[0] for _, name in details}, model.get_species_list(self.labels))
+            self.assertEqual([score for score, _ in details], sorted([score for score, _ in details], reverse=True))
+        self.assertEqual(model.interpreter.invokes, 1)
+
+    def test_table_is_cached_on_disk(self):
+        model = make_mdata_model(20, 0.75)
+        model.set_meta_data(50.0, 5.0, 7)
+        mask = model.get_species_mask(self.labels)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+
+        model = make_mdata_model(20, 0.75)
+        model.set_meta_data(50.0, 5.0, 7)
+        np.testing.assert_array_equal(model.get_species_mask(self.labels), mask)
+        self.assertEqual(model.interpreter.invokes, 0)
+
+        # another location is a different table
+        model.set_meta_data(51.0, 5.0, 7)
+        model.get_species_mask(self.labels)
+        self.assertEqual(model.interpreter.invokes, 1)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+
+    def test_week_outside_table(self):
+        model = make_mdata_model(20, 0.75)
+        model.set_meta_data(50.0, 5.0, -1)
+        self.assertEqual(list(model.get_species_mask(self.labels)), [(i - 1) % 10 >= 8 for i in range(20)])
+        self.assertIsNone(model._table)
+
+
+class TestInterpreterOptions(unittest.TestCase):
+
+    def test_defaults(self):
+        self.assertEqual(get_interpreter_options(Settings.with_defaults()), {'num_threads': None, 'xnnpack': True})
+
+    def test_configured(self):
+        settings = Settings.with_defaults()
+        settings.update({'TFLITE_THREADS': '2', 'TFLITE_XNNPACK': '0'})
+        self.assertEqual(get_interpreter_options(settings), {'num_threads': 2, 'xnnpack': False})
+
+    def test_empty_and_invalid_threads(self):
+        settings = Settings.with_defaults()
+        for value in ['', 'four']:
+            settings['TFLITE_THREADS'] = value
+            self.assertIsNone(get_interpreter_options(settings)['num_threads'])
+
+
+if __name__ == '__main__':
+    unittest.main()
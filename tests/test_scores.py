@@ -0,0 +1,94 @@
+import datetime
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import numpy as np
+
+from scripts.utils.analysis import chunk_starts, filter_humans, get_detections
+from scripts.utils.models import Perch, Prediction, rank_of_best, scores_from_logits, sensitivity_slope
+from scripts.utils.scores import RECORD_DTYPE, TOP_K, ScoreStore, rescore
+from tests.helpers import Settings
+
+
+class TestScoreStore(unittest.TestCase):
+    labels = [f'Species {i}' for i in range(30)] + ['Human vocal']
+    human_indices = np.array([30])
+    file_date = datetime.datetime(2024, 2, 24, 16, 19, 37)
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.store = ScoreStore(os.path.join(tmp.name, 'BirdNET_GLOBAL_6K_V2.4_Model_FP16'))
+        self.settings = Settings.with_defaults()
+        self.settings['CONFIDENCE'] = 0.3
+        for target, kwargs in [('scripts.utils.helpers._load_settings', {'return_value': self.settings}),
+                               ('scripts.utils.analysis.loadCustomSpeciesList', {'return_value': []})]:
+            patcher = patch(target, **kwargs)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        # logits that float16 holds exactly, a human in chunk 3
+        rng = np.random.default_rng(0)
+        self.logits = np.round(rng.uniform(-6, 3, (6, len(self.labels))) * 8) / 8
+        self.logits[3, 30] = 4.0
+
+    def analyze(self, sensitivity):
+        # what analyzeAudioData reports for these logits
+        scores = (1 / (1.0 + np.exp(-sensitivity_slope(sensitivity) * self.logits))).astype('float32')
+        predictions = [Prediction(row, self.labels, TOP_K, self.human_indices) for row in scores]
+        starts = chunk_starts(len(scores), 3, 1.5)
+        raw = {f'{start};{start + 3}': p for start, p in zip(starts, filter_humans(predictions, rank_of_best(scores, self.human_indices)))}
+        return predictions, starts, get_detections(self.file_date, raw, [])
+
+    def rescore(self, sensitivity):
+        return list(rescore(self.store.read(self.file_date), 'BirdNET_GLOBAL_6K_V2.4_Model_FP16', self.labels, sensitivity))
+
+    def assertSameDetections(self, first, second):
+        self.assertEqual([(d.start, d.stop, d.scientific_name) for d in first], [(d.start, d.stop, d.scientific_name) for d in second])
+        np.testing.assert_allclose([d.confidence for d in first], [d.confidence for d in second], atol=1e-4)
+
+    def store_analysis(self):
+        predictions, starts, detections = self.analyze(1.25)
+        scores = 1 / (1.0 + np.exp(-sensitivity_slope(1.25) * self.logits))
+        self.store.append(self.file_date, starts, 3, [p.indices for p in predictions], self.logits,
+                          np.zeros(len(self.logits)), rank_of_best(scores, self.human_indices))
+        return detections
+
+    def test_same_settings_same_detections(self):
+        detections = self.store_analysis()
+        self.assertTrue(detections)
+        [(file_date, stream, rescored)] = self.rescore(1.25)
+        self.assertEqual((file_date, stream), (self.file_date, 0))
+        self.assertSameDetections(rescored, detections)
+        # the human and its neighbours stay private
+        self.assertFalse({d.start for d in rescored} & {3.0, 4.5, 6.0})
+
+    def test_other_sensitivity_and_confidence(self):
+        self.store_analysis()
+        self.settings['CONFIDENCE'] = 0.2
+        [(_, _, rescored)] = self.rescore(0.75)
+        self.assertSameDetections(rescored, self.analyze(0.75)[2])
+
+    def test_recordings_and_partial_record(self):
+        self.store_analysis()
+        self.store.append(self.file_date + datetime.timedelta(seconds=15), [0.0], 3, [np.arange(TOP_K)], self.logits[:1], [0.0], [30])
+        with open(self.store._day_file(self.file_date), 'ab') as f:
+            f.write(b'\0' * 7)
+        self.assertEqual(len(self.store.read(self.file_date)), 7)
+        self.assertEqual([file_date.second for file_date, _, _ in self.rescore(1.25)], [37, 52])
+
+        # the next append first drops the partial record
+        self.store.append(self.file_date, [0.0], 3, [np.arange(TOP_K)], self.logits[:1], [0.0], [30])
+        self.assertEqual(os.path.getsize(self.store._day_file(self.file_date)), 8 * RECORD_DTYPE.itemsize)
+
+    def test_perch_scores_from_top_logits(self):
+        model = Perch.__new__(Perch)
+        logits = self.logits.astype('float32')
+        np.testing.assert_allclose(scores_from_logits('Perch_v2', logits[:, :TOP_K], model.score_norm(logits), 1.0),
+                                   model.scores(logits)[:, :TOP_K], rtol=1e-5)
+
+
+if __name__ == '__main__':
+    unittest.main()
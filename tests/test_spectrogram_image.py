@@ -0,0 +1,70 @@
+import os
+import subprocess
+import sys
+import unittest
+
+import numpy as np
+
+from scripts.utils.helpers import FONT_DIR
+from scripts.utils.reporting import get_spectrogram_plan
+from scripts.utils.spectrogram_image import HEIGHT, WIDTH, chrome, colormap_lut, layout, render
+
+FONT = os.path.join(FONT_DIR, 'RobotoFlex-Regular.ttf')
+
+
+class TestRender(unittest.TestCase):
+
+    def test_plasma_lut(self):
+        lut = colormap_lut()
+        self.assertEqual(lut.shape, (256, 3))
+        self.assertEqual(tuple(lut[0]), (0x0d, 0x08, 0x87))
+        self.assertEqual(tuple(lut[-1]), (0xf0, 0xf9, 0x21))
+
+    def test_matrix_in_plot_box(self):
+        # low bands at the bottom, colors from the min to the max of the matrix
+        matrix = np.zeros((1024, 100))
+        matrix[512:] = 2.0
+        img = np.asarray(render(matrix, 6.0, 'Eurasian Magpie', 'By_Date/clip.mp3', FONT))
+        self.assertEqual(img.shape, (HEIGHT, WIDTH, 3))
+        (left, top, right, bottom), _ = layout(FONT)
+        self.assertEqual(tuple(img[bottom - 10, (left + right) // 2]), tuple(colormap_lut()[0]))
+        self.assertEqual(tuple(img[top + 10, (left + right) // 2]), tuple(colormap_lut()[-1]))
+
+    def test_chrome_cached_per_duration(self):
+        self.assertIs(chrome(6.0, FONT), chrome(6.0, FONT))
+        self.assertIsNot(chrome(6.0, FONT), chrome(9.0, FONT))
+        # render draws on a copy
+        before = np.asarray(chrome(6.0, FONT)).copy()
+        render(np.random.default_rng(0).random((1024, 100)), 6.0, 'title', 'comment', FONT)
+        np.testing.assert_array_equal(np.asarray(chrome(6.0, FONT)), before)
+
+    def test_no_matplotlib(self):
+        code = 'import sys, numpy; from scripts.utils.spectrogram_image import render; ' \
+               f'render(numpy.ones((8, 8)), 3.0, "t", "c", {FONT!r}); print("matplotlib" in sys.modules)'
+        result = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.dirname(__file__)),
+                                capture_output=True, text=True, check=True)
+        self.assertEqual(result.stdout.strip(), 'False')
+
+
+class TestSpectrogramPlan(unittest.TestCase):
+
+    def test_cached_per_rate(self):
+        self.assertIs(get_spectrogram_plan(48000), get_spectrogram_plan(48000))
+        self.assertIsNot(get_spectrogram_plan(48000), get_spectrogram_plan(32000))
+
+    def test_magnitude_framing_of_librosa(self):
+        import librosa
+        plan = get_spectrogram_plan(48000)
+        y = np.random.default_rng(0).standard_normal(6 * 48000).astype('float32')
+        expected = np.abs(librosa.stft(y, n_fft=plan.n_fft, hop_length=plan.hop_length, window='hann'))
+        np.testing.assert_allclose(plan.magnitude(y), expected, rtol=1e-3, atol=1e-2)
+
+    def test_matrix(self):
+        plan = get_spectrogram_plan(48000)
+        matrix = plan.matrix(np.random.default_rng(0).standard_normal(6 * 48000).astype('float32'))
+        self.assertEqual(matrix.shape, (plan.n_mels, 6 * 48000 // plan.hop_length + 1))
+        self.assertTrue(np.all(np.isfinite(matrix)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,189 @@
+import datetime
+import os
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+
+import numpy as np
+import soundfile
+
+from scripts.utils.classes import ParseFileName
+from scripts.utils.models import Prediction, rank_of_best
+from scripts.utils.streaming import RingBuffer, StreamAnalyzer, read_pcm_blocks
+from tests.helpers import Settings
+
+RATE = 100
+
+
+class FakeModel:
+    """Scores the peak of a chunk as Pica pica and the negative peak as Human, everything else is background."""
+    chunk_duration = 3.0
+    sample_rate = RATE
+
+    def __init__(self):
+        self.labels = ['Pica pica'] + [f'Species {i}' for i in range(1, 19)] + ['Human vocal']
+        self.human_indices = np.array([19])
+        self.chunks = []
+
+    def set_meta_data(self, lat, lon, week):
+        pass
+
+    def get_species_list(self):
+        return []
+
+    def predict_logits(self, chunk):
+        self.chunks.append(chunk)
+        scores = np.full((1, len(self.labels)), 0.01, dtype='float32')
+        scores[0, 0] = chunk.max()
+        scores[0, 19] = -chunk.min()
+        return scores
+
+    def scores(self, logits):
+        return logits
+
+    def top_k(self, scores, k=10):
+        return Prediction(scores, self.labels, k, self.human_indices)
+
+    def human_ranks(self, scores):
+        return rank_of_best(scores, self.human_indices)
+
+
+def pipe_pcm(samples, channels, sizes=(7, 301, 64, 1, 999)):
+    """Write samples as S16_LE into a pipe from a thread, in odd sized writes, and return the read end."""
+    data = np.repeat((samples * 32767).astype('<i2')[:, np.newaxis], channels, axis=1).tobytes()
+    read_fd, write_fd = os.pipe()
+
+    def produce():
+        with os.fdopen(write_fd, 'wb', buffering=0) as out:
+            pos = 0
+            for i in range(len(data)):
+                size = sizes[i % len(sizes)]
+                out.write(data[pos:pos + size])
+                pos += size
+                if pos >= len(data):
+                    break
+
+    threading.Thread(target=produce).start()
+    return os.fdopen(read_fd, 'rb')
+
+
+class TestRingBuffer(unittest.TestCase):
+
+    def test_wraps_around(self):
+        ring = RingBuffer(10)
+        signal = np.arange(37, dtype='float32')
+        for i in range(0, 37, 4):
+            ring.write(signal[i:i + 4])
+            self.assertEqual(ring.end, min(i + 4, 37))
+            np.testing.assert_array_equal(ring.read(ring.start, ring.end), signal[ring.start:ring.end])
+
+    def test_write_larger_than_capacity(self):
+        ring = RingBuffer(10)
+        ring.write(np.arange(25, dtype='float32'))
+        self.assertEqual(ring.start, 15)
+        np.testing.assert_array_equal(ring.read(17, 22), np.arange(17, 22))
+
+    def test_read_outside_buffer(self):
+        ring = RingBuffer(10)
+        ring.write(np.zeros(25, dtype='float32'))
+        with self.assertRaises(IndexError):
+            ring.read(10, 20)
+        with self.assertRaises(IndexError):
+            ring.read(20, 26)
+
+
+class TestReadPcmBlocks(unittest.TestCase):
+
+    def test_stereo_downmix(self):
+        samples = np.linspace(-1, 1, 1000, dtype='float32')
+        with pipe_pcm(samples, 2) as stream:
+            blocks = list(read_pcm_blocks(stream, RATE, channels=2))
+        np.testing.assert_allclose(np.concatenate(blocks), samples, atol=1e-4)
+
+
+class TestStreamAnalyzer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.settings = settings = Settings.with_defaults()
+        settings['RECS_DIR'] = self.tmp.name
+        for target, value in [('scripts.utils.helpers._load_settings', settings),
+                              ('scripts.utils.analysis.loadCustomSpeciesList', [])]:
+            patcher = patch(target, return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.model = FakeModel()
+        patcher = patch('scripts.utils.streaming.load_global_model', return_value=self.model)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.tmp.cleanup)
+
+    def analyze(self, samples, report=None):
+        reports = []
+
+        def collect(file, detections):
+            reports.append((file, detections))
+            if report is not None:
+                report(file, detections)
+
+        analyzer = StreamAnalyzer(RATE, collect,
+                                  start_time=datetime.datetime(2024, 2, 24, 16, 19, 37, 300000))
+        with pipe_pcm(samples, 1) as stream:
+            for block in read_pcm_blocks(stream, RATE):
+                analyzer.feed(block)
+        analyzer.close()
+        return reports
+
+    def test_detection_in_third_window(self):
+        samples = np.zeros(12 * RATE, dtype='float32')
+        samples[7 * RATE] = 0.9
+        reports = self.analyze(samples)
+
+        self.assertEqual([chunk.shape for chunk in self.model.chunks], [(3 * RATE,)] * 4)
+        self.assertEqual(len(reports), 1)
+        file, detections = reports[0]
+        # window at 6s starts 16:19:43.3, the segment 1.5s earlier and is named after 16:19:41
+        self.assertEqual(file.file_date, datetime.datetime(2024, 2, 24, 16, 19, 41))
+        self.assertEqual([(d.scientific_name, d.start, d.stop) for d in detections], [('Pica pica', 2.3, 5.3)])
+
+        # segment is there, and the detection sits at the offset within it
+        self.assertEqual(os.listdir(os.path.join(self.tmp.name, 'StreamData')), [os.path.basename(file.file_name)])
+        audio, rate = soundfile.read(file.file_name, dtype='float32')
+        self.assertEqual(rate, RATE)
+        self.assertEqual(np.argmax(audio), int(3.3 * RATE))
+        self.assertEqual(ParseFileName(file.file_name).file_date, file.file_date)
+
+    def test_last_window_reported_on_close(self):
+        samples = np.zeros(9 * RATE, dtype='float32')
+        samples[8 * RATE] = 0.9
+        reports = self.analyze(samples)
+        self.assertEqual(len(reports), 1)
+        self.assertEqual(reports[0][1][0].scientific_name, 'Pica pica')
+
+    def test_human_masks_neighbours(self):
+        samples = np.zeros(12 * RATE, dtype='float32')
+        samples[7 * RATE] = 0.9
+        samples[10 * RATE] = -0.9
+        self.assertEqual(self.analyze(samples), [])
+        self.assertFalse(os.path.exists(os.path.join(self.tmp.name, 'StreamData')))
+
+    def test_high_overlap_segments_are_unique(self):
+        # windows every 0.5s: several start within the same second
+        self.settings['OVERLAP'] = 2.5
+        samples = np.zeros(12 * RATE, dtype='float32')
+        samples[np.arange(4, 8) * RATE] = [0.7, 0.8, 0.9, 0.75]
+        written = {}
+        reports = self.analyze(samples, lambda file, detections: written.setdefault(file.file_name, soundfile.read(file.file_name)[0]))
+
+        self.assertGreater(len(reports), 6)
+        self.assertEqual(len(written), len(reports))
+        # none was overwritten by a later window while waiting to be reported
+        for file_name, audio in written.items():
+            np.testing.assert_array_equal(soundfile.read(file_name)[0], audio)
+        for file, _ in reports:
+            self.assertEqual(ParseFileName(file.file_name).file_date, file.file_date)
+
+
+if __name__ == '__main__':
+    unittest.main()